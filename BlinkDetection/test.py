@@ -33,16 +33,23 @@ predictor_path = '/Users/manassrv29/Desktop/project/expo-project/BlinkDetection/
 detector = dlib.get_frontal_face_detector()
 predictor = dlib.shape_predictor(predictor_path)
 
-def eye_aspect_ratio(eye):
+def eye_aspect_ratio(eyes):
+    # eyes is a (n, 6, 2) batch, so both eyes are handled in one expression
+    eyes = np.asarray(eyes, dtype=np.float64)
     # compute the euclidean distances between the two sets of vertical eye landmarks (x, y)-coordinates
-    A = np.linalg.norm(eye[1] - eye[5])
-    B = np.linalg.norm(eye[2] - eye[4])
+    A = np.linalg.norm(eyes[:, 1] - eyes[:, 5], axis=-1)
+    B = np.linalg.norm(eyes[:, 2] - eyes[:, 4], axis=-1)
     # compute the euclidean distance between the horizontal eye landmark (x, y)-coordinates
-    C = np.linalg.norm(eye[0] - eye[3])
+    C = np.linalg.norm(eyes[:, 0] - eyes[:, 3], axis=-1)
     # compute the eye aspect ratio
     ear = (A + B) / (2.0 * C)
     return ear
 
+def shape_to_array(shape):
+    # convert all 68 dlib landmarks to a (68, 2) array in one pass
+    return np.fromiter((c for p in shape.parts() for c in (p.x, p.y)),
+                       dtype=np.int32, count=2 * shape.num_parts).reshape(-1, 2)
+
 # --- Preprocessing Function ---
 def preprocess_face(img):
     img = cv2.resize(img, IMG_SIZE)
@@ -113,15 +120,9 @@ while True:
                 # Use dlib for landmarks
                 dlib_rects = detector(gray, 0)
                 for rect in dlib_rects:
-                    shape = predictor(gray, rect)
-                    shape_np = np.zeros((68, 2), dtype='int')
-                    for i in range(68):
-                        shape_np[i] = (shape.part(i).x, shape.part(i).y)
+                    shape_np = shape_to_array(predictor(gray, rect))
                     # Left eye: 42-47, Right eye: 36-41
-                    leftEye = shape_np[42:48]
-                    rightEye = shape_np[36:42]
-                    leftEAR = eye_aspect_ratio(leftEye)
-                    rightEAR = eye_aspect_ratio(rightEye)
+                    leftEAR, rightEAR = eye_aspect_ratio(np.stack([shape_np[42:48], shape_np[36:42]]))
                     ear = (leftEAR + rightEAR) / 2.0
                     # Blink detection logic
                     if ear < EYE_AR_THRESH:
@@ -0,0 +1,98 @@
+"""
+Decode / detection / end-to-end latency and peak memory of the full-resolution
+photo path against the multi-resolution one, by input resolution.
+
+Every face in BlinkDetection/test_images is upscaled to each target resolution and
+re-encoded as JPEG, like a phone upload. The accuracy columns compare the embedding
+from the reduced path with the full-resolution one for the same photo.
+
+    python bench_decode.py [--megapixels 1 3 12] [--repeat 3]
+"""
+import argparse
+import os
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from routes.face_engine import FaceEngine
+from routes.image_decode import decode_reduced
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BACKEND_DIR)
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - started) * 1000.0
+
+def full_path(engine, image_bytes):
+    img, decode_ms = timed(cv2.imdecode, np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    faces, detect_ms = timed(engine.detect, gray)
+    if not faces:
+        return None, decode_ms, detect_ms
+    x, y, w, h = faces[0]
+    return engine.embed(img[y:y+h, x:x+w]), decode_ms, detect_ms
+
+def reduced_path(engine, image_bytes):
+    (img, _), decode_ms = timed(decode_reduced, image_bytes)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    faces, detect_ms = timed(engine.detect_scaled, gray)
+    if not faces:
+        return None, decode_ms, detect_ms
+    x, y, w, h = faces[0]
+    return engine.embed(img[y:y+h, x:x+w]), decode_ms, detect_ms
+
+def measure(path, engine, image_bytes, repeat):
+    decode, detect, total = [], [], []
+    for _ in range(repeat):
+        tracemalloc.start()
+        (embedding, decode_ms, detect_ms), total_ms = timed(path, engine, image_bytes)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        decode.append(decode_ms)
+        detect.append(detect_ms)
+        total.append(total_ms)
+    return embedding, np.median(decode), np.median(detect), np.median(total), peak / 2**20
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', default=os.path.join(PROJECT_ROOT, 'BlinkDetection', 'test_images'))
+    parser.add_argument('--model', default=os.path.join(BACKEND_DIR, 'routes', 'output_model.tflite'))
+    parser.add_argument('--predictor', default=os.path.join(PROJECT_ROOT, 'BlinkDetection', 'shape_predictor_68_face_landmarks.dat'))
+    parser.add_argument('--megapixels', type=float, nargs='*', default=[1, 3, 12])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    engine = FaceEngine(args.model, args.predictor)
+    engine.warm_up()
+    sources = [cv2.imread(os.path.join(args.images, f)) for f in sorted(os.listdir(args.images))]
+    sources = [img for img in sources if img is not None]
+
+    print(f"{'MP':>5} {'path':<8}{'decode ms':>10}{'detect ms':>10}{'total ms':>10}{'peak MiB':>10}"
+          f"{'faces':>7}{'min sim':>9}")
+    for megapixels in args.megapixels:
+        rows = {'full': [], 'reduced': []}
+        similarities = []
+        for src in sources:
+            ratio = np.sqrt(megapixels * 1e6 / (src.shape[0] * src.shape[1]))
+            big = cv2.resize(src, (int(src.shape[1] * ratio), int(src.shape[0] * ratio)), interpolation=cv2.INTER_CUBIC)
+            image_bytes = cv2.imencode('.jpg', big, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+            full = measure(full_path, engine, image_bytes, args.repeat)
+            reduced = measure(reduced_path, engine, image_bytes, args.repeat)
+            rows['full'].append(full)
+            rows['reduced'].append(reduced)
+            if full[0] is not None and reduced[0] is not None:
+                similarities.append(float(np.dot(full[0], reduced[0])))
+        for name, results in rows.items():
+            found = sum(1 for r in results if r[0] is not None)
+            decode_ms = np.mean([r[1] for r in results])
+            detect_ms = np.mean([r[2] for r in results])
+            total_ms = np.mean([r[3] for r in results])
+            peak = np.max([r[4] for r in results])
+            min_sim = f"{min(similarities):.4f}" if name == 'reduced' and similarities else ''
+            print(f"{megapixels:>5g} {name:<8}{decode_ms:>10.1f}{detect_ms:>10.1f}{total_ms:>10.1f}{peak:>10.1f}"
+                  f"{found:>4}/{len(results):<2}{min_sim:>9}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Recall vs latency of the IVF / IVF-PQ embedding index against exact search.
+
+Uses synthetic 128-d embeddings (identity centres plus per-photo noise) so it runs
+without a populated database:
+
+    python bench_embedding_index.py --size 200000 --queries 200
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from routes.embedding_index import IVFIndex
+
+def make_embeddings(size, dim, rng):
+    centres = rng.normal(size=(max(1, size // 4), dim)).astype(np.float32)
+    vectors = centres[rng.integers(0, len(centres), size)] + 0.6 * rng.normal(size=(size, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def exact_top_k(vectors, queries, k):
+    results = []
+    started = time.perf_counter()
+    for query in queries:
+        scores = vectors @ query
+        top = np.argpartition(-scores, k - 1)[:k]
+        results.append(set(top[np.argsort(-scores[top])].tolist()))
+    return results, (time.perf_counter() - started) * 1000.0 / len(queries)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=128)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=1)
+    parser.add_argument('--nlist', type=int, default=0, help='defaults to 4 * sqrt(size)')
+    parser.add_argument('--pq', type=int, nargs='*', default=[0, 16, 32], help='pq_m values, 0 = IVF-flat')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16', 'int8'],
+                        help='storage of IVF-flat vectors')
+    parser.add_argument('--nprobe', type=int, nargs='*', default=[1, 2, 4, 8, 16, 32, 64])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = make_embeddings(args.size, args.dim, rng)
+    picks = rng.integers(0, args.size, args.queries)
+    queries = vectors[picks] + 0.05 * rng.normal(size=(args.queries, args.dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    nlist = args.nlist or int(4 * np.sqrt(args.size))
+
+    truth, exact_ms = exact_top_k(vectors, queries, args.k)
+    print(f"{args.size} vectors, dim {args.dim}, {args.queries} queries, k={args.k}, nlist={nlist}")
+    print(f"exact search: {exact_ms:.3f} ms/query, {vectors.nbytes / 2**20:.1f} MiB\n")
+    print(f"{'index':<12}{'nprobe':>8}{'recall@k':>10}{'ms/query':>10}{'speedup':>9}{'MiB':>8}")
+
+    for pq_m in args.pq:
+        index = IVFIndex(args.dim, nlist=nlist, pq_m=pq_m, dtype=args.dtype)
+        started = time.perf_counter()
+        index.train(vectors)
+        index.add(np.arange(args.size), vectors)
+        build_s = time.perf_counter() - started
+        # Search the saved, memory-mapped form, as the app does after startup
+        path = os.path.join(tempfile.mkdtemp(), 'index')
+        index.save(path)
+        index = IVFIndex.load(path)
+        size_mib = (index.data.nbytes + (index.scales.nbytes if index.has_scales else 0)) / 2**20
+        name = f'IVF-PQ{pq_m}' if pq_m else f'IVF-{args.dtype}'
+        for nprobe in args.nprobe:
+            if nprobe > index.nlist:
+                continue
+            hits = 0
+            started = time.perf_counter()
+            for query, expected in zip(queries, truth):
+                found = {vector_id for vector_id, _ in index.search(query, args.k, nprobe=nprobe)}
+                hits += len(found & expected)
+            ms = (time.perf_counter() - started) * 1000.0 / args.queries
+            recall = hits / (args.k * args.queries)
+            print(f"{name:<12}{nprobe:>8}{recall:>10.3f}{ms:>10.3f}{exact_ms / ms:>8.1f}x{size_mib:>8.1f}")
+        print(f"{'':<12}(build {build_s:.1f}s)\n")
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Throughput and peak memory of whole-file Fernet against segmented AES-GCM
+(routes/segment_crypto.py) for stored images and liveness videos.
+
+Images are the faces in BlinkDetection/test_images re-encoded as JPEG at each
+resolution; "to cv2" reads the encrypted file and decodes it into an image.
+Videos are the sample clips, encrypted from and decrypted to a file the way
+liveness uploads are stored and analysed. Peak memory is the tracemalloc peak of
+one operation.
+
+    python bench_encryption.py [--megapixels 1 3 12] [--repeat 5]
+"""
+import argparse
+import glob
+import os
+import tempfile
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from cryptography.fernet import Fernet
+from routes import segment_crypto
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BACKEND_DIR)
+
+fernet = Fernet(Fernet.generate_key())
+KEY = os.urandom(32)
+
+def measure(fn, repeat):
+    """(best seconds, peak bytes) of fn()"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+def fernet_to_cv2(path):
+    with open(path, 'rb') as f:
+        image_bytes = fernet.decrypt(f.read())
+    return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+
+def segmented_to_cv2(path):
+    return cv2.imdecode(np.frombuffer(segment_crypto.decrypt_file(path, KEY), np.uint8), cv2.IMREAD_COLOR)
+
+def fernet_file(src_path, dst_path, transform):
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        dst.write(transform(src.read()))
+
+def segmented_encrypt_file(src_path, dst_path):
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        segment_crypto.encrypt_stream(src, dst, KEY)
+
+def segmented_decrypt_file(src_path, dst_path):
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        segment_crypto.decrypt_stream(src, dst, KEY)
+
+def row(label, size, fernet_result, segmented_result):
+    (f_s, f_peak), (s_s, s_peak) = fernet_result, segmented_result
+    mb = size / 2**20
+    print(f"{label:<28}{mb / f_s:>10.0f}{mb / s_s:>10.0f}{f_peak / 2**20:>11.1f}{s_peak / 2**20:>11.1f}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', default=os.path.join(PROJECT_ROOT, 'BlinkDetection', 'test_images'))
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[1, 3, 12])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp(prefix='bench_encryption_')
+    fernet_path = os.path.join(workdir, 'fernet')
+    segmented_path = os.path.join(workdir, 'segmented')
+    plain_path = os.path.join(workdir, 'plain')
+
+    img = next(cv2.imread(p) for p in sorted(glob.glob(os.path.join(args.images, '*'))) if cv2.imread(p) is not None)
+    print(f"{'':<28}{'MB/s':>10}{'':>10}{'peak MiB':>11}")
+    print(f"{'':<28}{'fernet':>10}{'segmented':>10}{'fernet':>11}{'segmented':>11}")
+    for megapixels in args.megapixels:
+        scale = np.sqrt(megapixels * 1e6 / (img.shape[0] * img.shape[1]))
+        resized = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+        data = cv2.imencode('.jpg', resized, [cv2.IMWRITE_JPEG_QUALITY, 92])[1].tobytes()
+        with open(fernet_path, 'wb') as f:
+            f.write(fernet.encrypt(data))
+        with open(segmented_path, 'wb') as f:
+            f.write(segment_crypto.encrypt(data, KEY))
+        label = f"{megapixels:g} MP JPEG ({len(data) / 2**20:.1f} MiB)"
+        print(label)
+        row('  encrypt', len(data), measure(lambda: fernet.encrypt(data), args.repeat),
+            measure(lambda: segment_crypto.encrypt(data, KEY), args.repeat))
+        row('  decrypt file', len(data), measure(lambda: fernet.decrypt(open(fernet_path, 'rb').read()), args.repeat),
+            measure(lambda: segment_crypto.decrypt_file(segmented_path, KEY), args.repeat))
+        row('  decrypt file to cv2', len(data), measure(lambda: fernet_to_cv2(fernet_path), args.repeat),
+            measure(lambda: segmented_to_cv2(segmented_path), args.repeat))
+        print(f"  stored size overhead      {os.path.getsize(fernet_path) / len(data) - 1:>9.1%}"
+              f"{os.path.getsize(segmented_path) / len(data) - 1:>10.2%}")
+
+    for video in sorted(glob.glob(os.path.join(PROJECT_ROOT, 'BlinkDetection', '*.mov'))):
+        size = os.path.getsize(video)
+        print(f"{os.path.basename(video)} ({size / 2**20:.1f} MiB)")
+        row('  encrypt file', size,
+            measure(lambda: fernet_file(video, fernet_path, fernet.encrypt), args.repeat),
+            measure(lambda: segmented_encrypt_file(video, segmented_path), args.repeat))
+        row('  decrypt to file', size,
+            measure(lambda: fernet_file(fernet_path, plain_path, fernet.decrypt), args.repeat),
+            measure(lambda: segmented_decrypt_file(segmented_path, plain_path), args.repeat))
+
+if __name__ == '__main__':
+    main()
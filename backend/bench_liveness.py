@@ -0,0 +1,99 @@
+"""
+Time to verdict and peak memory of liveness video analysis.
+
+Runs each analysis mode on the sample videos in BlinkDetection/ and uploads/, each in
+a fresh process so the peak RSS of one run doesn't hide another. "buffered" is the
+original decode-everything-then-analyse implementation, kept here as the baseline;
+"sampled" analyses about LIVENESS_SAMPLE_FPS downscaled frames per second, and its
+"frames" column counts those. "detector" is the fraction of analysed frames on which
+the dlib face detector ran. The verdict (blinks >= REQUIRED_BLINKS) should match
+across modes.
+
+    python bench_liveness.py [videos ...]
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import resource
+import time
+import cv2
+from routes import liveness
+from routes.face_engine import FaceEngine
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BACKEND_DIR)
+MODEL_PATH = os.path.join(BACKEND_DIR, 'routes', 'output_model.tflite')
+PREDICTOR_PATH = os.path.join(PROJECT_ROOT, 'BlinkDetection', 'shape_predictor_68_face_landmarks.dat')
+
+def buffered(engine, filepath):
+    cap = cv2.VideoCapture(filepath)
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    blink_count = 0
+    counter = 0
+    for frame in frames:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        for shape_np in engine.landmarks(gray):
+            ear = (liveness.eye_aspect_ratio(shape_np[42:48]) + liveness.eye_aspect_ratio(shape_np[36:42])) / 2.0
+            if ear < liveness.EAR_THRESHOLD:
+                counter += 1
+            else:
+                if counter >= liveness.CONSEC_FRAMES:
+                    blink_count += 1
+                counter = 0
+    return {'blinks': blink_count, 'frames_analysed': len(frames)}
+
+MODES = {
+    'buffered': buffered,
+    'streaming': lambda engine, filepath: liveness.analyse_video(engine, filepath, track=False, sample_fps=0),
+    'tracked': lambda engine, filepath: liveness.analyse_video(engine, filepath, track=True, sample_fps=0),
+    'sampled': lambda engine, filepath: liveness.analyse_video(engine, filepath, track=True),
+}
+
+def run_one(mode, filepath, results):
+    engine = FaceEngine(MODEL_PATH, PREDICTOR_PATH)
+    engine.warm_up()
+    baseline_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    result = MODES[mode](engine, filepath)
+    elapsed = time.perf_counter() - started
+    peak_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put(dict(result, seconds=elapsed, peak_mib=(peak_kib - baseline_kib) / 1024.0))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('videos', nargs='*')
+    parser.add_argument('--modes', nargs='*', default=list(MODES))
+    args = parser.parse_args()
+    videos = args.videos or sorted(
+        glob.glob(os.path.join(PROJECT_ROOT, 'BlinkDetection', '*.mov')) +
+        glob.glob(os.path.join(BACKEND_DIR, 'uploads', 'liveness_*.mp4'))
+    )
+
+    context = multiprocessing.get_context('spawn')
+    print(f"{'video':<22}{'mode':<12}{'blinks':>7}{'frames':>8}{'verdict s':>11}{'ms/frame':>10}"
+          f"{'detector':>10}{'peak RSS MiB':>14}  extra")
+    for video in videos:
+        for mode in args.modes:
+            results = context.Queue()
+            process = context.Process(target=run_one, args=(mode, video, results))
+            process.start()
+            result = results.get()
+            process.join()
+            frames = result.get('frames_analysed', 0)
+            detector_ratio = result.get('detector_calls', frames) / float(frames) if frames else 0.0
+            extra = {k: v for k, v in result.items()
+                     if k not in ('blinks', 'frames_analysed', 'seconds', 'peak_mib', 'face_found', 'detector_calls',
+                                  'embedding')}
+            print(f"{os.path.basename(video):<22}{mode:<12}{result['blinks']:>7}{frames:>8}"
+                  f"{result['seconds']:>11.2f}{result['seconds'] * 1000.0 / max(frames, 1):>10.1f}"
+                  f"{detector_ratio:>10.2f}{result['peak_mib']:>14.1f}  {extra if extra else ''}")
+
+if __name__ == '__main__':
+    main()
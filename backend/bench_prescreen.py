@@ -0,0 +1,96 @@
+"""
+CPU saved by the replay pre-screen on static and replayed submissions.
+
+Turns every face in BlinkDetection/test_images into synthetic attack clips: a still
+photo in front of the camera ("static", sensor noise only) and a photo shown on a
+flickering screen ("replay"). Each clip, plus the genuine sample videos, is timed
+through the pre-screen and through the full landmark analysis it would otherwise
+get. "saved" is the fraction of the full analysis CPU time a rejection avoids; for
+genuine clips, which must pass, "overhead" is what the pre-screen adds.
+
+    python bench_prescreen.py [--seconds 4] [--size 640x480]
+"""
+import argparse
+import glob
+import os
+import tempfile
+import time
+import cv2
+import numpy as np
+from routes import liveness
+from routes.face_engine import FaceEngine
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BACKEND_DIR)
+
+def write_clip(path, frames, fps=30):
+    height, width = frames[0].shape[:2]
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    for frame in frames:
+        writer.write(frame)
+    writer.release()
+
+def attack_clips(img, size, count, rng):
+    img = cv2.resize(img, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+    noisy = lambda frame: np.clip(frame + rng.normal(0, 2, frame.shape), 0, 255).astype(np.uint8)
+    return {
+        'static': [noisy(img) for _ in range(count)],
+        # A 60 Hz screen filmed at 30 fps beats at a few percent of its brightness
+        'replay': [noisy(img * (1.0 + 0.06 * np.sin(2.1 * i))) for i in range(count)],
+    }
+
+def cpu_seconds(fn, *args):
+    started = time.process_time()
+    result = fn(*args)
+    return result, time.process_time() - started
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', default=os.path.join(PROJECT_ROOT, 'BlinkDetection', 'test_images'))
+    parser.add_argument('--model', default=os.path.join(BACKEND_DIR, 'routes', 'output_model.tflite'))
+    parser.add_argument('--predictor', default=os.path.join(PROJECT_ROOT, 'BlinkDetection', 'shape_predictor_68_face_landmarks.dat'))
+    parser.add_argument('--seconds', type=float, default=4.0)
+    parser.add_argument('--size', default='640x480')
+    args = parser.parse_args()
+    size = tuple(int(v) for v in args.size.split('x'))
+
+    engine = FaceEngine(args.model, args.predictor)
+    engine.warm_up()
+    rng = np.random.default_rng(0)
+    workdir = tempfile.mkdtemp(prefix='bench_prescreen_')
+    clips = []
+    for filename in sorted(os.listdir(args.images)):
+        img = cv2.imread(os.path.join(args.images, filename))
+        if img is None:
+            continue
+        for kind, frames in attack_clips(img, size, int(30 * args.seconds), rng).items():
+            path = os.path.join(workdir, f'{kind}_{os.path.splitext(filename)[0]}.mp4')
+            write_clip(path, frames)
+            clips.append((kind, path))
+    clips += [('genuine', path) for path in sorted(glob.glob(os.path.join(PROJECT_ROOT, 'BlinkDetection', '*.mov')))]
+
+    print(f"{'clip':<24}{'kind':<9}{'verdict':<9}{'motion':>8}{'flicker':>9}{'screen ms':>11}{'full ms':>10}{'saved':>8}")
+    saved = {'static': [], 'replay': []}
+    wrong = 0
+    for kind, path in clips:
+        screen, screen_cpu = cpu_seconds(liveness.prescreen, path)
+        _, full_cpu = cpu_seconds(liveness.analyse_video, engine, path)
+        verdict = 'pass' if screen['passed'] else screen['reason']
+        if kind == 'genuine':
+            wrong += not screen['passed']
+            column = f"{-screen_cpu / full_cpu:>8.1%}"
+        else:
+            wrong += screen['passed']
+            fraction = (1.0 - screen_cpu / full_cpu) if not screen['passed'] else 0.0
+            saved[kind].append(fraction)
+            column = f"{fraction:>8.1%}"
+        print(f"{os.path.basename(path):<24}{kind:<9}{verdict:<9}{screen['motion']:>8.2f}{screen['flicker']:>9.4f}"
+              f"{screen_cpu * 1000:>11.1f}{full_cpu * 1000:>10.1f}{column}")
+    print()
+    for kind, fractions in saved.items():
+        if fractions:
+            print(f"{kind}: {np.mean(fractions):.1%} of the landmark-stage CPU saved on average")
+    print(f"misclassified clips: {wrong}")
+
+if __name__ == '__main__':
+    main()
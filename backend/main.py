@@ -12,6 +12,11 @@ from routes.certificate import certificate_bp
 from routes.admin import admin_bp
 from routes.notifications import notifications_bp
 from routes.activity import activity_bp
+from routes.metrics import metrics_bp
+from routes.liveness_upload import liveness_upload_bp
+from routes.liveness_stream import liveness_stream_bp
+from routes.enrollment import enrollment_bp, start_worker as start_enrollment_worker
+from routes import vision_workers
 
 from models import db
 
@@ -63,6 +68,10 @@ app.register_blueprint(certificate_bp)
 app.register_blueprint(admin_bp)
 app.register_blueprint(notifications_bp)
 app.register_blueprint(activity_bp)
+app.register_blueprint(metrics_bp)
+app.register_blueprint(liveness_upload_bp)
+app.register_blueprint(liveness_stream_bp)
+app.register_blueprint(enrollment_bp)
 
 from sqlalchemy import text
 
@@ -108,5 +117,11 @@ if __name__ == '__main__':
     print(f"Network URL: http://{local_ip}:5001")
     print("====================\n")
     
+    # Started here rather than at import: vision worker processes are spawned and
+    # re-import this module (as __mp_main__), and migrate_db.py imports it too
+    vision_workers.start()
+    # Processes queued reference uploads in the background (routes/enrollment.py)
+    start_enrollment_worker(app)
+
     # Run the app on all network interfaces
     app.run(debug=True, host='0.0.0.0', port=5001, ssl_context=None)
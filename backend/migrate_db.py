@@ -2,7 +2,7 @@
 Database migration script to update the database schema with new models
 """
 from main import app
-from models import db, ActivityLog, User
+from models import db, ActivityLog, User, FaceArtifact
 from datetime import datetime
 import sys
 from sqlalchemy import inspect, text
@@ -18,8 +18,18 @@ def migrate_database():
             # Get inspector
             inspector = inspect(db.engine)
             
-            # Check if ActivityLog table exists
+            # Check if ActivityLog and FaceEmbedding tables exist
             activity_table_exists = inspector.has_table('activity_log')
+            face_embedding_table_exists = inspector.has_table('face_embedding')
+            face_artifact_table_exists = inspector.has_table('face_artifact')
+            # FaceArtifact was first keyed by a SHA-256 of the image. Those keys can't be
+            # turned into blob keys without the images, and the rows are only a cache of
+            # face detection results, so the table is recreated
+            if face_artifact_table_exists and 'image_key' not in [col['name'] for col in inspector.get_columns('face_artifact')]:
+                print("Dropping FaceArtifact table keyed by content hash...")
+                FaceArtifact.__table__.drop(db.engine)
+                face_artifact_table_exists = False
+            enrollment_job_table_exists = inspector.has_table('enrollment_job')
             
             # Check if User.last_login and User.password_hash columns exist
             user_has_last_login = False
@@ -36,6 +46,27 @@ def migrate_database():
                 print("ActivityLog table created successfully.")
             else:
                 print("ActivityLog table already exists.")
+
+            if not face_embedding_table_exists:
+                print("Creating FaceEmbedding table...")
+                db.create_all()
+                print("FaceEmbedding table created successfully.")
+            else:
+                print("FaceEmbedding table already exists.")
+
+            if not face_artifact_table_exists:
+                print("Creating FaceArtifact table...")
+                db.create_all()
+                print("FaceArtifact table created successfully.")
+            else:
+                print("FaceArtifact table already exists.")
+
+            if not enrollment_job_table_exists:
+                print("Creating EnrollmentJob table...")
+                db.create_all()
+                print("EnrollmentJob table created successfully.")
+            else:
+                print("EnrollmentJob table already exists.")
             
             # Add last_login column to User table if it doesn't exist
             if not user_has_last_login:
@@ -0,0 +1,105 @@
+"""
+Re-encrypt stored uploads from whole-file Fernet to the segmented AES-GCM format
+(routes/segment_crypto.py), and encrypt liveness videos that were stored in plaintext.
+
+Covers legacy files in uploads/ and the local blob store. Files are rewritten in
+place through a temporary file and a rename, so a file is always readable in one
+format or the other and an interrupted run can simply be started again. Blob keys
+are an HMAC of the plaintext and stay the same.
+
+    python migrate_encryption.py [--workers 4] [--dry-run]
+"""
+import argparse
+import base64
+import hashlib
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from cryptography.fernet import Fernet, InvalidToken
+from routes import segment_crypto
+
+UPLOAD_FOLDER = 'uploads'
+
+# Same derivation as routes/face.py
+FERNET_KEY = base64.urlsafe_b64encode(hashlib.sha256(b'super_secret_image_key').digest())
+STORAGE_KEY = hashlib.sha256(b'segment-key:' + FERNET_KEY).digest()
+
+def stored_files(roots):
+    for root in roots:
+        for directory, _, filenames in os.walk(root):
+            for filename in filenames:
+                # In-progress writes and resumable uploads are left alone
+                if filename.startswith('.tmp-') or filename.endswith('.part'):
+                    continue
+                yield os.path.join(directory, filename)
+
+def replace_atomically(path, write):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def migrate_file(path, dry_run=False):
+    """Returns (path, action) with action one of converted, encrypted, current or skipped: <reason>"""
+    filename = os.path.basename(path)
+    if filename.startswith('liveness_') and filename.endswith('.mp4'):
+        # Stored unencrypted before; becomes liveness_<id>.mp4.enc
+        if not dry_run:
+            target = path + '.enc'
+            with open(path, 'rb') as src:
+                replace_atomically(target, lambda f: segment_crypto.encrypt_stream(src, f, STORAGE_KEY))
+            os.remove(path)
+        return path, 'encrypted'
+    with open(path, 'rb') as f:
+        data = f.read()
+    if segment_crypto.is_encrypted(data):
+        return path, 'current'
+    try:
+        plaintext = Fernet(FERNET_KEY).decrypt(data)
+    except InvalidToken:
+        return path, 'skipped: not a Fernet token'
+    if not dry_run:
+        replace_atomically(path, lambda f: f.write(segment_crypto.encrypt(plaintext, STORAGE_KEY)))
+    return path, 'converted'
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uploads', default=UPLOAD_FOLDER)
+    parser.add_argument('--blobs', default=os.environ.get('BLOB_STORE_PATH'),
+                        help='local blob store, if it is outside the uploads folder')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    if os.environ.get('BLOB_STORE', 'local') != 'local':
+        print("Note: only local files are migrated; objects in S3 stay readable as Fernet")
+
+    roots = [args.uploads] + ([args.blobs] if args.blobs else [])
+    counts = {}
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(migrate_file, path, args.dry_run) for path in stored_files(roots)]
+        for future in futures:
+            try:
+                path, action = future.result()
+            except Exception as e:
+                print(f"Error migrating file: {str(e)}")
+                failed += 1
+                continue
+            if action.startswith('skipped'):
+                print(f"{path}: {action}")
+            counts[action] = counts.get(action, 0) + 1
+    summary = ', '.join(f'{action} {count}' for action, count in sorted(counts.items()))
+    print(f"{'Would migrate' if args.dry_run else 'Migrated'}: {summary or 'nothing'}, failed {failed}")
+    return failed == 0
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -55,3 +55,48 @@ class ActivityLog(db.Model):
     status = db.Column(db.String(20), nullable=False)  # success, failure, pending
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user = db.relationship('User', backref=db.backref('activities', lazy=True))
+
+class FaceEmbedding(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), unique=True, nullable=False)
+    image = db.Column(db.String(256), nullable=False)  # reference_image the embedding was computed from
+    embedding = db.Column(db.LargeBinary, nullable=False)  # L2-normalized embedding, see routes/embedding_codec.py
+    box_x = db.Column(db.Integer, nullable=False)
+    box_y = db.Column(db.Integer, nullable=False)
+    box_w = db.Column(db.Integer, nullable=False)
+    box_h = db.Column(db.Integer, nullable=False)
+    model_version = db.Column(db.String(64), nullable=False)  # hash of the TFLite model file
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    user = db.relationship('User', backref=db.backref('face_embedding', uselist=False, lazy=True))
+
+class FaceArtifact(db.Model):
+    """Face preprocessing results for one image, so it never has to be decoded and detected again"""
+    id = db.Column(db.Integer, primary_key=True)
+    image_key = db.Column(db.String(64), unique=True, nullable=False, index=True)  # blob key of the image, see routes/face.py image_key()
+    box_x = db.Column(db.Integer, nullable=False)  # face detector box, original image coordinates
+    box_y = db.Column(db.Integer, nullable=False)
+    box_w = db.Column(db.Integer, nullable=False)
+    box_h = db.Column(db.Integer, nullable=False)
+    landmarks = db.Column(db.LargeBinary, nullable=False)  # 68 (x, y) points, int16, original image coordinates
+    landmarks_5 = db.Column(db.LargeBinary, nullable=False)  # eye centres, nose tip, mouth corners, int16
+    quality = db.Column(db.Float, nullable=False)  # sharpness x frontality of the face, higher is better
+    crop = db.Column(db.LargeBinary, nullable=False)  # encrypted PNG of the 112x112 model input
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class EnrollmentJob(db.Model):
+    """Background processing of an uploaded reference image, see routes/enrollment.py"""
+    id = db.Column(db.String(32), primary_key=True)  # random hex, returned by /upload
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    image = db.Column(db.String(256), nullable=False)  # blob key of the uploaded reference image
+    status = db.Column(db.String(16), nullable=False, default='queued', index=True)  # queued, running, done, failed, superseded
+    claimed_by = db.Column(db.String(32), nullable=True)  # worker that is processing the job
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    face_found = db.Column(db.Boolean, nullable=True)
+    quality = db.Column(db.Float, nullable=True)  # sharpness x frontality of the face
+    duplicates = db.Column(db.Text, nullable=True)  # JSON list of [user_id, similarity] of possible duplicates
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    user = db.relationship('User', backref=db.backref('enrollment_jobs', lazy=True))
@@ -3,6 +3,7 @@ from models import db, ManualReview, User, Notification, ActivityLog
 from sqlalchemy import func
 from datetime import datetime, timedelta
 from routes.auth import require_session
+from routes.face import load_gallery, record_duplicate_review, build_embedding_index, DUPLICATE_THRESHOLD
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -146,6 +147,54 @@ def get_all_activities():
     
     return jsonify({'activities': result}), 200
 
+@admin_bp.route('/admin/duplicates/sweep', methods=['POST'])
+@require_session
+@require_admin
+def sweep_duplicate_enrollments():
+    """All-pairs search for the same face enrolled under different accounts"""
+    data = request.get_json(silent=True) or {}
+    try:
+        threshold = float(data.get('threshold', DUPLICATE_THRESHOLD))
+        block_size = int(data.get('block_size', 1024))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'threshold and block_size must be numbers'}), 400
+    if block_size < 1:
+        return jsonify({'error': 'block_size must be at least 1'}), 400
+    gallery = load_gallery(force=True)
+    pairs = gallery.duplicate_pairs(threshold, block_size=block_size)
+    reviews_created = 0
+    for user_a, user_b, similarity in pairs:
+        # The later enrollment is the suspicious one
+        if record_duplicate_review(user_b, user_a, similarity):
+            reviews_created += 1
+    db.session.commit()
+    return jsonify({
+        'checked_users': len(gallery),
+        'threshold': threshold,
+        'pairs': [
+            {'user_id': user_b, 'matches_user_id': user_a, 'similarity': similarity}
+            for user_a, user_b, similarity in pairs
+        ],
+        'reviews_created': reviews_created
+    }), 200
+
+@admin_bp.route('/admin/embedding_index/build', methods=['POST'])
+@require_session
+@require_admin
+def rebuild_embedding_index():
+    """Train and persist the approximate 1:N index over all reference embeddings"""
+    data = request.get_json(silent=True) or {}
+    nlist = data.get('nlist')
+    pq_m = int(data.get('pq_m', 0))
+    index = build_embedding_index(nlist=int(nlist) if nlist else None, pq_m=pq_m)
+    if index is None:
+        return jsonify({'error': 'No reference embeddings to index'}), 400
+    return jsonify({
+        'indexed': len(index),
+        'nlist': index.nlist,
+        'pq_m': index.pq_m
+    }), 200
+
 def send_certificate_due_notifications():
     soon = datetime.utcnow() + timedelta(days=7)
     users = User.query.filter(
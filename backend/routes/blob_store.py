@@ -0,0 +1,122 @@
+"""
+Content-addressed storage for encrypted uploads.
+
+Blobs are immutable and named by a key derived from their content (see
+routes/face.py: an HMAC of the plaintext image), so identical uploads are stored
+once and nothing is ever overwritten. Keys are sharded two levels deep
+(ab/cd/abcd...) to keep directories and S3 prefixes small.
+
+    BLOB_STORE=local   files under BLOB_STORE_PATH (default uploads/blobs)
+    BLOB_STORE=s3      bucket BLOB_S3_BUCKET, optionally under BLOB_S3_PREFIX, at
+                       BLOB_S3_ENDPOINT (e.g. a MinIO server) with the usual AWS
+                       credential environment variables; needs boto3
+"""
+import os
+import re
+import tempfile
+
+KEY_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+def is_blob_key(name):
+    """Whether a stored image name is a blob key rather than a legacy uploads/ filename"""
+    return bool(name) and KEY_PATTERN.fullmatch(name) is not None
+
+def shard_path(key):
+    if not is_blob_key(key):
+        raise ValueError(f'Not a blob key: {key!r}')
+    return f'{key[:2]}/{key[2:4]}/{key}'
+
+class LocalBlobStore:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, *shard_path(key).split('/'))
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, key, data):
+        """Store data under key unless it is already there. Returns True if it was written"""
+        path = self.path(key)
+        if os.path.exists(path):
+            return False
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Readers never see a partial blob: write a temporary file next to it, then rename
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return True
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def delete(self, key):
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+class S3BlobStore:
+    def __init__(self, bucket, prefix='', endpoint_url=None, client=None):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise RuntimeError('BLOB_STORE=s3 needs the boto3 package')
+            client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+
+    def object_key(self, key):
+        return self.prefix + shard_path(key)
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def put(self, key, data):
+        """Store data under key unless it is already there. Returns True if it was written"""
+        if self.exists(key):
+            return False
+        # A single PUT is atomic: readers see the whole object or none of it
+        self.client.put_object(Bucket=self.bucket, Key=self.object_key(key), Body=data)
+        return True
+
+    def get(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))['Body'].read()
+        except self.client.exceptions.NoSuchKey:
+            raise KeyError(key)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+def from_env(upload_folder):
+    backend = os.environ.get('BLOB_STORE', 'local')
+    if backend == 'local':
+        return LocalBlobStore(os.environ.get('BLOB_STORE_PATH', os.path.join(upload_folder, 'blobs')))
+    if backend == 's3':
+        return S3BlobStore(os.environ['BLOB_S3_BUCKET'],
+                           prefix=os.environ.get('BLOB_S3_PREFIX', ''),
+                           endpoint_url=os.environ.get('BLOB_S3_ENDPOINT'))
+    raise ValueError(f'Unknown BLOB_STORE backend: {backend}')
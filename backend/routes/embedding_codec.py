@@ -0,0 +1,145 @@
+"""
+Versioned binary format for stored face embeddings.
+
+    offset  size  field
+    0       4     magic b'SPEM'
+    4       1     format version (1)
+    5       1     dtype code: 0 = float32, 1 = float16, 2 = int8
+    6       2     dimension (little-endian uint16)
+    8       4     int8 only: per-vector scale (float32)
+    ...           dim values of the given dtype
+
+int8 is symmetric: value = code * scale with scale = max(|x|) / 127.
+
+Blobs without the magic are treated as the raw float32 bytes written before this
+format existed.
+
+Cosine similarity between two unit embeddings stays within SIMILARITY_TOLERANCE of
+the float32 result for each storage dtype, so SIMILARITY_THRESHOLD decisions only
+differ for scores that close to the threshold.
+"""
+import struct
+import numpy as np
+
+MAGIC = b'SPEM'
+FORMAT_VERSION = 1
+DTYPE_CODES = {'float32': 0, 'float16': 1, 'int8': 2}
+DTYPE_NAMES = {code: name for name, code in DTYPE_CODES.items()}
+HEADER = struct.Struct('<4sBBH')
+SCALE = struct.Struct('<f')
+
+# Worst-case |cos_compact - cos_float32| for unit-length 128-d embeddings
+SIMILARITY_TOLERANCE = {'float32': 0.0, 'float16': 1e-3, 'int8': 1e-2}
+
+def quantize_int8(vectors):
+    """Symmetric per-vector int8 quantization. Returns (codes, scales)"""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+def encode(embedding, dtype='float16'):
+    embedding = np.asarray(embedding, dtype=np.float32).ravel()
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, DTYPE_CODES[dtype], embedding.shape[0])
+    if dtype == 'int8':
+        codes, scales = quantize_int8(embedding)
+        return header + SCALE.pack(float(scales[0])) + codes.tobytes()
+    return header + embedding.astype(dtype).tobytes()
+
+def decode(blob):
+    """Stored embedding bytes back to a float32 vector"""
+    if blob[:4] != MAGIC:
+        return np.frombuffer(blob, dtype=np.float32)
+    _, version, dtype_code, dim = HEADER.unpack_from(blob)
+    if version != FORMAT_VERSION:
+        raise ValueError(f'Unsupported embedding format version {version}')
+    dtype = DTYPE_NAMES[dtype_code]
+    if dtype == 'int8':
+        (scale,) = SCALE.unpack_from(blob, HEADER.size)
+        codes = np.frombuffer(blob, dtype=np.int8, count=dim, offset=HEADER.size + SCALE.size)
+        return codes.astype(np.float32) * scale
+    return np.frombuffer(blob, dtype=dtype, count=dim, offset=HEADER.size).astype(np.float32)
+
+def compact(vectors, dtype):
+    """Rows of vectors in compact form. Returns (codes, scales); scales is None except for int8"""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    if dtype == 'int8':
+        return quantize_int8(vectors)
+    return np.ascontiguousarray(vectors.astype(dtype)), None
+
+class CompactMatrix:
+    """
+    Many embeddings in compact form (float32, float16, or int8 codes plus per-row
+    scales), scored against float32 queries without materialising a float32 copy of
+    the whole matrix: rows are widened one cache-sized chunk at a time.
+    """
+
+    def __init__(self, vectors, dtype='float16'):
+        self.dtype = dtype
+        self.codes, self.scales = compact(vectors, dtype)
+
+    @classmethod
+    def from_codes(cls, codes, scales=None):
+        """Wrap existing (possibly memory-mapped) codes without copying them"""
+        matrix = cls.__new__(cls)
+        matrix.dtype = np.dtype(codes.dtype).name
+        matrix.codes = codes
+        matrix.scales = scales
+        return matrix
+
+    @classmethod
+    def zeros(cls, rows, dim, dtype):
+        return cls.from_codes(np.zeros((rows, dim), dtype=dtype),
+                              np.ones(rows, dtype=np.float32) if dtype == 'int8' else None)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, rows):
+        """Rows selected by a slice or index array, as another CompactMatrix"""
+        return CompactMatrix.from_codes(self.codes[rows], self.scales[rows] if self.scales is not None else None)
+
+    def __setitem__(self, rows, vectors):
+        """Encode float32 vectors into the given rows"""
+        codes, scales = compact(vectors, self.dtype)
+        self.codes[rows] = codes.reshape(self.codes[rows].shape)
+        if self.scales is not None:
+            self.scales[rows] = scales.reshape(self.scales[rows].shape)
+
+    def copy_row(self, dst, src):
+        self.codes[dst] = self.codes[src]
+        if self.scales is not None:
+            self.scales[dst] = self.scales[src]
+
+    def resized(self, rows):
+        """A copy with `rows` rows, truncated or padded with zero rows"""
+        resized = CompactMatrix.zeros(rows, self.codes.shape[1], self.dtype)
+        keep = min(rows, len(self))
+        resized.codes[:keep] = self.codes[:keep]
+        if self.scales is not None:
+            resized.scales[:keep] = self.scales[:keep]
+        return resized
+
+    def to_float32(self):
+        vectors = self.codes.astype(np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[:, None]
+        return vectors
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def dot(self, queries, chunk=4096):
+        """(rows, queries) inner products for a (dim,) or (n, dim) float32 query array"""
+        queries = np.asarray(queries, dtype=np.float32)
+        single = queries.ndim == 1
+        queries = np.atleast_2d(queries).T
+        out = np.empty((len(self.codes), queries.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.codes), chunk):
+            block = self.codes[start:start + chunk].astype(np.float32, copy=False)
+            out[start:start + chunk] = block @ queries
+        if self.scales is not None:
+            out *= self.scales[:, None]
+        return out[:, 0] if single else out
@@ -0,0 +1,380 @@
+import os
+import json
+import shutil
+import threading
+import uuid
+import numpy as np
+from routes.embedding_codec import CompactMatrix, compact
+
+INDEX_FORMAT_VERSION = 1
+
+def assign_nearest(data, centroids, chunk=65536):
+    """Index of the nearest centroid (squared L2) for every row, computed in chunks"""
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assignments = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), chunk):
+        block = data[start:start + chunk]
+        distances = centroid_norms[None, :] - 2.0 * (block @ centroids.T)
+        assignments[start:start + chunk] = np.argmin(distances, axis=1)
+    return assignments
+
+def kmeans(data, k, iterations=20, seed=0):
+    """Plain Lloyd's k-means; empty clusters are re-seeded from random points"""
+    data = np.asarray(data, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    k = min(k, len(data))
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign_nearest(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, data)
+        counts = np.bincount(assignments, minlength=k)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        if not filled.all():
+            centroids[~filled] = data[rng.choice(len(data), int((~filled).sum()))]
+    return centroids
+
+class StaleIndexError(Exception):
+    """The saved index was retrained since this copy was loaded, so its lists no longer match"""
+
+def _normalize_rows(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+class IVFIndex:
+    """
+    Inverted-file index over L2-normalized embeddings, scored by inner product.
+
+    Vectors are assigned to the nearest of `nlist` coarse centroids and a query only
+    scans the `nprobe` closest lists. With pq_m > 0 each vector's residual is product
+    quantized into pq_m one-byte codes (16 bytes instead of 512 for 128-d at pq_m=16);
+    otherwise vectors are stored as `dtype` (float32, float16 or int8 with per-vector
+    scales, see routes/embedding_codec.py) and scored on the compact form.
+
+    Saved indexes are a directory of .npy files loaded with mmap_mode='r', so worker
+    processes start without reading the whole index and share its pages. Vectors added
+    after loading live in an in-memory delta. flush() appends the entries changed since
+    the last flush to the directory's delta.log, which load() replays; save() merges
+    the delta into a new base segment and starts an empty log.
+    """
+
+    def __init__(self, dim, nlist=256, pq_m=0, dtype='float32'):
+        if pq_m and dim % pq_m:
+            raise ValueError(f'dim {dim} is not divisible by pq_m {pq_m}')
+        self.dim = dim
+        self.nlist = nlist
+        self.pq_m = pq_m
+        self.dtype = 'uint8' if pq_m else dtype
+        self.pq_ksub = 256
+        self.meta = {}
+        # Identifies the trained centroids (and codebooks); kept by save() and flush()
+        self.build = None
+        self.centroids = None
+        self.codebooks = None
+        # Base segment, grouped by list, possibly memory-mapped
+        self.list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.data = np.zeros((0, self.code_width), dtype=self.dtype)
+        self.scales = np.zeros(0, dtype=np.float32) if self.has_scales else None
+        # Delta segment: list number -> (ids, rows, scales) added since the last save
+        self._delta = {}
+        self._delta_location = {}
+        self._superseded = set()
+        # Ids added or removed since the last flush() or save()
+        self._unflushed = set()
+        self._lock = threading.RLock()
+
+    @property
+    def code_width(self):
+        return self.pq_m if self.pq_m else self.dim
+
+    @property
+    def has_scales(self):
+        return self.dtype == 'int8'
+
+    @property
+    def log_dtype(self):
+        """One delta.log record: an add, or a removal when list is -1"""
+        return np.dtype([('id', '<i8'), ('list', '<i4'), ('scale', '<f4'), ('code', self.dtype, (self.code_width,))])
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def __len__(self):
+        base = len(self.ids) - self._superseded_in_base()
+        return base + len(self._delta_location)
+
+    def _superseded_in_base(self):
+        if not self._superseded:
+            return 0
+        return int(np.isin(self.ids, np.fromiter(self._superseded, dtype=np.int64)).sum())
+
+    def train(self, vectors, iterations=20, max_train=100000, seed=0):
+        vectors = _normalize_rows(vectors)
+        if len(vectors) > max_train:
+            vectors = vectors[np.random.default_rng(seed).choice(len(vectors), max_train, replace=False)]
+        self.centroids = kmeans(vectors, self.nlist, iterations, seed)
+        self.build = uuid.uuid4().hex
+        self.nlist = len(self.centroids)
+        self.list_offsets = np.zeros(self.nlist + 1, dtype=np.int64)
+        if self.pq_m:
+            residuals = vectors - self.centroids[assign_nearest(vectors, self.centroids)]
+            dsub = self.dim // self.pq_m
+            self.codebooks = np.stack([
+                kmeans(residuals[:, m * dsub:(m + 1) * dsub], self.pq_ksub, iterations, seed + m)
+                for m in range(self.pq_m)
+            ])
+
+    def _encode(self, vectors, lists):
+        """(codes, scales) rows for vectors assigned to lists; scales is None unless int8"""
+        if not self.pq_m:
+            return compact(vectors, self.dtype)
+        residuals = vectors - self.centroids[lists]
+        dsub = self.dim // self.pq_m
+        codes = np.empty((len(vectors), self.pq_m), dtype=np.uint8)
+        for m in range(self.pq_m):
+            codes[:, m] = assign_nearest(residuals[:, m * dsub:(m + 1) * dsub], self.codebooks[m])
+        return codes, None
+
+    def add(self, ids, vectors):
+        """Add or replace vectors by id"""
+        if not self.is_trained:
+            raise RuntimeError('Index must be trained before adding vectors')
+        vectors = _normalize_rows(vectors)
+        ids = np.asarray(ids, dtype=np.int64)
+        lists = assign_nearest(vectors, self.centroids)
+        codes, scales = self._encode(vectors, lists)
+        if scales is None:
+            scales = np.ones(len(ids), dtype=np.float32)
+        with self._lock:
+            for vector_id, list_no, code, scale in zip(ids, lists, codes, scales):
+                self._put_locked(int(vector_id), int(list_no), code, scale)
+                self._unflushed.add(int(vector_id))
+
+    def remove(self, vector_id):
+        with self._lock:
+            self._remove_locked(int(vector_id))
+            self._unflushed.add(int(vector_id))
+
+    def _put_locked(self, vector_id, list_no, code, scale):
+        self._remove_locked(vector_id)
+        delta_ids, delta_rows, delta_scales = self._delta.setdefault(list_no, ([], [], []))
+        self._delta_location[vector_id] = list_no
+        delta_ids.append(vector_id)
+        delta_rows.append(code)
+        delta_scales.append(scale)
+
+    def _remove_locked(self, vector_id):
+        list_no = self._delta_location.pop(vector_id, None)
+        if list_no is not None:
+            delta_ids, delta_rows, delta_scales = self._delta[list_no]
+            position = delta_ids.index(vector_id)
+            del delta_ids[position]
+            del delta_rows[position]
+            del delta_scales[position]
+        # Base entries are immutable (and possibly read-only mmaps), so mask them instead
+        self._superseded.add(vector_id)
+
+    def _segments(self, list_no):
+        """(ids, codes, scales, is_base) of the base and delta entries of a list"""
+        start, end = self.list_offsets[list_no], self.list_offsets[list_no + 1]
+        if end > start:
+            yield (self.ids[start:end], self.data[start:end],
+                   self.scales[start:end] if self.has_scales else None, True)
+        delta = self._delta.get(list_no)
+        if delta and delta[0]:
+            yield (np.array(delta[0], dtype=np.int64), np.stack(delta[1]),
+                   np.array(delta[2], dtype=np.float32) if self.has_scales else None, False)
+
+    def search(self, query, k=10, nprobe=8):
+        """Approximate top-k (id, inner product) pairs, best first"""
+        query = _normalize_rows(query)[0]
+        coarse = self.centroids @ query
+        nprobe = min(nprobe, self.nlist)
+        probes = np.argpartition(-coarse, nprobe - 1)[:nprobe]
+        if self.pq_m:
+            # Lookup table of query-subvector x codeword inner products (ADC)
+            table = np.einsum('mkd,md->mk', self.codebooks, query.reshape(self.pq_m, -1))
+            columns = np.arange(self.pq_m)
+        candidate_ids, candidate_scores = [], []
+        with self._lock:
+            superseded = np.fromiter(self._superseded, dtype=np.int64) if self._superseded else None
+            for list_no in probes:
+                for segment_ids, segment_data, segment_scales, is_base in self._segments(list_no):
+                    if self.pq_m:
+                        scores = coarse[list_no] + table[columns, segment_data].sum(axis=1)
+                    else:
+                        scores = CompactMatrix.from_codes(segment_data, segment_scales).dot(query)
+                    if is_base and superseded is not None:
+                        live = ~np.isin(segment_ids, superseded)
+                        segment_ids, scores = segment_ids[live], scores[live]
+                    candidate_ids.append(segment_ids)
+                    candidate_scores.append(scores)
+        if not candidate_ids:
+            return []
+        ids = np.concatenate(candidate_ids)
+        scores = np.concatenate(candidate_scores)
+        if len(ids) == 0:
+            return []
+        k = min(k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top]
+
+    @staticmethod
+    def _read_meta(path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f)
+
+    def _write_meta(self, path, meta=None):
+        """Replace meta.json atomically, with this index's structure unless `meta` is given"""
+        if meta is None:
+            meta = dict(self.meta, format_version=INDEX_FORMAT_VERSION, dim=self.dim,
+                        nlist=self.nlist, pq_m=self.pq_m, dtype=self.dtype, build=self.build)
+        tmp_path = os.path.join(path, f'meta.json.tmp-{os.getpid()}-{threading.get_ident()}')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(path, 'meta.json'))
+
+    def flush(self, path, **meta):
+        """
+        Append the entries added or removed since the last flush to delta.log of a saved
+        index directory and set the given fields of its meta.json. Writes O(changes),
+        not O(index). Raises StaleIndexError, writing nothing, if the directory holds
+        another build than this index (retrained by another process).
+        """
+        with self._lock:
+            saved = self._read_meta(path)
+            if saved.get('build') != self.build:
+                raise StaleIndexError(f'{path} was rebuilt since this index was loaded')
+            records = np.zeros(len(self._unflushed), dtype=self.log_dtype)
+            for record, vector_id in zip(records, sorted(self._unflushed)):
+                record['id'] = vector_id
+                list_no = self._delta_location.get(vector_id)
+                if list_no is None:
+                    record['list'] = -1
+                    continue
+                delta_ids, delta_rows, delta_scales = self._delta[list_no]
+                position = delta_ids.index(vector_id)
+                record['list'] = list_no
+                record['code'] = delta_rows[position]
+                record['scale'] = delta_scales[position]
+            if len(records):
+                # One append per flush, so concurrent flushes from other processes don't interleave
+                with open(os.path.join(path, 'delta.log'), 'ab') as f:
+                    f.write(records.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+            self._unflushed = set()
+            self.meta.update(meta)
+            # Only the given fields: the structure on disk is the one just checked
+            self._write_meta(path, dict(saved, **meta))
+
+    def _replay(self, path):
+        log_path = os.path.join(path, 'delta.log')
+        if not os.path.exists(log_path):
+            return
+        with open(log_path, 'rb') as f:
+            data = f.read()
+        # A record cut short by a crash mid-append is ignored
+        records = np.frombuffer(data, dtype=self.log_dtype, count=len(data) // self.log_dtype.itemsize)
+        with self._lock:
+            for record in records:
+                vector_id = int(record['id'])
+                if record['list'] < 0:
+                    self._remove_locked(vector_id)
+                else:
+                    self._put_locked(vector_id, int(record['list']), record['code'].copy(), record['scale'])
+
+    def save(self, path, **meta):
+        """Merge the delta into the base segment and write the index directory atomically"""
+        with self._lock:
+            ids_parts, data_parts, scales_parts = [], [], []
+            counts = np.zeros(self.nlist, dtype=np.int64)
+            superseded = np.fromiter(self._superseded, dtype=np.int64) if self._superseded else None
+            for list_no in range(self.nlist):
+                for segment_ids, segment_data, segment_scales, is_base in self._segments(list_no):
+                    if is_base and superseded is not None:
+                        live = ~np.isin(segment_ids, superseded)
+                        segment_ids, segment_data = segment_ids[live], segment_data[live]
+                        if segment_scales is not None:
+                            segment_scales = segment_scales[live]
+                    ids_parts.append(np.asarray(segment_ids, dtype=np.int64))
+                    data_parts.append(np.asarray(segment_data, dtype=self.dtype))
+                    if segment_scales is not None:
+                        scales_parts.append(np.asarray(segment_scales, dtype=np.float32))
+                    counts[list_no] += len(segment_ids)
+            list_offsets = np.zeros(self.nlist + 1, dtype=np.int64)
+            list_offsets[1:] = np.cumsum(counts)
+            ids = np.concatenate(ids_parts) if ids_parts else np.zeros(0, dtype=np.int64)
+            data = (np.concatenate(data_parts) if data_parts
+                    else np.zeros((0, self.code_width), dtype=self.dtype))
+            scales = np.concatenate(scales_parts) if scales_parts else np.zeros(0, dtype=np.float32)
+
+            self.meta.update(meta)
+            tmp_path = f'{path}.tmp-{os.getpid()}'
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            os.makedirs(tmp_path)
+            np.save(os.path.join(tmp_path, 'centroids.npy'), self.centroids)
+            if self.pq_m:
+                np.save(os.path.join(tmp_path, 'codebooks.npy'), self.codebooks)
+            np.save(os.path.join(tmp_path, 'list_offsets.npy'), list_offsets)
+            np.save(os.path.join(tmp_path, 'ids.npy'), ids)
+            np.save(os.path.join(tmp_path, 'data.npy'), data)
+            if self.has_scales:
+                np.save(os.path.join(tmp_path, 'scales.npy'), scales)
+            self._write_meta(tmp_path)
+            old_path = f'{path}.old-{os.getpid()}'
+            if os.path.exists(path):
+                os.rename(path, old_path)
+            os.rename(tmp_path, path)
+            shutil.rmtree(old_path, ignore_errors=True)
+
+            self.list_offsets = list_offsets
+            self.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode='r')
+            self.data = np.load(os.path.join(path, 'data.npy'), mmap_mode='r')
+            if self.has_scales:
+                self.scales = np.load(os.path.join(path, 'scales.npy'), mmap_mode='r')
+            self._delta = {}
+            self._delta_location = {}
+            self._superseded = set()
+            self._unflushed = set()
+
+    @property
+    def delta_size(self):
+        """Entries held in memory on top of the base segment"""
+        return len(self._delta_location)
+
+    @property
+    def unflushed(self):
+        """Entries changed since the last flush() or save()"""
+        return len(self._unflushed)
+
+    def unflushed_removals(self):
+        """Ids removed since the last flush() or save()"""
+        with self._lock:
+            return sorted(vector_id for vector_id in self._unflushed if vector_id not in self._delta_location)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        meta = cls._read_meta(path)
+        if meta.get('format_version') != INDEX_FORMAT_VERSION:
+            raise ValueError(f"Unsupported embedding index format {meta.get('format_version')}")
+        # Indexes saved before compact storage hold float32 vectors
+        index = cls(meta['dim'], nlist=meta['nlist'], pq_m=meta['pq_m'], dtype=meta.get('dtype', 'float32'))
+        index.build = meta.get('build')
+        index.meta = {key: value for key, value in meta.items()
+                      if key not in ('format_version', 'dim', 'nlist', 'pq_m', 'dtype', 'build')}
+        mmap_mode = 'r' if mmap else None
+        index.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        if index.pq_m:
+            index.codebooks = np.load(os.path.join(path, 'codebooks.npy'))
+        index.list_offsets = np.load(os.path.join(path, 'list_offsets.npy'))
+        index.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode=mmap_mode)
+        index.data = np.load(os.path.join(path, 'data.npy'), mmap_mode=mmap_mode)
+        if index.has_scales:
+            index.scales = np.load(os.path.join(path, 'scales.npy'), mmap_mode=mmap_mode)
+        index._replay(path)
+        return index
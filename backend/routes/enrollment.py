@@ -0,0 +1,160 @@
+"""
+Background enrollment of uploaded reference images.
+
+    GET /upload/status/<job_id>   -> {'job_id', 'status', 'face_found', 'quality', ...}
+
+/upload stores the image and queues an EnrollmentJob (routes/enrollment_queue.py),
+then answers 202 with the job id. A worker thread started with the app claims up
+to ENROLLMENT_BATCH_SIZE queued jobs at a time, detects and scores the face in each
+image and embeds all of them in one batch, then stores the reference embeddings
+and runs the duplicate-enrollment check.
+
+A job ends up done (face_found tells whether the photo is usable, quality_ok
+whether it is sharp and frontal enough), failed (the image could not be read or
+decoded) or superseded (another reference was uploaded before it ran).
+"""
+from flask import Blueprint, jsonify
+import json
+import os
+import threading
+import time
+import uuid
+from models import db, User, EnrollmentJob
+from routes import enrollment_queue, embedding_codec, metrics
+from routes.face import load_image, extract_face_embeddings, store_reference_embedding, check_duplicate_enrollment
+
+enrollment_bp = Blueprint('enrollment', __name__)
+
+# Set to 0 in processes that should not run a worker
+ENROLLMENT_WORKER = os.environ.get('ENROLLMENT_WORKER', '1') == '1'
+ENROLLMENT_BATCH_SIZE = int(os.environ.get('ENROLLMENT_BATCH_SIZE', '8'))
+# After an upload wakes the worker, wait this long for more uploads to batch with it
+ENROLLMENT_BATCH_WINDOW_MS = float(os.environ.get('ENROLLMENT_BATCH_WINDOW_MS', '50'))
+# Jobs queued by other processes or put back for a retry are picked up this often
+ENROLLMENT_POLL_SECONDS = float(os.environ.get('ENROLLMENT_POLL_SECONDS', '2'))
+# Faces scoring below this (Laplacian variance x frontality) are enrolled but flagged for a retake
+ENROLLMENT_MIN_QUALITY = float(os.environ.get('ENROLLMENT_MIN_QUALITY', '60'))
+
+JOB_BUCKETS_MS = (100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+batch_sizes = metrics.histogram('enrollment_batch_size', (1, 2, 4, 8, 16, 32))
+queued_to_done_ms = metrics.histogram('enrollment_queued_to_done_ms', JOB_BUCKETS_MS)
+failed_jobs = metrics.counter('enrollment_jobs_failed')
+
+def _observe(job):
+    if job.status == 'failed':
+        failed_jobs.inc()
+    queued_to_done_ms.observe((job.finished_at - job.created_at).total_seconds() * 1000.0)
+
+def _finish(job, status, **outcome):
+    enrollment_queue.finish(job, status, **outcome)
+    _observe(job)
+
+def _retry_or_fail(job, error):
+    enrollment_queue.retry_or_fail(job, error)
+    if job.status == 'failed':
+        _observe(job)
+
+def process_jobs(jobs):
+    """Run a batch of claimed jobs (needs an app context)"""
+    live, images = [], []
+    for job in jobs:
+        user = User.query.get(job.user_id)
+        if user is None or user.reference_image != job.image:
+            _finish(job, 'superseded')
+            continue
+        try:
+            images.append(load_image(job.image))
+            live.append((job, user))
+        except Exception as e:
+            _finish(job, 'failed', error=f'Could not read the image: {str(e)}')
+    db.session.commit()
+    if not live:
+        return
+
+    try:
+        results = extract_face_embeddings(images, [job.image for job, _ in live])
+    except Exception as e:
+        # Includes timeouts waiting for a vision worker
+        print(f"Error processing enrollment batch: {str(e)}")
+        db.session.rollback()
+        for job, _ in live:
+            _retry_or_fail(job, str(e))
+        db.session.commit()
+        return
+    batch_sizes.observe(len(live))
+
+    for (job, user), image_bytes, result in zip(live, images, results):
+        try:
+            record = store_reference_embedding(user, image_bytes, result)
+            if not result['decoded']:
+                _finish(job, 'failed', face_found=False, error='Image could not be decoded')
+            elif record is None:
+                _finish(job, 'done', face_found=False)
+            else:
+                matches = check_duplicate_enrollment(user, embedding_codec.decode(record.embedding))
+                if matches:
+                    print(f"Warning: Possible duplicate enrollment of user {user.id}: {matches}")
+                _finish(job, 'done', face_found=True, quality=result.get('quality'),
+                        duplicates=[[other_user_id, float(sim)] for other_user_id, sim in matches])
+        except Exception as e:
+            print(f"Error enrolling user {user.id}: {str(e)}")
+            db.session.rollback()
+            _retry_or_fail(job, str(e))
+        db.session.commit()
+
+class EnrollmentWorker(threading.Thread):
+    def __init__(self, app):
+        super().__init__(name='enrollment-worker', daemon=True)
+        self.app = app
+        self.worker_id = uuid.uuid4().hex
+
+    def run(self):
+        while True:
+            with self.app.app_context():
+                try:
+                    enrollment_queue.requeue_stale()
+                    while True:
+                        jobs = enrollment_queue.claim(self.worker_id, ENROLLMENT_BATCH_SIZE)
+                        if not jobs:
+                            break
+                        process_jobs(jobs)
+                except Exception as e:
+                    print(f"Error in enrollment worker: {str(e)}")
+                    db.session.rollback()
+            if enrollment_queue.wait(ENROLLMENT_POLL_SECONDS):
+                time.sleep(ENROLLMENT_BATCH_WINDOW_MS / 1000.0)
+
+_worker = None
+
+def start_worker(app):
+    """Start this process's enrollment worker thread (once)"""
+    global _worker
+    if ENROLLMENT_WORKER and _worker is None:
+        _worker = EnrollmentWorker(app)
+        _worker.start()
+    return _worker
+
+@enrollment_bp.route('/upload/status/<job_id>', methods=['GET'])
+def upload_status(job_id):
+    job = EnrollmentJob.query.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    response = {
+        'job_id': job.id,
+        'status': job.status,
+        'face_found': job.face_found,
+        'quality': job.quality,
+        'error': job.error,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    }
+    if job.status == 'done':
+        if not job.face_found:
+            response['reason'] = 'No face detected, please upload another photo'
+        else:
+            response['quality_ok'] = job.quality is not None and job.quality >= ENROLLMENT_MIN_QUALITY
+            if not response['quality_ok']:
+                response['reason'] = 'Photo is blurry or not facing the camera, a retake is recommended'
+            response['possible_duplicate'] = bool(json.loads(job.duplicates or '[]'))
+    return jsonify(response), 200
@@ -0,0 +1,85 @@
+"""
+Queue of EnrollmentJob rows in the application database, so background enrollment
+needs no external services and survives restarts.
+
+Workers claim a batch of queued jobs with a single conditional UPDATE, which SQLite
+serializes, so any number of worker threads or processes can share the queue
+without processing a job twice. Jobs whose worker died are queued again after
+ENROLLMENT_JOB_TIMEOUT, up to ENROLLMENT_MAX_ATTEMPTS times.
+"""
+import json
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+from models import db, EnrollmentJob
+
+ENROLLMENT_JOB_TIMEOUT = float(os.environ.get('ENROLLMENT_JOB_TIMEOUT', '300'))
+ENROLLMENT_MAX_ATTEMPTS = int(os.environ.get('ENROLLMENT_MAX_ATTEMPTS', '3'))
+
+# Set when a job is queued by this process, so its worker picks it up without polling
+_wakeup = threading.Event()
+
+def enqueue(user_id, image):
+    """Add a job to the session; it is queued when the caller commits (then call notify())"""
+    job = EnrollmentJob(id=uuid.uuid4().hex, user_id=user_id, image=image, status='queued')
+    db.session.add(job)
+    return job
+
+def notify():
+    _wakeup.set()
+
+def wait(timeout):
+    """Block until a job is queued in this process or timeout passes"""
+    woken = _wakeup.wait(timeout)
+    _wakeup.clear()
+    return woken
+
+def claim(worker_id, limit):
+    """Mark up to `limit` of the oldest queued jobs as running for this worker and return them"""
+    ids = [job_id for (job_id,) in db.session.query(EnrollmentJob.id)
+           .filter(EnrollmentJob.status == 'queued')
+           .order_by(EnrollmentJob.created_at)
+           .limit(limit)]
+    if not ids:
+        return []
+    # Jobs another worker claimed in the meantime are no longer 'queued' and stay theirs
+    EnrollmentJob.query.filter(EnrollmentJob.id.in_(ids), EnrollmentJob.status == 'queued').update({
+        'status': 'running',
+        'claimed_by': worker_id,
+        'started_at': datetime.utcnow(),
+        'attempts': EnrollmentJob.attempts + 1
+    }, synchronize_session=False)
+    db.session.commit()
+    return (EnrollmentJob.query
+            .filter(EnrollmentJob.id.in_(ids), EnrollmentJob.status == 'running', EnrollmentJob.claimed_by == worker_id)
+            .order_by(EnrollmentJob.created_at)
+            .all())
+
+def finish(job, status, face_found=None, quality=None, duplicates=None, error=None):
+    """Record the outcome of a claimed job. Caller commits."""
+    job.status = status
+    job.face_found = face_found
+    job.quality = quality
+    job.duplicates = json.dumps(duplicates) if duplicates is not None else None
+    job.error = error
+    job.finished_at = datetime.utcnow()
+
+def retry_or_fail(job, error):
+    """Put a job whose processing failed back in the queue, or fail it after ENROLLMENT_MAX_ATTEMPTS. Caller commits."""
+    if job.attempts < ENROLLMENT_MAX_ATTEMPTS:
+        job.status = 'queued'
+        job.claimed_by = None
+        job.error = error
+    else:
+        finish(job, 'failed', error=error)
+
+def requeue_stale():
+    """Retry jobs left running by a worker that crashed or hung. Returns how many were found"""
+    cutoff = datetime.utcnow() - timedelta(seconds=ENROLLMENT_JOB_TIMEOUT)
+    stale = EnrollmentJob.query.filter(EnrollmentJob.status == 'running', EnrollmentJob.started_at < cutoff).all()
+    for job in stale:
+        retry_or_fail(job, 'Worker did not finish the job in time')
+    if stale:
+        db.session.commit()
+    return len(stale)
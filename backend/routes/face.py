@@ -1,102 +1,520 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
 import os
+import tempfile
+from contextlib import contextmanager
 import cv2
 import numpy as np
-from models import db, User, ManualReview, ActivityLog
-import tensorflow as tf
-from PIL import Image
-import dlib
+from models import db, User, ManualReview, ActivityLog, FaceEmbedding, FaceArtifact
+from sqlalchemy.exc import IntegrityError
 from cryptography.fernet import Fernet
-import base64, hashlib
+import base64, hashlib, hmac
+from routes.face_engine import get_model_version
+from routes import vision_workers, liveness, embedding_codec, segment_crypto, enrollment_queue, blob_store as blob_stores
+from routes.face_gallery import ReferenceGallery
+from routes.face_cache import FaceCache
+from routes.verification_cache import VerificationCache, IdempotencyConflict
+from routes.embedding_index import IVFIndex, StaleIndexError
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as VisionTimeoutError
 
 # Initialize Fernet for encryption
 fernet_key = Fernet.generate_key()
 fernet = Fernet(fernet_key)
 
-tflite = tf.lite
-
 UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # Use relative path to the model file in the same directory
 TFLITE_MODEL_PATH = os.path.join(os.path.dirname(__file__), 'output_model.tflite')
-IMG_SIZE = (112, 112)
 SIMILARITY_THRESHOLD = 0.8
 
-interpreter = tflite.Interpreter(model_path=TFLITE_MODEL_PATH)
-interpreter.allocate_tensors()
-input_details = interpreter.get_input_details()
-output_details = interpreter.get_output_details()
+# Micro-batching of embedding inference across concurrent requests (window of 0 disables it)
+EMBED_BATCH_WINDOW_MS = float(os.environ.get('EMBED_BATCH_WINDOW_MS', '3'))
+EMBED_MAX_BATCH = int(os.environ.get('EMBED_MAX_BATCH', '8'))
+
+# Pool of TFLite interpreters so request threads can run inference in parallel
+CPU_COUNT = os.cpu_count() or 1
+INTERPRETER_POOL_SIZE = int(os.environ.get('INTERPRETER_POOL_SIZE', str(min(4, CPU_COUNT))))
+INTERPRETER_NUM_THREADS = int(os.environ.get('INTERPRETER_NUM_THREADS', str(max(1, CPU_COUNT // INTERPRETER_POOL_SIZE))))
+INTERPRETER_CHECKOUT_TIMEOUT = float(os.environ.get('INTERPRETER_CHECKOUT_TIMEOUT', '5'))
 
 # Path to the shape predictor file in the BlinkDetection directory (in the project root)
 project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 PREDICTOR_PATH = os.path.join(project_root, 'BlinkDetection', 'shape_predictor_68_face_landmarks.dat')
-detector = dlib.get_frontal_face_detector()
-predictor = dlib.shape_predictor(PREDICTOR_PATH)
-EAR_THRESHOLD = 0.21
-CONSEC_FRAMES = 2
+
+# All models are loaded and warmed up once at startup (vision_workers.start() in
+# main.py), either in the server process or in the VISION_WORKERS worker processes,
+# and shared by every request
+vision_workers.configure({
+    'model_path': TFLITE_MODEL_PATH,
+    'predictor_path': PREDICTOR_PATH,
+    'pool_size': INTERPRETER_POOL_SIZE,
+    'num_threads': INTERPRETER_NUM_THREADS,
+    'checkout_timeout': INTERPRETER_CHECKOUT_TIMEOUT,
+    'batch_window_ms': EMBED_BATCH_WINDOW_MS,
+    'max_batch': EMBED_MAX_BATCH
+})
+MODEL_VERSION = get_model_version(TFLITE_MODEL_PATH)
+
+EAR_THRESHOLD = liveness.EAR_THRESHOLD
+CONSEC_FRAMES = liveness.CONSEC_FRAMES
 
 FERNET_KEY = base64.urlsafe_b64encode(hashlib.sha256(b'super_secret_image_key').digest())
 fernet = Fernet(FERNET_KEY)
 
-def preprocess_face(img):
-    img = cv2.resize(img, IMG_SIZE)
-    img = img.astype(np.float32)
-    img = img - 128
-    img = img * 0.0078125
-    img = np.expand_dims(img, axis=0)
-    return img
-
-def get_embedding(face_img):
-    preprocessed = preprocess_face(face_img)
-    interpreter.set_tensor(input_details[0]['index'], preprocessed)
-    interpreter.invoke()
-    embedding = interpreter.get_tensor(output_details[0]['index'])
-    embedding = embedding[0]
-    embedding = embedding / np.linalg.norm(embedding)
-    return embedding
+# Uploaded images are stored encrypted in a content-addressed blob store (routes/blob_store.py).
+# Keys are an HMAC of the plaintext, so identical uploads dedupe without the key
+# revealing a plain hash of the image.
+BLOB_KEY_SECRET = hashlib.sha256(b'blob-key:' + FERNET_KEY).digest()
+blob_store = blob_stores.from_env(UPLOAD_FOLDER)
+
+# Images, face crops and liveness videos are encrypted a segment at a time with AES-GCM
+# (routes/segment_crypto.py); Fernet is only used to read files stored before that
+STORAGE_KEY = hashlib.sha256(b'segment-key:' + FERNET_KEY).digest()
+# Liveness videos are decrypted here for the video decoder, which needs a file
+DECRYPTED_VIDEO_DIR = os.environ.get('DECRYPTED_VIDEO_DIR', '/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+# Face crops and embeddings of stored images, so retries of a verification skip the
+# decrypt, decode and inference; bounded by FACE_CACHE_MAX_BYTES per web worker process
+FACE_CACHE_MAX_BYTES = int(os.environ.get('FACE_CACHE_MAX_BYTES', str(64 * 2**20)))
+face_cache = FaceCache(FACE_CACHE_MAX_BYTES)
+
+# /verify responses replayed to retries of the same verification (routes/verification_cache.py)
+VERIFY_CACHE_TTL = float(os.environ.get('VERIFY_CACHE_TTL', '300'))
+IDEMPOTENCY_KEY_TTL = float(os.environ.get('IDEMPOTENCY_KEY_TTL', '86400'))
+verification_cache = VerificationCache(VERIFY_CACHE_TTL, IDEMPOTENCY_KEY_TTL)
+
+# Storage format of FaceEmbedding.embedding, the in-memory gallery and flat embedding index
+# lists: float32, float16 or int8 (see routes/embedding_codec.py)
+EMBEDDING_STORAGE_DTYPE = os.environ.get('EMBEDDING_STORAGE_DTYPE', 'float16')
+
+# 1:N duplicate-enrollment search over all reference embeddings of the current model
+DUPLICATE_THRESHOLD = float(os.environ.get('DUPLICATE_THRESHOLD', '0.9'))
+DUPLICATE_TOP_K = 5
+reference_gallery = ReferenceGallery(dtype=EMBEDDING_STORAGE_DTYPE)
+gallery_loaded = False
+
+# Approximate nearest-neighbour index used for 1:N search once it has been built
+# (POST /admin/embedding_index/build); until then the exact in-memory gallery is used
+EMBEDDING_INDEX_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'embedding_index')
+EMBEDDING_INDEX_NPROBE = int(os.environ.get('EMBEDDING_INDEX_NPROBE', '16'))
+# Changes are appended to the index's delta log every EMBEDDING_INDEX_FLUSH_EVERY adds or
+# removals; the index is only rewritten once EMBEDDING_INDEX_COMPACT_AT of them are in memory
+EMBEDDING_INDEX_FLUSH_EVERY = int(os.environ.get('EMBEDDING_INDEX_FLUSH_EVERY', '500'))
+EMBEDDING_INDEX_COMPACT_AT = int(os.environ.get('EMBEDDING_INDEX_COMPACT_AT', '50000'))
+embedding_index = None
+# mtime_ns of the meta.json embedding_index was loaded from (or last written by this process)
+embedding_index_mtime = None
+
+# Encrypted copies of single-shot /verify photos are written off the response path
+persist_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='photo-persist')
 
 def cosine_similarity(a, b):
     return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
 
-def eye_aspect_ratio(eye):
-    A = np.linalg.norm(eye[1] - eye[5])
-    B = np.linalg.norm(eye[2] - eye[4])
-    C = np.linalg.norm(eye[0] - eye[3])
-    ear = (A + B) / (2.0 * C)
-    return ear
-
-def count_blinks(frames):
-    blink_count = 0
-    counter = 0
-    for frame in frames:
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        rects = detector(gray, 0)
-        for rect in rects:
-            shape = predictor(gray, rect)
-            shape_np = np.zeros((68, 2), dtype='int')
-            for i in range(68):
-                shape_np[i] = (shape.part(i).x, shape.part(i).y)
-            leftEye = shape_np[42:48]
-            rightEye = shape_np[36:42]
-            leftEAR = eye_aspect_ratio(leftEye)
-            rightEAR = eye_aspect_ratio(rightEye)
-            ear = (leftEAR + rightEAR) / 2.0
-            if ear < EAR_THRESHOLD:
-                counter += 1
-            else:
-                if counter >= CONSEC_FRAMES:
-                    blink_count += 1
-                counter = 0
-    return blink_count
-
-def decrypt_image_to_cv2(filepath):
+def decrypt_stored(data):
+    """Plaintext of stored encrypted data, in either the segmented format or legacy Fernet"""
+    if segment_crypto.is_encrypted(data):
+        return segment_crypto.decrypt(data, STORAGE_KEY)
+    return fernet.decrypt(bytes(data))
+
+def decrypt_file(filepath):
     with open(filepath, 'rb') as f:
-        encrypted_bytes = f.read()
-    image_bytes = fernet.decrypt(encrypted_bytes)
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    return img
+        head = f.read(len(segment_crypto.MAGIC))
+        if not segment_crypto.is_encrypted(head):
+            return fernet.decrypt(head + f.read())
+    return segment_crypto.decrypt_file(filepath, STORAGE_KEY)
+
+def image_key(image_bytes):
+    return hmac.new(BLOB_KEY_SECRET, image_bytes, hashlib.sha256).hexdigest()
+
+def put_image(key, image_bytes):
+    blob_store.put(key, segment_crypto.encrypt(image_bytes, STORAGE_KEY))
+
+def store_image(image_bytes):
+    """Encrypt and store an uploaded image, returning its blob key; identical images are stored once"""
+    key = image_key(image_bytes)
+    if not blob_store.exists(key):
+        put_image(key, image_bytes)
+    return key
+
+def image_exists(name):
+    if blob_stores.is_blob_key(name):
+        return blob_store.exists(name)
+    return os.path.exists(os.path.join(UPLOAD_FOLDER, name))
+
+def load_image(name):
+    """
+    Decrypted bytes of a stored image, by blob key or, for images uploaded before the
+    blob store, by filename in UPLOAD_FOLDER
+    """
+    if blob_stores.is_blob_key(name):
+        return decrypt_stored(blob_store.get(name))
+    return decrypt_file(os.path.join(UPLOAD_FOLDER, name))
+
+def image_identity(name):
+    """
+    Cache identity of a stored image: its blob key, which changes with the content,
+    or for legacy files the filename and mtime. None if the image doesn't exist.
+    """
+    if blob_stores.is_blob_key(name):
+        return name
+    try:
+        return (name, os.path.getmtime(os.path.join(UPLOAD_FOLDER, name)))
+    except (OSError, TypeError):
+        return None
+
+def forget_cached_image(name):
+    """Drop the face_cache entries of a stored image that has been replaced"""
+    if name:
+        face_cache.invalidate(image_identity(name))
+
+def persist_current_photo(app, user_id, key, image_bytes):
+    """
+    Store a single-shot /verify photo, then make it the user's current photo. The
+    column is only updated once the blob is written, so it never names a missing image.
+    """
+    try:
+        if not blob_store.exists(key):
+            put_image(key, image_bytes)
+    except Exception as e:
+        print(f"Error storing current photo {key} of user {user_id}: {str(e)}")
+        return
+    with app.app_context():
+        try:
+            user = db.session.get(User, user_id)
+            previous = user.current_photo
+            user.current_photo = key
+            db.session.commit()
+        except Exception as e:
+            print(f"Error recording current photo {key} of user {user_id}: {str(e)}")
+            db.session.rollback()
+            return
+    if previous != key:
+        forget_cached_image(previous)
+
+def liveness_video_path(user_id):
+    return os.path.join(UPLOAD_FOLDER, f'liveness_{user_id}.mp4.enc')
+
+def store_liveness_video(stream, user_id):
+    """Encrypt a liveness video from a readable stream as it is read, replacing the user's previous one"""
+    filepath = liveness_video_path(user_id)
+    fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_FOLDER, prefix='.tmp-liveness_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            segment_crypto.encrypt_stream(stream, f, STORAGE_KEY)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return filepath
+
+@contextmanager
+def decrypted_video(filepath):
+    """Path of a temporary plaintext copy of an encrypted video, removed on exit"""
+    fd, plain_path = tempfile.mkstemp(dir=DECRYPTED_VIDEO_DIR, prefix='liveness_', suffix='.mp4')
+    try:
+        with os.fdopen(fd, 'wb') as out, open(filepath, 'rb') as f:
+            segment_crypto.decrypt_stream(f, out, STORAGE_KEY)
+        yield plain_path
+    finally:
+        os.remove(plain_path)
+
+def face_result_from_artifact(key):
+    """
+    Embed the face of an image seen before from its FaceArtifact (keyed by the image's
+    blob key), in a vision worker: only the stored 112x112 crop is read and embedded.
+    Returns {'decoded', 'embedding', 'box', 'crop'} with the crop PNG-encoded, or
+    None if the image has no FaceArtifact
+    """
+    artifact = FaceArtifact.query.filter_by(image_key=key).first()
+    if artifact is None:
+        return None
+    crop = bytes(decrypt_stored(artifact.crop))
+    embedding = vision_workers.run(vision_workers.embed_face_crop, crop)
+    box = (artifact.box_x, artifact.box_y, artifact.box_w, artifact.box_h)
+    return {'decoded': True, 'embedding': embedding, 'box': box, 'crop': crop}
+
+def face_result_from_image(key, image_bytes):
+    """
+    Embed the first face in encoded image bytes, in a vision worker, and keep its
+    crop as a FaceArtifact under `key`. Returns the same dict as face_result_from_artifact()
+    """
+    result = vision_workers.run(vision_workers.face_artifact_from_bytes, image_bytes)
+    if result['embedding'] is not None:
+        store_face_artifact(key, result)
+    return result
+
+def extract_face_embeddings(images, keys=None):
+    """
+    Face results of several images (and their blob keys, if known) like
+    stored_face_result(), with the faces of all of them embedded in one batch. Results also carry the face
+    'quality' when a face is found
+    """
+    keys = keys or [image_key(image_bytes) for image_bytes in images]
+    artifacts = {a.image_key: a for a in FaceArtifact.query.filter(FaceArtifact.image_key.in_(keys)).all()}
+    results = [None] * len(images)
+    seen = [i for i, key in enumerate(keys) if key in artifacts]
+    if seen:
+        crops = [bytes(decrypt_stored(artifacts[keys[i]].crop)) for i in seen]
+        embeddings = vision_workers.run(vision_workers.embed_face_crops, crops)
+        for i, crop, embedding in zip(seen, crops, embeddings):
+            artifact = artifacts[keys[i]]
+            box = (artifact.box_x, artifact.box_y, artifact.box_w, artifact.box_h)
+            results[i] = {'decoded': True, 'embedding': embedding, 'box': box, 'crop': crop, 'quality': artifact.quality}
+    new = [i for i in range(len(images)) if results[i] is None]
+    if new:
+        for i, result in zip(new, vision_workers.run(vision_workers.face_artifacts_from_bytes, [images[i] for i in new])):
+            if result['embedding'] is not None:
+                store_face_artifact(keys[i], result)
+            results[i] = result
+    return results
+
+def stored_face_result(name, image_bytes=None):
+    """
+    Face result of a stored image (see face_result_from_artifact()), from face_cache
+    if it has been seen before. The image itself is only loaded (unless passed as image_bytes) when it
+    has no FaceArtifact yet; otherwise only its stored crop is read.
+    """
+    identity = image_identity(name)
+    cached = face_cache.get('face', identity)
+    if cached is not None:
+        return cached
+    key = name if blob_stores.is_blob_key(name) else None
+    result = face_result_from_artifact(key) if key is not None else None
+    if result is None:
+        if image_bytes is None:
+            image_bytes = load_image(name)
+        result = face_result_from_image(key or image_key(image_bytes), image_bytes)
+    if result['embedding'] is not None:
+        face_cache.put('face', identity, {
+            'decoded': True,
+            'embedding': result['embedding'],
+            'box': result['box'],
+            'crop': cv2.imdecode(np.frombuffer(result['crop'], np.uint8), cv2.IMREAD_COLOR)
+        })
+    return result
+
+def store_face_artifact(key, result):
+    """Persist the preprocessing results of face_artifact_from_bytes() for an image, by its blob key"""
+    artifact = FaceArtifact(
+        image_key=key,
+        landmarks=result['landmarks'].tobytes(),
+        landmarks_5=result['landmarks_5'].tobytes(),
+        quality=float(result['quality']),
+        crop=segment_crypto.encrypt(result['crop'], STORAGE_KEY)
+    )
+    artifact.box_x, artifact.box_y, artifact.box_w, artifact.box_h = result['box']
+    db.session.add(artifact)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Stored by a concurrent request for the same image
+        db.session.rollback()
+    return artifact
+
+def store_reference_embedding(user, image_bytes=None, result=None):
+    """
+    Compute the reference embedding for a user's current reference image and persist
+    it. `result` is the image's stored_face_result() if already computed
+    """
+    record = FaceEmbedding.query.filter_by(user_id=user.id).first()
+    if result is None:
+        result = stored_face_result(user.reference_image, image_bytes)
+    embedding, box = result['embedding'], result['box']
+    if embedding is None:
+        # Drop any embedding left over from a previous reference image
+        if record:
+            db.session.delete(record)
+            db.session.commit()
+            reference_gallery.remove(user.id)
+            if embedding_index is not None:
+                embedding_index.remove(user.id)
+                if embedding_index.unflushed >= EMBEDDING_INDEX_FLUSH_EVERY:
+                    flush_embedding_index()
+        return None
+    if not record:
+        record = FaceEmbedding(user_id=user.id)
+        db.session.add(record)
+    record.image = user.reference_image
+    record.embedding = embedding_codec.encode(embedding, EMBEDDING_STORAGE_DTYPE)
+    record.box_x, record.box_y, record.box_w, record.box_h = box
+    record.model_version = MODEL_VERSION
+    db.session.commit()
+    if gallery_loaded:
+        reference_gallery.upsert(user.id, embedding)
+    if embedding_index is not None:
+        embedding_index.add([user.id], [embedding])
+        if embedding_index.unflushed >= EMBEDDING_INDEX_FLUSH_EVERY:
+            flush_embedding_index()
+    return record
+
+def load_reference_embedding(user):
+    """
+    Return the stored reference embedding for a user, recomputing it from the
+    encrypted reference image if it is missing, stale or from another model version.
+    Returns None if no face can be found in the reference image.
+    """
+    identity = image_identity(user.reference_image)
+    cached = face_cache.get('reference', identity)
+    if cached is not None:
+        return cached['embedding']
+    record = FaceEmbedding.query.filter_by(user_id=user.id).first()
+    if record is None or record.image != user.reference_image or record.model_version != MODEL_VERSION:
+        print(f"Recomputing reference embedding for user {user.id}")
+        # Only the stored face crop is read if the reference image has been seen before
+        record = store_reference_embedding(user)
+        if record is None:
+            return None
+    embedding = embedding_codec.decode(record.embedding)
+    face_cache.put('reference', identity, {'embedding': embedding})
+    return embedding
+
+def load_gallery(force=False):
+    """Fill the reference gallery from the database on first use (or on demand)"""
+    global gallery_loaded
+    if gallery_loaded and not force:
+        return reference_gallery
+    records = FaceEmbedding.query.filter_by(model_version=MODEL_VERSION).all()
+    reference_gallery.load((r.user_id, embedding_codec.decode(r.embedding)) for r in records)
+    gallery_loaded = True
+    return reference_gallery
+
+def catch_up_embedding_index(index):
+    """Add references stored since the index was last saved (possibly by another process)"""
+    since = datetime.fromisoformat(index.meta['saved_at'])
+    records = FaceEmbedding.query.filter(
+        FaceEmbedding.updated_at > since,
+        FaceEmbedding.model_version == MODEL_VERSION
+    ).all()
+    if records:
+        index.add([r.user_id for r in records], [embedding_codec.decode(r.embedding) for r in records])
+
+def embedding_index_meta_mtime():
+    try:
+        return os.stat(os.path.join(EMBEDDING_INDEX_PATH, 'meta.json')).st_mtime_ns
+    except OSError:
+        return None
+
+def load_embedding_index():
+    """
+    Memory-map the saved embedding index, if one exists for the current model. It is
+    loaded again whenever another process has built, saved or flushed it since.
+    """
+    global embedding_index, embedding_index_mtime
+    mtime = embedding_index_meta_mtime()
+    if mtime == embedding_index_mtime:
+        return embedding_index
+    embedding_index_mtime = mtime
+    if mtime is None:
+        embedding_index = None
+        return None
+    index = IVFIndex.load(EMBEDDING_INDEX_PATH)
+    if index.meta.get('model_version') != MODEL_VERSION:
+        print("Embedding index was built with another model version, ignoring it until it is rebuilt")
+        embedding_index = None
+        return None
+    catch_up_embedding_index(index)
+    embedding_index = index
+    return embedding_index
+
+def flush_embedding_index():
+    """
+    Append the index's recent changes to its delta log, or rewrite it once the delta
+    is large. If another process has written the index since it was loaded, the
+    changes are only appended and the index is loaded again on next use; if it was
+    rebuilt, the new index is loaded now and only removals are carried over (the
+    rest is caught up from the database).
+    """
+    global embedding_index_mtime
+    index = embedding_index
+    saved_at = datetime.utcnow()
+    written_elsewhere = embedding_index_meta_mtime() != embedding_index_mtime
+    catch_up_embedding_index(index)
+    try:
+        if index.delta_size >= EMBEDDING_INDEX_COMPACT_AT and not written_elsewhere:
+            index.save(EMBEDDING_INDEX_PATH, model_version=MODEL_VERSION, saved_at=saved_at.isoformat())
+        else:
+            index.flush(EMBEDDING_INDEX_PATH, saved_at=saved_at.isoformat())
+    except (StaleIndexError, FileNotFoundError):
+        removed = index.unflushed_removals()
+        embedding_index_mtime = None
+        index = load_embedding_index()
+        if index is not None and removed:
+            for user_id in removed:
+                index.remove(user_id)
+            index.flush(EMBEDDING_INDEX_PATH, saved_at=saved_at.isoformat())
+            embedding_index_mtime = embedding_index_meta_mtime()
+        return
+    embedding_index_mtime = None if written_elsewhere else embedding_index_meta_mtime()
+
+def build_embedding_index(nlist=None, pq_m=0):
+    """Train and save a fresh index over every reference embedding of the current model"""
+    global embedding_index, embedding_index_mtime
+    saved_at = datetime.utcnow()
+    records = FaceEmbedding.query.filter_by(model_version=MODEL_VERSION).all()
+    if not records:
+        return None
+    vectors = np.stack([embedding_codec.decode(r.embedding) for r in records])
+    if nlist is None:
+        nlist = max(1, min(4096, int(4 * np.sqrt(len(records)))))
+    index = IVFIndex(vectors.shape[1], nlist=nlist, pq_m=pq_m, dtype=EMBEDDING_STORAGE_DTYPE)
+    index.train(vectors)
+    index.add([r.user_id for r in records], vectors)
+    index.save(EMBEDDING_INDEX_PATH, model_version=MODEL_VERSION, saved_at=saved_at.isoformat())
+    embedding_index = index
+    embedding_index_mtime = embedding_index_meta_mtime()
+    return index
+
+def search_references(embedding, k, exclude_user_id=None):
+    """
+    Top-k enrolled users most similar to an embedding. Uses the ANN index for the
+    candidate set when one exists and re-scores those candidates exactly.
+    """
+    index = load_embedding_index()
+    if index is None:
+        return load_gallery().search(embedding, k, exclude_user_id=exclude_user_id)
+    candidates = [user_id for user_id, _ in index.search(embedding, k * 4 + 1, nprobe=EMBEDDING_INDEX_NPROBE)
+                  if user_id != exclude_user_id]
+    if not candidates:
+        return []
+    records = FaceEmbedding.query.filter(FaceEmbedding.user_id.in_(candidates)).all()
+    query = np.asarray(embedding, dtype=np.float32)
+    query = query / np.linalg.norm(query)
+    scored = [(r.user_id, float(embedding_codec.decode(r.embedding) @ query)) for r in records]
+    scored.sort(key=lambda item: -item[1])
+    return scored[:k]
+
+def record_duplicate_review(user_id, other_user_id, similarity):
+    """Queue a duplicate-enrollment review unless one is already pending for this pair. Caller commits."""
+    existing = ManualReview.query.filter(
+        ManualReview.user_id == user_id,
+        ManualReview.failure_type == 'duplicate_enrollment',
+        ManualReview.status == 'pending',
+        ManualReview.details.like(f'matches user {other_user_id} %')
+    ).first()
+    if existing:
+        return False
+    db.session.add(ManualReview(
+        user_id=user_id,
+        failure_type='duplicate_enrollment',
+        details=f'matches user {other_user_id} (similarity: {similarity:.4f})'
+    ))
+    return True
+
+def check_duplicate_enrollment(user, embedding):
+    """Compare a new reference embedding against every other enrolled user"""
+    matches = [
+        (other_user_id, similarity)
+        for other_user_id, similarity in search_references(embedding, DUPLICATE_TOP_K, exclude_user_id=user.id)
+        if similarity >= DUPLICATE_THRESHOLD
+    ]
+    for other_user_id, similarity in matches:
+        record_duplicate_review(user.id, other_user_id, similarity)
+    if matches:
+        db.session.commit()
+    return matches
 
 face_bp = Blueprint('face', __name__)
 
@@ -136,56 +554,38 @@ def handle_image_upload(request, user, is_reference=True):
             print("Error: Failed to read image data")
             return None, 'Failed to read image data'
             
-        # Generate appropriate filename with proper extension
-        file_ext = '.jpg'  # Default to .jpg
-        if 'image' in request.files:
-            # Try to get the original extension if available
-            original_filename = getattr(request.files['image'], 'filename', '')
-            if '.' in original_filename:
-                file_ext = os.path.splitext(original_filename)[1].lower()
-                # Ensure it's a valid image extension
-                if file_ext not in ['.jpg', '.jpeg', '.png']:
-                    file_ext = '.jpg'  # Default to .jpg if invalid extension
-        
-        file_prefix = 'reference' if is_reference else 'current'
-        filename = f"{file_prefix}_{user.id}{file_ext}"
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        print(f"Saving to: {filepath}")
-        
-        # Ensure upload directory exists
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        
-        # Encrypt and save the image
-        encrypted_bytes = fernet.encrypt(image_bytes)
-        with open(filepath, 'wb') as f:
-            f.write(encrypted_bytes)
+        # Encrypt and store the image; earlier uploads are kept under their own keys
+        filename = store_image(image_bytes)
+        print(f"Stored as blob {filename}")
             
         # Update user record
+        previous = user.reference_image if is_reference else user.current_photo
         if is_reference:
             user.reference_image = filename
         else:
             user.current_photo = filename
+
+        # Face detection, quality, reference embedding and duplicate checks of a
+        # reference image run in the background (routes/enrollment.py)
+        job = enrollment_queue.enqueue(user.id, filename) if is_reference else None
+
+        # Log the photo upload activity in the same commit
+        activity = ActivityLog(
+            user_id=user.id,
+            activity_type='photo_upload',
+            details=f"{'Reference' if is_reference else 'Current'} photo uploaded",
+            ip_address=request.remote_addr,
+            user_agent=request.headers.get('User-Agent'),
+            status='success'
+        )
+        db.session.add(activity)
         db.session.commit()
+        if job is not None:
+            enrollment_queue.notify()
+        if previous != filename:
+            forget_cached_image(previous)
         
-        # Log the photo upload activity
-        try:
-            ip_address = request.remote_addr
-            user_agent = request.headers.get('User-Agent')
-            
-            activity = ActivityLog(
-                user_id=user.id,
-                activity_type='photo_upload',
-                details=f"{'Reference' if is_reference else 'Current'} photo uploaded",
-                ip_address=ip_address,
-                user_agent=user_agent,
-                status='success'
-            )
-            db.session.add(activity)
-            db.session.commit()
-        except Exception as e:
-            print(f"Error logging activity: {str(e)}")
-        
-        return {'filename': filename, 'filepath': filepath}, None
+        return {'filename': filename, 'job_id': job.id if job else None}, None
         
     except Exception as e:
         print(f"Error processing image: {str(e)}", exc_info=True)
@@ -239,6 +639,12 @@ def handle_photo_upload(is_reference=True):
             'filename': result['filename'],
             'status': 'success'
         }
+        if result['job_id']:
+            # Stored; the face checks are reported at status_url
+            response_data.update(job_id=result['job_id'], job_status='queued',
+                                 status_url=f"/upload/status/{result['job_id']}")
+            print(f"Accepted: {response_data}")
+            return jsonify(response_data), 202
         print(f"Success: {response_data}")
         return jsonify(response_data), 200
             
@@ -246,6 +652,75 @@ def handle_photo_upload(is_reference=True):
         print(f"Unexpected error in {'upload_face' if is_reference else 'upload_current_face'}: {str(e)}", exc_info=True)
         return jsonify({'error': 'An unexpected error occurred', 'details': str(e)}), 500
 
+def compare_with_reference(user, current_photo, current_bytes=None):
+    """
+    Compare a current photo (stored name or blob key) with the user's reference, log
+    the verification and queue a review on a mismatch. Returns (response body, status)
+    """
+    print("Loading stored reference embedding...")
+    ref_embedding = load_reference_embedding(user)
+    if ref_embedding is None:
+        print("Error: No face detected in reference image")
+        return {'error': 'No face in reference image'}, 400
+        
+    print("Processing current photo...")
+    # Decrypted only if its face isn't cached from an earlier attempt
+    cur_result = stored_face_result(current_photo, current_bytes)
+    
+    if not cur_result['decoded']:
+        print("Error: Could not load current photo")
+        return {
+            'error': 'Could not load images',
+            'reference_loaded': True,
+            'current_loaded': False
+        }, 500
+        
+    cur_embedding = cur_result['embedding']
+    
+    if cur_embedding is None:
+        print("Error: No face detected in current photo")
+        return {'error': 'No face in current photo'}, 400
+        
+    print("Calculating similarity score...")
+    sim = cosine_similarity(ref_embedding, cur_embedding)
+    
+    # Log verification activity
+    verification_status = 'success' if sim > SIMILARITY_THRESHOLD else 'failure'
+    try:
+        ip_address = request.remote_addr
+        user_agent = request.headers.get('User-Agent')
+        
+        activity = ActivityLog(
+            user_id=user.id,
+            activity_type='face_verification',
+            details=f'Similarity score: {sim}',
+            ip_address=ip_address,
+            user_agent=user_agent,
+            status=verification_status
+        )
+        db.session.add(activity)
+        db.session.commit()
+    except Exception as e:
+        print(f"Error logging activity: {str(e)}")
+        
+    if sim > SIMILARITY_THRESHOLD:
+        print(f"Verification successful! Similarity score: {sim}")
+        return {'verified': True, 'similarity': float(sim)}, 200
+    else:
+        print(f"Verification failed. Similarity score: {sim} (threshold: {SIMILARITY_THRESHOLD})")
+        review = ManualReview(
+            user_id=user.id,
+            failure_type='verification',
+            details=f'similarity: {sim}'
+        )
+        db.session.add(review)
+        db.session.commit()
+        return {
+            'verified': False, 
+            'similarity': float(sim),
+            'admin_required': True
+        }, 200
+
 @face_bp.route('/verify', methods=['POST'])
 def verify_face():
     try:
@@ -266,118 +741,68 @@ def verify_face():
         print(f"Reference image: {user.reference_image}")
         print(f"Current photo: {user.current_photo}")
         
-        if not user.reference_image or not user.current_photo:
+        # Single-shot mode: the current photo comes in with the request and is
+        # compared straight from memory instead of via /upload/current and disk
+        current_bytes = None
+        if 'image' in request.files:
+            current_bytes = request.files['image'].read()
+            if not current_bytes:
+                print("Error: Empty image in request")
+                return jsonify({'error': 'No selected file'}), 400
+            print(f"Single-shot verification with {len(current_bytes)} bytes from request")
+            
+        if not user.reference_image or (current_bytes is None and not user.current_photo):
             print("Error: Missing reference or current photo")
             return jsonify({
                 'error': 'Reference or current photo not found for user',
                 'has_reference': bool(user.reference_image),
-                'has_current': bool(user.current_photo)
+                'has_current': bool(user.current_photo) or current_bytes is not None
             }), 404
             
-        # Build full file paths
-        ref_path = os.path.join(UPLOAD_FOLDER, user.reference_image)
-        cur_path = os.path.join(UPLOAD_FOLDER, user.current_photo)
-        
-        print(f"Reference image path: {ref_path}")
-        print(f"Current photo path: {cur_path}")
-        
-        # Check if files exist
-        if not os.path.exists(ref_path):
-            print(f"Error: Reference image not found at {ref_path}")
-            return jsonify({'error': f'Reference image not found at {ref_path}'}), 404
+        # Check that the stored images exist
+        if not image_exists(user.reference_image):
+            print(f"Error: Reference image {user.reference_image} not found")
+            return jsonify({'error': f'Reference image {user.reference_image} not found'}), 404
             
-        if not os.path.exists(cur_path):
-            print(f"Error: Current photo not found at {cur_path}")
-            return jsonify({'error': f'Current photo not found at {cur_path}'}), 404
-            
-        # Try to decrypt and load images
-        print("Decrypting reference image...")
-        ref_img = decrypt_image_to_cv2(ref_path)
-        print("Decrypting current photo...")
-        cur_img = decrypt_image_to_cv2(cur_path)
-        
-        if ref_img is None or cur_img is None:
-            print(f"Error: Could not load images. ref_img is None: {ref_img is None}, cur_img is None: {cur_img is None}")
-            return jsonify({
-                'error': 'Could not load images',
-                'reference_loaded': ref_img is not None,
-                'current_loaded': cur_img is not None
-            }), 500
-            
-        print("Converting reference image to grayscale...")
-        gray_ref = cv2.cvtColor(ref_img, cv2.COLOR_BGR2GRAY)
-        cascade_path = os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
-        
-        if not os.path.exists(cascade_path):
-            print(f"Error: Face detection model not found at {cascade_path}")
-            return jsonify({'error': 'Face detection model not found'}), 500
-            
-        print("Detecting face in reference image...")
-        face_cascade = cv2.CascadeClassifier(cascade_path)
-        faces_ref = face_cascade.detectMultiScale(gray_ref, 1.3, 5)
-        
-        if len(faces_ref) == 0:
-            print("Error: No face detected in reference image")
-            return jsonify({'error': 'No face in reference image'}), 400
-            
-        x, y, w, h = faces_ref[0]
-        ref_face = ref_img[y:y+h, x:x+w]
-        print("Extracting face embedding from reference image...")
-        ref_embedding = get_embedding(ref_face)
-        
-        print("Processing current photo...")
-        gray_cur = cv2.cvtColor(cur_img, cv2.COLOR_BGR2GRAY)
-        faces_cur = face_cascade.detectMultiScale(gray_cur, 1.3, 5)
-        
-        if len(faces_cur) == 0:
-            print("Error: No face detected in current photo")
-            return jsonify({'error': 'No face in current photo'}), 400
+        if current_bytes is None:
+            current_photo = user.current_photo
+            print(f"Current photo: {current_photo}")
+            if not image_exists(current_photo):
+                print(f"Error: Current photo {current_photo} not found")
+                return jsonify({'error': f'Current photo {current_photo} not found'}), 404
+        else:
+            # Keep an encrypted copy of the photo without holding up the response; it
+            # becomes the user's current photo once it is written
+            current_photo = image_key(current_bytes)
+            persist_executor.submit(persist_current_photo, current_app._get_current_object(),
+                                    user.id, current_photo, current_bytes)
             
-        x, y, w, h = faces_cur[0]
-        cur_face = cur_img[y:y+h, x:x+w]
-        print("Extracting face embedding from current photo...")
-        cur_embedding = get_embedding(cur_face)
-        
-        print("Calculating similarity score...")
-        sim = cosine_similarity(ref_embedding, cur_embedding)
-        
-        # Log verification activity
-        verification_status = 'success' if sim > SIMILARITY_THRESHOLD else 'failure'
+        # A retry of a verification that already ran (or is still running) gets its
+        # response, without another run or another set of log and review rows
+        idempotency_key = request.headers.get('Idempotency-Key')
+        images = (image_identity(user.reference_image), image_identity(current_photo))
         try:
-            ip_address = request.remote_addr
-            user_agent = request.headers.get('User-Agent')
-            
-            activity = ActivityLog(
-                user_id=user.id,
-                activity_type='face_verification',
-                details=f'Similarity score: {sim}',
-                ip_address=ip_address,
-                user_agent=user_agent,
-                status=verification_status
-            )
-            db.session.add(activity)
-            db.session.commit()
-        except Exception as e:
-            print(f"Error logging activity: {str(e)}")
-            
-        if sim > SIMILARITY_THRESHOLD:
-            print(f"Verification successful! Similarity score: {sim}")
-            return jsonify({'verified': True, 'similarity': float(sim)}), 200
-        else:
-            print(f"Verification failed. Similarity score: {sim} (threshold: {SIMILARITY_THRESHOLD})")
-            review = ManualReview(
-                user_id=user.id,
-                failure_type='verification',
-                details=f'similarity: {sim}'
-            )
-            db.session.add(review)
-            db.session.commit()
-            return jsonify({
-                'verified': False, 
-                'similarity': float(sim),
-                'admin_required': True
-            }), 200
+            cached = verification_cache.acquire(user.id, images, MODEL_VERSION, idempotency_key,
+                                                timeout=vision_workers.VISION_TASK_TIMEOUT)
+        except IdempotencyConflict:
+            print(f"Error: Idempotency-Key {idempotency_key} reused for a different verification")
+            return jsonify({'error': 'Idempotency-Key was already used for a different verification'}), 422
+        if cached is not None:
+            print(f"Returning the result of an identical earlier verification: {cached}")
+            response = jsonify(cached)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response, 200
+        result, status = None, 500
+        try:
+            result, status = compare_with_reference(user, current_photo, current_bytes)
+        finally:
+            verification_cache.release(user.id, images, MODEL_VERSION, result if status == 200 else None,
+                                       idempotency_key)
+        return jsonify(result), status
             
+    except VisionTimeoutError:
+        print("Error: Timed out waiting for a vision worker")
+        return jsonify({'error': 'Verification service is busy, please retry'}), 503
     except Exception as e:
         print(f"Error in verify_face: {str(e)}", exc_info=True)
         return jsonify({'error': f'Error during verification: {str(e)}'}), 500
@@ -393,44 +818,31 @@ def liveness_check():
     if 'video' not in request.files:
         return jsonify({'error': 'No video uploaded'}), 400
     video = request.files['video']
-    filename = f'liveness_{user.id}.mp4'
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
-    video.save(filepath)
-
-    cap = cv2.VideoCapture(filepath)
-    frames = []
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        frames.append(frame)
-    cap.release()
-
-    blink_count = 0
-    counter = 0
-    face_found = False
-    for frame in frames:
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        rects = detector(gray, 0)
-        if len(rects) == 0:
-            continue
-        face_found = True
-        for rect in rects:
-            shape = predictor(gray, rect)
-            shape_np = np.zeros((68, 2), dtype='int')
-            for i in range(68):
-                shape_np[i] = (shape.part(i).x, shape.part(i).y)
-            leftEye = shape_np[42:48]
-            rightEye = shape_np[36:42]
-            leftEAR = eye_aspect_ratio(leftEye)
-            rightEAR = eye_aspect_ratio(rightEye)
-            ear = (leftEAR + rightEAR) / 2.0
-            if ear < EAR_THRESHOLD:
-                counter += 1
-            else:
-                if counter >= CONSEC_FRAMES:
-                    blink_count += 1
-                counter = 0
+    filepath = store_liveness_video(video.stream, user.id)
+
+    try:
+        with decrypted_video(filepath) as plain_path:
+            result = vision_workers.analyse_liveness(plain_path)
+    except VisionTimeoutError:
+        print("Error: Timed out waiting for a vision worker")
+        return jsonify({'error': 'Liveness service is busy, please retry'}), 503
+    return record_liveness_result(user, result)
+
+def record_liveness_result(user, result):
+    """Log a liveness analysis result and build the response; failures go to manual review"""
+    blink_count = result['blinks']
+    face_found = result['face_found']
+
+    screen = result.get('prescreen')
+    if screen is not None and not screen['passed']:
+        review = ManualReview(
+            user_id=user.id,
+            failure_type='liveness',
+            details=f"Replay pre-screen ({screen['reason']}): motion {screen['motion']:.2f}, flicker {screen['flicker']:.4f}"
+        )
+        db.session.add(review)
+        db.session.commit()
+        return jsonify({'liveness': False, 'blinks': 0, 'reason': 'Video looks static or replayed', 'admin_required': True}), 200
 
     if not face_found:
         review = ManualReview(
@@ -442,8 +854,23 @@ def liveness_check():
         db.session.commit()
         return jsonify({'liveness': False, 'blinks': 0, 'reason': 'No face detected', 'admin_required': True}), 200
 
+    # Identity check against the reference, from frames selected during the blink analysis
+    identity = {}
+    if result.get('embedding') is not None:
+        try:
+            ref_embedding = load_reference_embedding(user)
+        except VisionTimeoutError:
+            print("Error: Timed out recomputing the reference embedding")
+            ref_embedding = None
+        if ref_embedding is not None:
+            sim = cosine_similarity(ref_embedding, result['embedding'])
+            identity = {'similarity': float(sim), 'match': bool(sim > SIMILARITY_THRESHOLD)}
+
     # Log liveness check activity
-    liveness_status = 'success' if blink_count >= 2 else 'failure'
+    liveness_status = 'success' if blink_count >= liveness.REQUIRED_BLINKS else 'failure'
+    details = f'Blink count: {blink_count}'
+    if identity:
+        details += f', similarity: {identity["similarity"]:.4f}'
     try:
         ip_address = request.remote_addr
         user_agent = request.headers.get('User-Agent')
@@ -451,7 +878,7 @@ def liveness_check():
         activity = ActivityLog(
             user_id=user.id,
             activity_type='liveness_check',
-            details=f'Blink count: {blink_count}',
+            details=details,
             ip_address=ip_address,
             user_agent=user_agent,
             status=liveness_status
@@ -461,8 +888,18 @@ def liveness_check():
     except Exception as e:
         print(f"Error logging activity: {str(e)}")
     
-    if blink_count >= 2:
-        return jsonify({'liveness': True, 'blinks': blink_count}), 200
+    if blink_count >= liveness.REQUIRED_BLINKS:
+        if identity and not identity['match']:
+            # A live face, but not the enrolled one
+            review = ManualReview(
+                user_id=user.id,
+                failure_type='verification',
+                details=f'liveness video similarity: {identity["similarity"]}'
+            )
+            db.session.add(review)
+            db.session.commit()
+            return jsonify({'liveness': True, 'blinks': blink_count, **identity, 'admin_required': True}), 200
+        return jsonify({'liveness': True, 'blinks': blink_count, **identity}), 200
     else:
         review = ManualReview(
             user_id=user.id,
@@ -471,7 +908,7 @@ def liveness_check():
         )
         db.session.add(review)
         db.session.commit()
-        return jsonify({'liveness': False, 'blinks': blink_count, 'admin_required': True}), 200
+        return jsonify({'liveness': False, 'blinks': blink_count, **identity, 'admin_required': True}), 200
 
 @face_bp.route('/photo_upload', methods=['POST'])
 def photo_upload():
@@ -484,12 +921,11 @@ def photo_upload():
     if 'image' not in request.files:
         return jsonify({'error': 'No image uploaded'}), 400
     image = request.files['image']
-    filename = f"current_{user.id}.jpg"
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
     image_bytes = image.read()
-    encrypted_bytes = fernet.encrypt(image_bytes)
-    with open(filepath, 'wb') as f:
-        f.write(encrypted_bytes)
+    filename = store_image(image_bytes)
+    previous = user.current_photo
     user.current_photo = filename
     db.session.commit()
+    if previous != filename:
+        forget_cached_image(previous)
     return jsonify({'message': 'Current photo uploaded', 'filename': filename}), 200
@@ -0,0 +1,105 @@
+"""
+In-process LRU cache of face results for stored images, bounded by bytes rather
+than by entry count.
+
+Entries are keyed by the identity of a stored image (see routes/face.py
+image_identity(): its blob key, which is derived from the content and never
+changes, or for files from before the blob store, the filename and mtime) and a
+kind, e.g. the 112x112 face crop and embedding of a current photo or the decoded
+reference embedding of a user. Full-resolution images are never cached.
+"""
+import threading
+from collections import OrderedDict
+import numpy as np
+from routes import metrics
+
+# Rough size of the key, dict and bookkeeping of an entry on top of its arrays
+ENTRY_OVERHEAD = 256
+
+def entry_size(value):
+    """Approximate bytes held by a cached dict of arrays, bytes and scalars"""
+    size = ENTRY_OVERHEAD
+    for item in value.values():
+        if isinstance(item, np.ndarray):
+            size += item.nbytes
+        elif isinstance(item, (bytes, bytearray)):
+            size += len(item)
+    return size
+
+class FaceCache:
+    def __init__(self, max_bytes, name='face_cache'):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._keys_of = {}
+        self._bytes = 0
+        self.hits = metrics.counter(f'{name}_hits')
+        self.misses = metrics.counter(f'{name}_misses')
+        self.evictions = metrics.counter(f'{name}_evictions')
+        self.size_bytes = metrics.gauge(f'{name}_bytes')
+        self.size_entries = metrics.gauge(f'{name}_entries')
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def get(self, kind, identity):
+        """The cached value, or None. Values are shared, so callers must not modify them"""
+        if identity is None:
+            return None
+        with self._lock:
+            entry = self._entries.get((kind, identity))
+            if entry is None:
+                self.misses.inc()
+                return None
+            self._entries.move_to_end((kind, identity))
+        self.hits.inc()
+        return entry[0]
+
+    def put(self, kind, identity, value):
+        if identity is None:
+            return
+        size = entry_size(value)
+        if size > self.max_bytes:
+            return
+        key = (kind, identity)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, size)
+            self._keys_of.setdefault(identity, set()).add(key)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions.inc()
+            self._update_gauges()
+
+    def invalidate(self, identity):
+        """Drop every entry for a stored image"""
+        with self._lock:
+            for key in list(self._keys_of.get(identity, ())):
+                self._remove(key)
+            self._update_gauges()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_of.clear()
+            self._bytes = 0
+            self._update_gauges()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry[1]
+        keys = self._keys_of[key[1]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_of[key[1]]
+
+    def _update_gauges(self):
+        self.size_bytes.set(self._bytes)
+        self.size_entries.set(len(self._entries))
@@ -0,0 +1,242 @@
+import os
+import hashlib
+import queue
+import time
+from contextlib import contextmanager
+import cv2
+import numpy as np
+import tensorflow as tf
+import dlib
+from routes.inference_batcher import EmbeddingBatcher
+from routes.image_decode import DETECT_MAX_SIDE, decode_reduced
+from routes import metrics
+from routes.liveness import frontality, sharpness
+
+IMG_SIZE = (112, 112)
+CASCADE_PATH = os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
+
+def preprocess_face(img):
+    img = cv2.resize(img, IMG_SIZE)
+    img = img.astype(np.float32)
+    img = img - 128
+    img = img * 0.0078125
+    img = np.expand_dims(img, axis=0)
+    return img
+
+def five_point_landmarks(shape_np):
+    """Eye centres, nose tip and mouth corners from the 68-point layout"""
+    return np.array([
+        shape_np[36:42].mean(axis=0),
+        shape_np[42:48].mean(axis=0),
+        shape_np[30],
+        shape_np[48],
+        shape_np[54]
+    ])
+
+def shape_to_array(shape):
+    """dlib full_object_detection -> (68, 2) int32 array in a single pass"""
+    return np.fromiter((c for p in shape.parts() for c in (p.x, p.y)),
+                       dtype=np.int32, count=2 * shape.num_parts).reshape(-1, 2)
+
+def get_model_version(model_path):
+    """Short content hash of the model file, used to invalidate stored embeddings"""
+    with open(model_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+POOL_WAIT_BUCKETS_MS = [0.1, 1, 5, 10, 50, 100, 500, 1000, 5000]
+
+class PooledInterpreter:
+    """One TFLite interpreter plus the batch size its input tensor is currently allocated for"""
+
+    def __init__(self, model_path, num_threads):
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = 1
+
+    def run(self, batch):
+        if batch.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, list(batch.shape))
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch.shape[0]
+        self.interpreter.set_tensor(self.input_index, batch)
+        self.interpreter.invoke()
+        # Copy out, the tensor buffer is reused by the next invoke
+        return np.array(self.interpreter.get_tensor(self.output_index))
+
+class InterpreterPool:
+    """
+    Fixed set of interpreters built from the same model. set_tensor/invoke/get_tensor
+    on one interpreter is not thread-safe, so each request thread checks one out for
+    the duration of an inference and returns it afterwards.
+    """
+
+    def __init__(self, model_path, size, num_threads, checkout_timeout=5.0):
+        self.size = size
+        self.checkout_timeout = checkout_timeout
+        self._available = queue.Queue()
+        for _ in range(size):
+            self._available.put(PooledInterpreter(model_path, num_threads))
+        self.wait_ms = metrics.histogram('interpreter_pool_wait_ms', POOL_WAIT_BUCKETS_MS)
+        self.timeouts = metrics.counter('interpreter_pool_timeouts')
+        self.starved = metrics.counter('interpreter_pool_starved_checkouts')
+        self.in_use = metrics.gauge('interpreter_pool_in_use')
+        metrics.gauge('interpreter_pool_size').set(size)
+
+    @contextmanager
+    def checkout(self):
+        started = time.perf_counter()
+        try:
+            worker = self._available.get_nowait()
+        except queue.Empty:
+            # Every interpreter is busy, wait for one to come back
+            self.starved.inc()
+            try:
+                worker = self._available.get(timeout=self.checkout_timeout)
+            except queue.Empty:
+                self.timeouts.inc()
+                raise TimeoutError(f'No interpreter available after {self.checkout_timeout}s')
+        self.wait_ms.observe((time.perf_counter() - started) * 1000.0)
+        self.in_use.inc()
+        try:
+            yield worker
+        finally:
+            self.in_use.dec()
+            self._available.put(worker)
+
+class FaceEngine:
+    """
+    Process-wide holder for the face models. Everything expensive (Haar cascade XML,
+    dlib detector and shape predictor, TFLite interpreter) is loaded once here and
+    shared by every request instead of being rebuilt per call.
+    """
+
+    def __init__(self, model_path, predictor_path, cascade_path=CASCADE_PATH,
+                 pool_size=1, num_threads=1, checkout_timeout=5.0):
+        if not os.path.exists(cascade_path):
+            raise FileNotFoundError(f"Face detection model not found at {cascade_path}")
+        self.face_cascade = cv2.CascadeClassifier(cascade_path)
+        self.detector = dlib.get_frontal_face_detector()
+        self.predictor = dlib.shape_predictor(predictor_path)
+        self.pool = InterpreterPool(model_path, pool_size, num_threads, checkout_timeout)
+        self.model_version = get_model_version(model_path)
+        self.batcher = None
+
+    def warm_up(self):
+        """Run each model once so the first real request doesn't pay for lazy initialisation"""
+        blank = np.zeros((IMG_SIZE[1] * 2, IMG_SIZE[0] * 2, 3), dtype=np.uint8)
+        gray = cv2.cvtColor(blank, cv2.COLOR_BGR2GRAY)
+        self.detect(gray)
+        self.landmarks(gray)
+        self.embed(blank)
+
+    def detect(self, gray):
+        """Haar cascade face boxes as a list of (x, y, w, h)"""
+        faces = self.face_cascade.detectMultiScale(gray, 1.3, 5)
+        return [tuple(int(v) for v in face) for face in faces]
+
+    def rect(self, left, top, right, bottom):
+        return dlib.rectangle(int(left), int(top), int(right), int(bottom))
+
+    def face_boxes(self, gray):
+        """dlib face detector boxes as (left, top, right, bottom)"""
+        return [(r.left(), r.top(), r.right(), r.bottom()) for r in self.detector(gray, 0)]
+
+    def landmarks(self, gray, rects=None):
+        """68-point landmarks as (68, 2) arrays, one per dlib-detected face (or per given rect)"""
+        if rects is None:
+            rects = self.detector(gray, 0)
+        return [shape_to_array(self.predictor(gray, rect)) for rect in rects]
+
+    def start_batching(self, window_ms, max_batch):
+        """Route embed() calls through a micro-batching queue shared by all request threads"""
+        self.batcher = EmbeddingBatcher(self.run_batch, window_ms=window_ms, max_batch=max_batch,
+                                        num_workers=self.pool.size)
+
+    def run_batch(self, tensors):
+        """Run one invoke over a list of preprocessed (1, H, W, C) faces and return normalized embeddings"""
+        batch = np.concatenate(tensors, axis=0)
+        with self.pool.checkout() as worker:
+            embeddings = worker.run(batch)
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return list(embeddings)
+
+    def embed(self, face_img):
+        """L2-normalized embedding of a cropped BGR face"""
+        preprocessed = preprocess_face(face_img)
+        if self.batcher is not None:
+            return self.batcher.embed(preprocessed)
+        return self.run_batch([preprocessed])[0]
+
+    def embed_batch(self, face_imgs):
+        """embed() of several cropped faces in a single invoke"""
+        if not face_imgs:
+            return []
+        return self.run_batch([preprocess_face(face_img) for face_img in face_imgs])
+
+    def detect_scaled(self, gray, max_side=DETECT_MAX_SIDE):
+        """Haar detection on a copy downscaled to max_side, with boxes mapped back to gray's coordinates"""
+        longest = max(gray.shape[:2])
+        if longest <= max_side:
+            return self.detect(gray)
+        ratio = longest / max_side
+        small = cv2.resize(gray, (round(gray.shape[1] / ratio), round(gray.shape[0] / ratio)),
+                           interpolation=cv2.INTER_AREA)
+        return [tuple(int(round(v * ratio)) for v in face) for face in self.detect(small)]
+
+    def face_artifact_from_bytes(self, image_bytes):
+        """
+        Multi-resolution path for encoded photos: reduced-scale decode, detection on a
+        small grayscale copy, embedding crop from the moderately sized decode. Returns
+        the face embedding and box in original image coordinates, plus what is worth
+        keeping to skip decoding and detection next time: landmarks in original
+        coordinates, a quality score and the IMG_SIZE crop the embedding was computed
+        from (embed(crop) reproduces it).
+        Returns {'decoded', 'embedding', 'box', 'landmarks', 'landmarks_5', 'quality', 'crop'}
+        """
+        artifact = self._face_artifact_without_embedding(image_bytes)
+        if artifact['crop'] is not None:
+            artifact['embedding'] = self.embed(artifact['crop'])
+        return artifact
+
+    def face_artifacts_from_bytes(self, images):
+        """face_artifact_from_bytes() of several images, with all their faces embedded in one invoke"""
+        artifacts = [self._face_artifact_without_embedding(image_bytes) for image_bytes in images]
+        faces = [artifact for artifact in artifacts if artifact['crop'] is not None]
+        for artifact, embedding in zip(faces, self.embed_batch([artifact['crop'] for artifact in faces])):
+            artifact['embedding'] = embedding
+        return artifacts
+
+    def _face_artifact_without_embedding(self, image_bytes):
+        artifact = {'decoded': False, 'embedding': None, 'box': None, 'landmarks': None,
+                    'landmarks_5': None, 'quality': None, 'crop': None}
+        img, scale = decode_reduced(image_bytes)
+        if img is None:
+            return artifact
+        artifact['decoded'] = True
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        faces = self.detect_scaled(gray)
+        if len(faces) == 0:
+            return artifact
+        x, y, w, h = faces[0]
+        crop = cv2.resize(img[y:y+h, x:x+w], IMG_SIZE)
+        shape_np = self.landmarks(gray, [self.rect(x, y, x + w, y + h)])[0]
+        artifact.update(
+            box=tuple(int(round(v * scale)) for v in (x, y, w, h)),
+            landmarks=np.round(shape_np * scale).astype(np.int16),
+            landmarks_5=np.round(five_point_landmarks(shape_np) * scale).astype(np.int16),
+            quality=sharpness(gray, shape_np) * frontality(shape_np),
+            crop=crop
+        )
+        return artifact
+
+    def face_embedding(self, img):
+        """Detect the first face in a BGR image and return (embedding, box), or (None, None)"""
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        faces = self.detect(gray)
+        if len(faces) == 0:
+            return None, None
+        x, y, w, h = faces[0]
+        face = img[y:y+h, x:x+w]
+        return self.embed(face), (x, y, w, h)
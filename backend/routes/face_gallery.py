@@ -0,0 +1,124 @@
+import threading
+import numpy as np
+from routes.embedding_codec import CompactMatrix
+
+class ReferenceGallery:
+    """
+    All users' L2-normalized reference embeddings in one contiguous matrix, so a 1:N
+    search is a single matrix-vector product instead of N cosine calls. With a
+    float16 or int8 dtype the matrix is kept compact (see routes/embedding_codec.py)
+    and scores stay within SIMILARITY_TOLERANCE of float32.
+    """
+
+    def __init__(self, dim=None, dtype='float32'):
+        self.dim = dim
+        self.dtype = dtype
+        self._lock = threading.RLock()
+        self._matrix = CompactMatrix.zeros(0, dim or 0, dtype)
+        self._user_ids = np.zeros(0, dtype=np.int64)
+        self._row_of = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _normalize(embedding):
+        embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        return embedding / np.linalg.norm(embedding)
+
+    def load(self, items):
+        """Replace the gallery contents with (user_id, embedding) pairs"""
+        items = list(items)
+        with self._lock:
+            if not items:
+                self._matrix = CompactMatrix.zeros(0, self.dim or 0, self.dtype)
+                self._user_ids = np.zeros(0, dtype=np.int64)
+                self._row_of = {}
+                self._size = 0
+                return
+            matrix = np.stack([self._normalize(e) for _, e in items])
+            self.dim = matrix.shape[1]
+            self._matrix = CompactMatrix(matrix, self.dtype)
+            self._user_ids = np.array([user_id for user_id, _ in items], dtype=np.int64)
+            self._row_of = {int(user_id): row for row, user_id in enumerate(self._user_ids)}
+            self._size = len(items)
+
+    def _grow(self, needed):
+        capacity = len(self._matrix)
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2, 64)
+        matrix = self._matrix.resized(capacity)
+        user_ids = np.zeros(capacity, dtype=np.int64)
+        user_ids[:self._size] = self._user_ids[:self._size]
+        self._matrix, self._user_ids = matrix, user_ids
+
+    def upsert(self, user_id, embedding):
+        embedding = self._normalize(embedding)
+        with self._lock:
+            if self.dim is None or self._size == 0:
+                self.dim = embedding.shape[0]
+                if self._matrix.codes.shape[1] != self.dim:
+                    self._matrix = CompactMatrix.zeros(0, self.dim, self.dtype)
+            row = self._row_of.get(int(user_id))
+            if row is None:
+                self._grow(self._size + 1)
+                row = self._size
+                self._size += 1
+                self._row_of[int(user_id)] = row
+                self._user_ids[row] = user_id
+            self._matrix[row] = embedding
+
+    def remove(self, user_id):
+        with self._lock:
+            row = self._row_of.pop(int(user_id), None)
+            if row is None:
+                return
+            last = self._size - 1
+            if row != last:
+                # Move the last row into the hole to keep the matrix dense
+                self._matrix.copy_row(row, last)
+                self._user_ids[row] = self._user_ids[last]
+                self._row_of[int(self._user_ids[row])] = row
+            self._size = last
+
+    def search(self, embedding, k=5, exclude_user_id=None):
+        """Top-k (user_id, similarity) pairs for one embedding, best first"""
+        query = self._normalize(embedding)
+        with self._lock:
+            if self._size == 0:
+                return []
+            scores = self._matrix[:self._size].dot(query)
+            user_ids = self._user_ids[:self._size].copy()
+        if exclude_user_id is not None:
+            scores[user_ids == exclude_user_id] = -np.inf
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(user_ids[i]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+    def duplicate_pairs(self, threshold, block_size=1024):
+        """
+        All-pairs sweep returning (user_id_a, user_id_b, similarity) with a < b and
+        similarity >= threshold. Works block by block so memory stays at
+        block_size x block_size scores however large the gallery is.
+        """
+        with self._lock:
+            matrix = self._matrix.resized(self._size)
+            user_ids = self._user_ids[:self._size].copy()
+        pairs = []
+        n = len(user_ids)
+        for i in range(0, n, block_size):
+            block_i = matrix[i:i + block_size].to_float32()
+            for j in range(i, n, block_size):
+                scores = matrix[j:j + block_size].dot(block_i).T
+                if i == j:
+                    # Only the strict upper triangle, skipping self-matches and mirrored pairs
+                    scores = np.triu(scores, k=1) + np.tril(np.full_like(scores, -np.inf))
+                rows, cols = np.nonzero(scores >= threshold)
+                for r, c in zip(rows, cols):
+                    a, b = int(user_ids[i + r]), int(user_ids[j + c])
+                    pairs.append((min(a, b), max(a, b), float(scores[r, c])))
+        pairs.sort(key=lambda pair: -pair[2])
+        return pairs
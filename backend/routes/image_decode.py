@@ -0,0 +1,56 @@
+"""
+Reduced-scale decoding of uploaded photos.
+
+Large phone photos are decoded at reduced scale: the face crop is cut from an image
+whose longest side is at least CROP_MAX_SIDE and detection runs on a DETECT_MAX_SIDE copy.
+"""
+import io
+import cv2
+import numpy as np
+from PIL import Image
+
+CROP_MAX_SIDE = 1280
+DETECT_MAX_SIDE = 640
+REDUCED_COLOR_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                       4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+EXIF_ORIENTATION = 0x0112
+# Orientations 5-8 are stored rotated by 90 degrees
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+def image_size(image_bytes):
+    """
+    (width, height) of the image as cv2.imdecode returns it, i.e. after its EXIF
+    orientation is applied, read from the header without decoding pixels, or None
+    """
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        width, height = image.size
+        if image.getexif().get(EXIF_ORIENTATION) in TRANSPOSED_ORIENTATIONS:
+            return height, width
+        return width, height
+    except Exception:
+        return None
+
+def reduction_factor(size, min_side):
+    """Largest JPEG-style reduction (1, 2, 4 or 8) that keeps the longest side >= min_side"""
+    if size is None:
+        return 1
+    longest = max(size)
+    for factor in (8, 4, 2):
+        if longest // factor >= min_side:
+            return factor
+    return 1
+
+def decode_reduced(image_bytes, max_side=CROP_MAX_SIDE):
+    """
+    Decode at the coarsest scale that still has max_side pixels on the longest side.
+    Returns (img, scale) where original coordinates = img coordinates * scale.
+    """
+    size = image_size(image_bytes)
+    factor = reduction_factor(size, max_side)
+    img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), REDUCED_COLOR_FLAGS[factor])
+    if img is None:
+        return None, 1.0
+    scale = size[0] / img.shape[1] if size and factor > 1 else 1.0
+    return img, scale
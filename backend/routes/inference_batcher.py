@@ -0,0 +1,84 @@
+import queue
+import threading
+import time
+from routes import metrics
+
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32]
+QUEUE_WAIT_BUCKETS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 250]
+
+class _PendingEmbedding:
+    def __init__(self, tensor):
+        self.tensor = tensor
+        self.enqueued_at = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class EmbeddingBatcher:
+    """
+    Collects preprocessed faces from concurrent requests and runs them through the
+    model as one batch. A batch takes the faces already queued, then is closed once
+    window_ms has passed since collection began or max_batch faces are in it,
+    whichever comes first.
+    """
+
+    def __init__(self, run_batch, window_ms=3.0, max_batch=8, num_workers=1):
+        self.run_batch = run_batch
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self.batch_size = metrics.histogram('embedding_batch_size', BATCH_SIZE_BUCKETS)
+        self.queue_wait_ms = metrics.histogram('embedding_queue_wait_ms', QUEUE_WAIT_BUCKETS_MS)
+        # One collector per interpreter so several batches can be in flight at once
+        self._threads = []
+        for i in range(num_workers):
+            thread = threading.Thread(target=self._run, name=f'embedding-batcher-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def embed(self, tensor, timeout=None):
+        """Queue a single preprocessed (1, H, W, C) face and block until its embedding is ready"""
+        pending = _PendingEmbedding(tensor)
+        self._queue.put(pending)
+        if not pending.done.wait(timeout):
+            raise TimeoutError('Timed out waiting for embedding batch')
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        # Faces already waiting go in first, so a backlog is drained in full batches
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            for pending in batch:
+                self.queue_wait_ms.observe((started - pending.enqueued_at) * 1000.0)
+            self.batch_size.observe(len(batch))
+            try:
+                embeddings = self.run_batch([pending.tensor for pending in batch])
+                for pending, embedding in zip(batch, embeddings):
+                    pending.result = embedding
+            except Exception as e:
+                for pending in batch:
+                    pending.error = e
+            finally:
+                for pending in batch:
+                    pending.done.set()
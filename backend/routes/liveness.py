@@ -0,0 +1,618 @@
+import os
+import heapq
+import cv2
+import numpy as np
+
+EAR_THRESHOLD = 0.21
+CONSEC_FRAMES = 2
+REQUIRED_BLINKS = 2
+
+# Upper bound on how much of a liveness video is analysed
+MAX_ANALYSED_FRAMES = int(os.environ.get('LIVENESS_MAX_FRAMES', '900'))
+MAX_ANALYSED_SECONDS = float(os.environ.get('LIVENESS_MAX_SECONDS', '20'))
+
+# Face tracking: run the dlib detector once, then predict landmarks inside a box placed
+# around the previous frame's landmarks the way the detector placed its box, re-detecting
+# every REDETECT_EVERY frames or as soon as the landmark geometry stops looking like a
+# face in that box
+TRACK_FACES = os.environ.get('LIVENESS_TRACKING', '1') == '1'
+REDETECT_EVERY = int(os.environ.get('LIVENESS_REDETECT_EVERY', '15'))
+MAX_TRACK_SHIFT = 0.25
+MAX_TRACK_SCALE_CHANGE = 0.35
+
+LEFT_EYE = slice(42, 48)
+RIGHT_EYE = slice(36, 42)
+EAR_WINDOW = 8
+
+# Blink detection needs about 15 EAR samples per second; higher frame rates are
+# sampled down to that (0 analyses every frame), on frames downscaled to at most
+# ANALYSIS_MAX_SIDE pixels
+SAMPLE_FPS = float(os.environ.get('LIVENESS_SAMPLE_FPS', '15'))
+# Frame rate of the recordings CONSEC_FRAMES was tuned on
+REFERENCE_FPS = 30
+# A blink still needs this many consecutive closed samples after sampling down, so a
+# single noisy landmark fit can't count as one
+MIN_SAMPLED_CONSEC_FRAMES = 2
+
+# Identity check on the liveness video itself: the IDENTITY_FRAMES sharpest frontal
+# frames with open eyes are embedded and compared with the reference (0 disables it)
+IDENTITY_FRAMES = int(os.environ.get('LIVENESS_IDENTITY_FRAMES', '3'))
+IDENTITY_MIN_FRONTALITY = 0.6
+IDENTITY_CROP_MARGIN = 0.4
+NOSE_TIP = 30
+JAW_LEFT = 0
+JAW_RIGHT = 16
+
+# Replay pre-screen: the first second of the clip, as tiny grayscale frames, rejects
+# clips with no motion (a photo held in front of the camera) or with screen flicker
+# before the landmark stage runs. Motion is the 99th percentile over pixels of the
+# largest change from the first frame, in gray levels; flicker is the frame-to-frame
+# jitter of overall brightness as a fraction of it.
+PRESCREEN = os.environ.get('LIVENESS_PRESCREEN', '1') == '1'
+PRESCREEN_SECONDS = 1.0
+PRESCREEN_MAX_FRAMES = 30
+PRESCREEN_SIDE = 96
+PRESCREEN_MIN_MOTION = float(os.environ.get('LIVENESS_PRESCREEN_MIN_MOTION', '6'))
+PRESCREEN_MAX_FLICKER = float(os.environ.get('LIVENESS_PRESCREEN_MAX_FLICKER', '0.02'))
+ANALYSIS_MAX_SIDE = int(os.environ.get('LIVENESS_ANALYSIS_MAX_SIDE', '480'))
+
+def eye_aspect_ratio(eye):
+    A = np.linalg.norm(eye[1] - eye[5])
+    B = np.linalg.norm(eye[2] - eye[4])
+    C = np.linalg.norm(eye[0] - eye[3])
+    ear = (A + B) / (2.0 * C)
+    return ear
+
+def eye_aspect_ratios(eyes):
+    """EAR for a (frames, 6, 2) batch of eye landmarks in one expression"""
+    eyes = np.asarray(eyes, dtype=np.float64)
+    A = np.linalg.norm(eyes[:, 1] - eyes[:, 5], axis=-1)
+    B = np.linalg.norm(eyes[:, 2] - eyes[:, 4], axis=-1)
+    C = np.linalg.norm(eyes[:, 0] - eyes[:, 3], axis=-1)
+    return (A + B) / (2.0 * C)
+
+def ear_series(landmarks):
+    """Mean of left and right EAR for a (frames, 68, 2) landmark array"""
+    landmarks = np.asarray(landmarks)
+    if len(landmarks) == 0:
+        return np.zeros(0)
+    return (eye_aspect_ratios(landmarks[:, LEFT_EYE]) + eye_aspect_ratios(landmarks[:, RIGHT_EYE])) / 2.0
+
+class LandmarkBuffer:
+    """Preallocated (capacity, 68, 2) store for a window of per-frame landmarks"""
+
+    def __init__(self, capacity=EAR_WINDOW):
+        self.array = np.zeros((capacity, 68, 2), dtype=np.int32)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, shape_np):
+        if self.size == len(self.array):
+            grown = np.zeros((2 * len(self.array), 68, 2), dtype=np.int32)
+            grown[:self.size] = self.array
+            self.array = grown
+        self.array[self.size] = shape_np
+        self.size += 1
+
+    def drain(self):
+        """EAR series for the buffered landmarks, emptying the buffer"""
+        ears = ear_series(self.array[:self.size])
+        self.size = 0
+        return ears
+
+class BlinkCounter:
+    """
+    The blink state machine: a blink is CONSEC_FRAMES or more EAR samples below
+    EAR_THRESHOLD followed by a sample at or above it. State carries across update()
+    calls, so a series can be fed in windows.
+    """
+
+    def __init__(self, threshold=EAR_THRESHOLD, consec_frames=CONSEC_FRAMES):
+        self.threshold = threshold
+        self.consec_frames = consec_frames
+        self.counter = 0
+        self.blinks = 0
+
+    def update(self, ears):
+        for ear in ears:
+            if ear < self.threshold:
+                self.counter += 1
+            else:
+                if self.counter >= self.consec_frames:
+                    self.blinks += 1
+                self.counter = 0
+        return self.blinks
+
+class FaceTracker:
+    """
+    Drop-in for engine.landmarks(gray) that skips the detector on most frames.
+
+    The landmark predictor is trained on detector boxes, which are larger than the
+    landmarks' bounds and sit differently around them. Each detection records where
+    the detector put its box relative to the landmarks' bounds, and tracked frames
+    predict inside a box placed the same way around the previous landmarks.
+    """
+
+    def __init__(self, engine, redetect_every=REDETECT_EVERY):
+        self.engine = engine
+        self.redetect_every = redetect_every
+        # Per face: landmark bounds in the last frame, and detector box edges relative to them
+        self.boxes = None
+        self.fits = None
+        self.frames_since_detect = 0
+        self.frames = 0
+        self.detector_calls = 0
+
+    @staticmethod
+    def _box(shape_np):
+        left, top = shape_np.min(axis=0)
+        right, bottom = shape_np.max(axis=0)
+        return int(left), int(top), int(right), int(bottom)
+
+    @staticmethod
+    def _fit(box, detector_box):
+        """Detector box edges as offsets from the landmark bounds, in units of their size"""
+        width, height = max(box[2] - box[0], 1), max(box[3] - box[1], 1)
+        return ((detector_box[0] - box[0]) / width, (detector_box[1] - box[1]) / height,
+                (detector_box[2] - box[2]) / width, (detector_box[3] - box[3]) / height)
+
+    @staticmethod
+    def _detector_like(box, fit):
+        width, height = box[2] - box[0], box[3] - box[1]
+        return (box[0] + fit[0] * width, box[1] + fit[1] * height,
+                box[2] + fit[2] * width, box[3] + fit[3] * height)
+
+    def _plausible(self, shape_np, box, frame_shape):
+        height, width = frame_shape[:2]
+        left, top, right, bottom = self._box(shape_np)
+        if left < 0 or top < 0 or right >= width or bottom >= height:
+            return False
+        box_w, box_h = box[2] - box[0], box[3] - box[1]
+        new_w, new_h = right - left, bottom - top
+        if box_w <= 0 or box_h <= 0 or new_w <= 0 or new_h <= 0:
+            return False
+        shift = max(abs((left + right) - (box[0] + box[2])) / 2.0 / box_w,
+                    abs((top + bottom) - (box[1] + box[3])) / 2.0 / box_h)
+        scale_change = abs(new_w * new_h / float(box_w * box_h) - 1.0)
+        return shift <= MAX_TRACK_SHIFT and scale_change <= MAX_TRACK_SCALE_CHANGE
+
+    def _detect(self, gray):
+        self.detector_calls += 1
+        detector_boxes = self.engine.face_boxes(gray)
+        shapes = self.engine.landmarks(gray, [self.engine.rect(*box) for box in detector_boxes])
+        self.boxes = [self._box(shape_np) for shape_np in shapes] or None
+        self.fits = [self._fit(box, detector_box) for box, detector_box in zip(self.boxes or [], detector_boxes)]
+        self.frames_since_detect = 0
+        return shapes
+
+    def landmarks(self, gray):
+        self.frames += 1
+        if self.boxes is None or self.frames_since_detect >= self.redetect_every:
+            return self._detect(gray)
+        rects = [self.engine.rect(*self._detector_like(box, fit)) for box, fit in zip(self.boxes, self.fits)]
+        shapes = self.engine.landmarks(gray, rects)
+        if not all(self._plausible(shape_np, box, gray.shape) for shape_np, box in zip(shapes, self.boxes)):
+            return self._detect(gray)
+        self.boxes = [self._box(shape_np) for shape_np in shapes]
+        self.frames_since_detect += 1
+        return shapes
+
+    @property
+    def detector_ratio(self):
+        return self.detector_calls / float(self.frames) if self.frames else 0.0
+
+    def state(self):
+        """Tracking state, so a stream's next frame can be handled by another process"""
+        return {
+            'boxes': self.boxes,
+            'fits': self.fits,
+            'frames_since_detect': self.frames_since_detect,
+            'frames': self.frames,
+            'detector_calls': self.detector_calls
+        }
+
+    def restore(self, state):
+        if state:
+            self.boxes = state['boxes']
+            self.fits = state['fits']
+            self.frames_since_detect = state['frames_since_detect']
+            self.frames = state['frames']
+            self.detector_calls = state['detector_calls']
+        return self
+
+def frame_limit(cap, max_frames=MAX_ANALYSED_FRAMES, max_seconds=MAX_ANALYSED_SECONDS):
+    """Number of frames to analyse at most, from the frame and duration caps"""
+    limit = max_frames
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    if fps and fps > 0 and max_seconds:
+        limit = min(limit, int(fps * max_seconds))
+    return limit
+
+def sample_stride(fps, sample_fps=SAMPLE_FPS):
+    """Analyse every stride-th frame so that about sample_fps frames per second are used"""
+    if not sample_fps or not fps or fps <= 0:
+        return 1
+    return max(1, int(round(fps / float(sample_fps))))
+
+def sampled_consec_frames(stride, consec_frames=CONSEC_FRAMES):
+    """
+    CONSEC_FRAMES is in source frames; the equivalent run length in sampled frames,
+    but never below MIN_SAMPLED_CONSEC_FRAMES (or consec_frames itself if that is lower)
+    """
+    return max(min(consec_frames, MIN_SAMPLED_CONSEC_FRAMES), int(np.ceil(consec_frames / float(stride))))
+
+def reduce_gray(gray, max_side=ANALYSIS_MAX_SIDE):
+    """
+    Reduce a grayscale frame by an integer factor to at most max_side: landmarks and
+    EAR don't need full resolution, and an integer INTER_AREA reduction of one channel
+    is several times cheaper than an arbitrary resize of three
+    """
+    factor = int(np.ceil(max(gray.shape) / float(max_side))) if max_side else 1
+    if factor > 1:
+        gray = cv2.resize(gray, None, fx=1.0 / factor, fy=1.0 / factor, interpolation=cv2.INTER_AREA)
+    return gray
+
+def analysis_gray(frame, max_side=ANALYSIS_MAX_SIDE):
+    return reduce_gray(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), max_side)
+
+def consec_frames_at(fps):
+    """CONSEC_FRAMES for frames arriving at `fps` rather than at the REFERENCE_FPS it was tuned for"""
+    return sampled_consec_frames(sample_stride(REFERENCE_FPS, fps))
+
+class FrameSampler:
+    """
+    The grayscale analysis frames of source frames [start, end), decoded one at a time.
+    Only frames whose index is a multiple of the stride are retrieved and converted;
+    the others are just grabbed. Strides are aligned to the start of the video, so
+    ranges of one clip sample exactly the frames a single pass over it would.
+    """
+
+    def __init__(self, filepath, start=0, end=None, max_frames=MAX_ANALYSED_FRAMES,
+                 max_seconds=MAX_ANALYSED_SECONDS, sample_fps=SAMPLE_FPS):
+        self.cap = cv2.VideoCapture(filepath)
+        self.stride = sample_stride(self.cap.get(cv2.CAP_PROP_FPS), sample_fps)
+        self.consec_frames = sampled_consec_frames(self.stride)
+        limit = frame_limit(self.cap, max_frames, max_seconds)
+        self.end = limit if end is None else min(end, limit)
+        self.position = start
+        self.frames_analysed = 0
+        self.frame = None
+        self.scale = 1.0
+        if start:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+    def __iter__(self):
+        try:
+            while self.position < self.end:
+                if self.position % self.stride:
+                    if not self.cap.grab():
+                        break
+                    self.position += 1
+                    continue
+                ret, frame = self.cap.read()
+                if not ret:
+                    break
+                self.position += 1
+                self.frames_analysed += 1
+                gray = analysis_gray(frame)
+                # The source frame, for crops at full resolution
+                self.frame = frame
+                self.scale = frame.shape[1] / float(gray.shape[1])
+                yield gray
+        finally:
+            self.close()
+
+    def close(self):
+        self.cap.release()
+
+def frontality(shape_np):
+    """1 for a face looking straight at the camera, falling to 0 as it turns sideways"""
+    left, right, nose = shape_np[JAW_LEFT], shape_np[JAW_RIGHT], shape_np[NOSE_TIP]
+    width = np.linalg.norm(right - left)
+    if width == 0:
+        return 0.0
+    yaw = abs(np.linalg.norm(nose - left) - np.linalg.norm(nose - right)) / width
+    return max(0.0, 1.0 - 2.0 * yaw)
+
+def sharpness(gray, shape_np):
+    """Variance of the Laplacian over the landmarks' bounding box"""
+    left, top = np.maximum(shape_np.min(axis=0), 0)
+    right, bottom = shape_np.max(axis=0)
+    roi = gray[top:bottom + 1, left:right + 1]
+    return float(cv2.Laplacian(roi, cv2.CV_64F).var()) if roi.size else 0.0
+
+def face_crop(frame, shape_np, scale, margin=IDENTITY_CROP_MARGIN):
+    """Region around the landmarks in the source frame, with room for the face detector"""
+    left, top = shape_np.min(axis=0) * scale
+    right, bottom = shape_np.max(axis=0) * scale
+    pad_x, pad_y = margin * (right - left), margin * (bottom - top)
+    height, width = frame.shape[:2]
+    left, top = int(max(0, left - pad_x)), int(max(0, top - pad_y))
+    right, bottom = int(min(width, right + pad_x)), int(min(height, bottom + pad_y))
+    return frame[top:bottom, left:right].copy()
+
+def identity_score(gray, shapes):
+    """
+    sharpness x frontality of a frame usable for the identity check (one face, eyes
+    open, roughly frontal), or None
+    """
+    if len(shapes) != 1:
+        return None
+    shape_np = shapes[0]
+    front = frontality(shape_np)
+    if front < IDENTITY_MIN_FRONTALITY or ear_series(shape_np[None])[0] < EAR_THRESHOLD:
+        return None
+    return sharpness(gray, shape_np) * front
+
+def embed_candidates(engine, items):
+    """
+    (score, position, embedding) for (score, position, crop) items, best first, with
+    crops cut down to the face detector's box as reference embeddings are, so the
+    two are comparable. Crops without a detectable face are dropped.
+    """
+    candidates = []
+    for score, position, crop in sorted(items, key=lambda item: item[:2], reverse=True):
+        embedding, _ = engine.face_embedding(crop)
+        if embedding is not None:
+            candidates.append((score, position, embedding))
+    return candidates
+
+class FrameSelector:
+    """
+    Keeps source-resolution crops of the k best frames for the identity check, using
+    the landmarks the blink analysis already has
+    """
+
+    def __init__(self, k=IDENTITY_FRAMES):
+        self.k = k
+        self.heap = []
+
+    @property
+    def cutoff(self):
+        """Score a frame has to beat to be kept"""
+        if self.k <= 0:
+            return np.inf
+        return self.heap[0][0] if len(self.heap) == self.k else -np.inf
+
+    def keep(self, score, position, crop):
+        if score <= self.cutoff:
+            return
+        item = (score, position, crop)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, item)
+        else:
+            heapq.heapreplace(self.heap, item)
+
+    def offer(self, frame, scale, gray, shapes, position):
+        score = identity_score(gray, shapes)
+        if score is not None and score > self.cutoff:
+            self.keep(score, position, face_crop(frame, shapes[0], scale))
+
+    def candidates(self, engine):
+        """(score, position, embedding) for the selected frames, see embed_candidates()"""
+        return embed_candidates(engine, self.heap)
+
+def identity_embedding(candidates, k=IDENTITY_FRAMES):
+    """Mean of the k best candidates' embeddings, re-normalized; None without candidates"""
+    best = sorted(candidates, key=lambda c: c[:2], reverse=True)[:k]
+    if not best:
+        return None
+    mean = np.mean([embedding for _, _, embedding in best], axis=0)
+    return mean / np.linalg.norm(mean)
+
+def frame_ears(engine, image_bytes, tracker_state=None, thumbnail=False, identity_cutoff=np.inf):
+    """
+    EAR of each face in one encoded (JPEG/PNG) frame of a live stream, decoded
+    straight to grayscale. With thumbnail=True the result includes the frame reduced
+    for prescreen_frames(); if the frame scores above identity_cutoff for the identity
+    check (see FrameSelector) it includes its face crop as PNG bytes.
+    Returns {'ears', 'tracker_state', 'thumbnail', 'identity': (score, crop_png) or None},
+    or None if the bytes aren't an image.
+    """
+    gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None
+    tracker = FaceTracker(engine).restore(tracker_state)
+    reduced = reduce_gray(gray)
+    shapes = tracker.landmarks(reduced)
+    identity = None
+    score = identity_score(reduced, shapes) if identity_cutoff < np.inf else None
+    if score is not None and score > identity_cutoff:
+        # Only the few frames that make the cut are decoded again in colour
+        frame = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        crop = face_crop(frame, shapes[0], frame.shape[1] / float(reduced.shape[1]))
+        identity = (score, cv2.imencode('.png', crop)[1].tobytes())
+    return {
+        'ears': ear_series(np.array(shapes)),
+        'tracker_state': tracker.state(),
+        'thumbnail': reduce_gray(gray, PRESCREEN_SIDE) if thumbnail else None,
+        'identity': identity
+    }
+
+def prescreen_frame_count(fps, seconds=PRESCREEN_SECONDS, max_frames=PRESCREEN_MAX_FRAMES):
+    """Frames of a clip at `fps` that the pre-screen looks at"""
+    return min(max_frames, max(3, int((fps or REFERENCE_FPS) * seconds)))
+
+def prescreen(filepath, seconds=PRESCREEN_SECONDS, max_frames=PRESCREEN_MAX_FRAMES, holdback=0):
+    """
+    Motion and flicker over the first `seconds` of a video. Clips too short to judge
+    pass. For a file that is still being written, pass holdback > 0: the result is
+    None until that many frames past the first `seconds` can be decoded.
+    Returns {'passed', 'reason', 'motion', 'flicker', 'frames'}
+    """
+    cap = cv2.VideoCapture(filepath)
+    try:
+        count = prescreen_frame_count(cap.get(cv2.CAP_PROP_FPS), seconds, max_frames)
+        grays = []
+        while len(grays) < count + holdback:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            grays.append(reduce_gray(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), PRESCREEN_SIDE))
+    finally:
+        cap.release()
+    if holdback and len(grays) < count + holdback:
+        return None
+    return prescreen_frames(grays[:count])
+
+def prescreen_frames(grays):
+    """prescreen() of grayscale frames already reduced to PRESCREEN_SIDE"""
+    if len(grays) < 3:
+        return {'passed': True, 'reason': None, 'motion': None, 'flicker': None, 'frames': len(grays)}
+    # Stream clients may change resolution mid-clip
+    size = grays[0].shape[::-1]
+    stack = np.stack([g if g.shape[::-1] == size else cv2.resize(g, size, interpolation=cv2.INTER_AREA)
+                      for g in grays]).astype(np.float32)
+    motion = float(np.percentile(np.abs(stack - stack[0]).max(axis=0), 99))
+    brightness = stack.mean(axis=(1, 2))
+    flicker = float(np.abs(np.diff(brightness, 2)).mean() / max(brightness.mean(), 1.0))
+    reason = None
+    if motion < PRESCREEN_MIN_MOTION:
+        reason = 'static'
+    elif flicker > PRESCREEN_MAX_FLICKER:
+        reason = 'flicker'
+    return {'passed': reason is None, 'reason': reason, 'motion': motion, 'flicker': flicker, 'frames': len(grays)}
+
+def prescreen_rejection(screen):
+    """The analysis result for a clip that failed prescreen()"""
+    return {'blinks': 0, 'face_found': False, 'frames_analysed': 0, 'detector_calls': 0, 'prescreen': screen}
+
+def analyse_video(engine, filepath, required_blinks=REQUIRED_BLINKS, max_frames=MAX_ANALYSED_FRAMES,
+                  max_seconds=MAX_ANALYSED_SECONDS, track=TRACK_FACES, sample_fps=SAMPLE_FPS,
+                  identity_frames=IDENTITY_FRAMES):
+    """
+    Count blinks in a liveness video, holding only the current frame in memory and
+    stopping as soon as required_blinks have been seen (the count reported is capped
+    there). The same pass selects and embeds the best frames for the identity check.
+    Returns {'blinks', 'face_found', 'frames_analysed', 'detector_calls', 'stride', 'embedding', 'identity_frames'}
+    """
+    landmarker = FaceTracker(engine) if track else engine
+    frames = FrameSampler(filepath, max_frames=max_frames, max_seconds=max_seconds, sample_fps=sample_fps)
+    blinks = BlinkCounter(consec_frames=frames.consec_frames)
+    buffer = LandmarkBuffer()
+    selector = FrameSelector(identity_frames)
+    face_found = False
+    try:
+        for gray in frames:
+            shapes = landmarker.landmarks(gray)
+            if len(shapes) == 0:
+                continue
+            face_found = True
+            selector.offer(frames.frame, frames.scale, gray, shapes, frames.position - 1)
+            for shape_np in shapes:
+                buffer.append(shape_np)
+            # EAR is computed for a window of frames at a time
+            if len(buffer) >= EAR_WINDOW and blinks.update(buffer.drain()) >= required_blinks:
+                break
+        blinks.update(buffer.drain())
+    finally:
+        frames.close()
+    # The last window may hold more blinks than were needed
+    blink_count = min(blinks.blinks, required_blinks)
+    candidates = selector.candidates(engine)
+    return {
+        'blinks': blink_count,
+        'face_found': face_found,
+        'frames_analysed': frames.frames_analysed,
+        'detector_calls': landmarker.detector_calls if track else frames.frames_analysed,
+        'stride': frames.stride,
+        'embedding': identity_embedding(candidates, identity_frames),
+        'identity_frames': len(candidates)
+    }
+
+# --- Parallel analysis of long clips ---
+#
+# Each worker extracts the EAR series for one frame range; the ranges' series are
+# concatenated in order and a single BlinkCounter runs over the result. A blink that
+# straddles two ranges is therefore counted exactly once, and the count is identical
+# to analysing the whole clip sequentially.
+
+def video_frame_count(filepath, max_frames=MAX_ANALYSED_FRAMES, max_seconds=MAX_ANALYSED_SECONDS):
+    """(frames to split across workers, hard frame limit); frames is 0 if the container doesn't say"""
+    cap = cv2.VideoCapture(filepath)
+    try:
+        limit = frame_limit(cap, max_frames, max_seconds)
+        count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+    finally:
+        cap.release()
+    return max(0, min(count, limit)), limit
+
+def split_ranges(total, chunks, last_end=None):
+    """[start, end) ranges covering total frames; the last one runs to last_end (or total)"""
+    chunks = max(1, min(chunks, total)) if total else 1
+    bounds = [round(i * total / chunks) for i in range(chunks + 1)]
+    ranges = [(bounds[i], bounds[i + 1]) for i in range(chunks)]
+    if last_end is not None:
+        ranges[-1] = (ranges[-1][0], max(last_end, ranges[-1][1]))
+    return ranges
+
+def extract_ear_series(engine, filepath, start=0, end=None, track=TRACK_FACES, sample_fps=SAMPLE_FPS,
+                       identity_frames=IDENTITY_FRAMES):
+    """
+    EAR samples for source frames [start, end) of a video, in order, one per detected face.
+    'positions' holds the source frame of each sample and 'end' the frame decoding
+    stopped at, which is short of `end` when the file is truncated. 'identity' holds
+    the range's FrameSelector candidates.
+    Returns {'ears', 'positions', 'identity', 'face_found', 'frames_analysed', 'detector_calls', 'consec_frames', 'end'}
+    """
+    landmarker = FaceTracker(engine) if track else engine
+    frames = FrameSampler(filepath, start, end, sample_fps=sample_fps)
+    buffer = LandmarkBuffer()
+    selector = FrameSelector(identity_frames)
+    parts = []
+    positions = []
+    face_found = False
+    try:
+        for gray in frames:
+            shapes = landmarker.landmarks(gray)
+            if len(shapes) == 0:
+                continue
+            face_found = True
+            selector.offer(frames.frame, frames.scale, gray, shapes, frames.position - 1)
+            positions.extend([frames.position - 1] * len(shapes))
+            for shape_np in shapes:
+                buffer.append(shape_np)
+            if len(buffer) >= EAR_WINDOW:
+                parts.append(buffer.drain())
+        parts.append(buffer.drain())
+    finally:
+        frames.close()
+    return {
+        'ears': np.concatenate(parts),
+        'positions': np.asarray(positions, dtype=np.int64),
+        'identity': selector.candidates(engine),
+        'face_found': face_found,
+        'frames_analysed': frames.frames_analysed,
+        'detector_calls': landmarker.detector_calls if track else frames.frames_analysed,
+        'consec_frames': frames.consec_frames,
+        'end': frames.position
+    }
+
+def truncate_ear_result(result, end):
+    """The part of an extract_ear_series() result that comes from source frames before `end`"""
+    keep = result['positions'] < end
+    kept = dict(result, ears=result['ears'][keep], positions=result['positions'][keep], end=min(end, result['end']),
+                identity=[c for c in result['identity'] if c[1] < end])
+    kept['face_found'] = bool(keep.any())
+    return kept
+
+def merge_ear_results(results, required_blinks=REQUIRED_BLINKS):
+    """
+    Combine per-range extract_ear_series() results, given in frame order. Ranges are
+    analysed in full, so blinks is capped at required_blinks to report what
+    analyse_video() does
+    """
+    ears = np.concatenate([r['ears'] for r in results]) if results else np.zeros(0)
+    consec_frames = results[0]['consec_frames'] if results else CONSEC_FRAMES
+    candidates = [c for r in results for c in r['identity']]
+    return {
+        'blinks': min(BlinkCounter(consec_frames=consec_frames).update(ears), required_blinks),
+        'embedding': identity_embedding(candidates),
+        'identity_frames': min(len(candidates), IDENTITY_FRAMES),
+        'face_found': any(r['face_found'] for r in results),
+        'frames_analysed': sum(r['frames_analysed'] for r in results),
+        'detector_calls': sum(r['detector_calls'] for r in results),
+        'chunks': len(results)
+    }
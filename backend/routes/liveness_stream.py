@@ -0,0 +1,215 @@
+"""
+Live liveness sessions: the app sends small camera frames as they are captured
+instead of recording and uploading a video.
+
+    POST /liveness/stream/start          email, fps       -> {'session_id', ...}
+    POST /liveness/stream/<id>/frame     seq, frame (JPEG file or raw body)
+    POST /liveness/stream/<id>/end       give up and take the verdict for the frames so far
+
+Each frame returns the running blink count with 'liveness': null until a verdict is
+reached. The verdict comes back, and is logged like a /liveness one, on the frame
+where the REQUIRED_BLINKS-th blink completes, or as a failure once MAX_ANALYSED_SECONDS
+of frames have been sent without it, or as a rejection as soon as the first second of
+frames fails the replay pre-screen. Blink state, the pre-screen thumbnails and the
+face crops kept for the identity check live in this web worker; the per-frame
+landmark work and the final embedding run in the vision workers.
+"""
+from flask import Blueprint, request, jsonify
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import TimeoutError as VisionTimeoutError
+from models import User
+from routes import liveness, metrics, vision_workers
+from routes.face import record_liveness_result
+
+liveness_stream_bp = Blueprint('liveness_stream', __name__)
+
+# Concurrent sessions per web worker process; more are refused with 429
+MAX_STREAM_SESSIONS = int(os.environ.get('LIVENESS_STREAM_MAX_SESSIONS', '32'))
+# Sessions that receive no frame for this long are dropped
+SESSION_TTL = float(os.environ.get('LIVENESS_STREAM_TTL', '30'))
+MAX_FRAME_BYTES = int(os.environ.get('LIVENESS_STREAM_MAX_FRAME_BYTES', str(512 * 2**10)))
+
+FRAME_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000)
+
+frame_ms = metrics.histogram('liveness_stream_frame_ms', FRAME_BUCKETS_MS)
+active_sessions = metrics.gauge('liveness_stream_sessions')
+rejected_sessions = metrics.counter('liveness_stream_rejected')
+expired_sessions = metrics.counter('liveness_stream_expired')
+
+class StreamSession:
+    def __init__(self, user_id, fps):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.fps = fps
+        self.blinks = liveness.BlinkCounter(consec_frames=liveness.consec_frames_at(fps))
+        self.max_frames = int(liveness.MAX_ANALYSED_SECONDS * fps)
+        self.tracker_state = None
+        # Thumbnails of the first frames for the replay pre-screen, then its outcome
+        self.prescreen_frames = liveness.prescreen_frame_count(fps) if liveness.PRESCREEN else 0
+        self.thumbnails = []
+        self.screen = None
+        self.selector = liveness.FrameSelector()
+        self.face_found = False
+        self.frames = 0
+        self.last_seq = -1
+        self.finished = False
+        self.touched_at = time.time()
+        self.lock = threading.Lock()
+
+    @property
+    def screening(self):
+        return self.screen is None and len(self.thumbnails) < self.prescreen_frames
+
+    def finish_prescreen(self):
+        """Run the pre-screen on the thumbnails received so far; False if the stream failed it"""
+        if self.screen is None and self.prescreen_frames:
+            self.screen = liveness.prescreen_frames(self.thumbnails)
+            self.thumbnails = []
+            if not self.screen['passed']:
+                vision_workers.prescreen_rejections.inc()
+        return self.screen is None or self.screen['passed']
+
+    def result(self):
+        """The analysis result for the frames so far, like vision_workers.analyse_liveness() returns"""
+        if not self.finish_prescreen():
+            return liveness.prescreen_rejection(self.screen)
+        embedding, identity_frames = None, 0
+        if self.selector.heap:
+            embedding, identity_frames = vision_workers.run(vision_workers.liveness_identity_embedding,
+                                                            self.selector.heap)
+        return {
+            'blinks': self.blinks.blinks,
+            'face_found': self.face_found,
+            'frames_analysed': self.frames,
+            'detector_calls': (self.tracker_state or {}).get('detector_calls', 0),
+            'prescreen': self.screen,
+            'embedding': embedding,
+            'identity_frames': identity_frames
+        }
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def _expire_sessions():
+    now = time.time()
+    with _sessions_lock:
+        for session_id in [k for k, s in _sessions.items() if now - s.touched_at > SESSION_TTL]:
+            del _sessions[session_id]
+            expired_sessions.inc()
+        active_sessions.set(len(_sessions))
+
+def _pop_session(session_id):
+    with _sessions_lock:
+        session = _sessions.pop(session_id, None)
+        active_sessions.set(len(_sessions))
+    return session
+
+def _get_session(session_id):
+    _expire_sessions()
+    with _sessions_lock:
+        session = _sessions.get(session_id)
+    if session is not None:
+        session.touched_at = time.time()
+    return session
+
+def _finish(session):
+    try:
+        result = session.result()
+    except VisionTimeoutError:
+        # The session stays open, so the client can end it again
+        print("Error: Timed out waiting for a vision worker")
+        return jsonify({'error': 'Liveness service is busy, please retry'}), 503
+    session.finished = True
+    _pop_session(session.id)
+    user = User.query.get(session.user_id)
+    if user is None:
+        return jsonify({'error': 'User not found'}), 404
+    return record_liveness_result(user, result)
+
+@liveness_stream_bp.route('/liveness/stream/start', methods=['POST'])
+def start_stream():
+    email = request.form.get('email')
+    if not email:
+        return jsonify({'error': 'Email is required'}), 400
+    user = User.query.filter_by(email=email).first()
+    if not user or not user.reference_image:
+        return jsonify({'error': 'Reference image not found for user'}), 404
+    fps = request.form.get('fps', default=liveness.SAMPLE_FPS, type=float)
+    if not fps or fps <= 0 or fps > 60:
+        return jsonify({'error': 'fps must be between 0 and 60'}), 400
+    _expire_sessions()
+    session = StreamSession(user.id, fps)
+    with _sessions_lock:
+        if len(_sessions) >= MAX_STREAM_SESSIONS:
+            rejected_sessions.inc()
+            return jsonify({'error': 'Too many liveness sessions, please retry'}), 429
+        _sessions[session.id] = session
+        active_sessions.set(len(_sessions))
+    return jsonify({
+        'session_id': session.id,
+        'max_frames': session.max_frames,
+        'ttl_seconds': SESSION_TTL,
+        'max_side': liveness.ANALYSIS_MAX_SIDE
+    }), 201
+
+@liveness_stream_bp.route('/liveness/stream/<session_id>/frame', methods=['POST'])
+def stream_frame(session_id):
+    session = _get_session(session_id)
+    if session is None:
+        return jsonify({'error': 'Session not found or expired'}), 404
+    frame = request.files.get('frame')
+    image_bytes = frame.read() if frame else request.get_data()
+    if not image_bytes:
+        return jsonify({'error': 'No frame uploaded'}), 400
+    if len(image_bytes) > MAX_FRAME_BYTES:
+        return jsonify({'error': f'Frames are limited to {MAX_FRAME_BYTES} bytes'}), 413
+    seq = request.form.get('seq', type=int)
+
+    # Frames of a session are analysed one at a time and in order
+    with session.lock:
+        if session.finished:
+            return jsonify({'error': 'Session has already ended'}), 409
+        if seq is not None and seq <= session.last_seq:
+            # A retry of a frame that was already counted
+            return jsonify({'liveness': None, 'blinks': session.blinks.blinks, 'seq': session.last_seq}), 200
+        started = time.perf_counter()
+        try:
+            analysed = vision_workers.run(vision_workers.liveness_frame_ears, image_bytes, session.tracker_state,
+                                          session.screening, session.selector.cutoff)
+        except VisionTimeoutError:
+            print("Error: Timed out waiting for a vision worker")
+            return jsonify({'error': 'Liveness service is busy, please retry'}), 503
+        frame_ms.observe((time.perf_counter() - started) * 1000.0)
+        if analysed is None:
+            return jsonify({'error': 'Frame is not an image'}), 400
+        session.tracker_state = analysed['tracker_state']
+        session.frames += 1
+        if seq is not None:
+            session.last_seq = seq
+        if analysed['thumbnail'] is not None:
+            session.thumbnails.append(analysed['thumbnail'])
+            if len(session.thumbnails) >= session.prescreen_frames and not session.finish_prescreen():
+                return _finish(session)
+        if analysed['identity'] is not None:
+            score, crop_png = analysed['identity']
+            session.selector.keep(score, session.frames - 1, crop_png)
+        ears = analysed['ears']
+        if len(ears):
+            session.face_found = True
+        blink_count = session.blinks.update(ears)
+        if blink_count >= liveness.REQUIRED_BLINKS or session.frames >= session.max_frames:
+            return _finish(session)
+    return jsonify({'liveness': None, 'blinks': blink_count, 'seq': session.last_seq}), 200
+
+@liveness_stream_bp.route('/liveness/stream/<session_id>/end', methods=['POST'])
+def end_stream(session_id):
+    session = _get_session(session_id)
+    if session is None:
+        return jsonify({'error': 'Session not found or expired'}), 404
+    with session.lock:
+        if session.finished:
+            return jsonify({'error': 'Session has already ended'}), 409
+        return _finish(session)
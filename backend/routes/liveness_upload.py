@@ -0,0 +1,276 @@
+"""
+Resumable chunked upload of liveness videos.
+
+    POST  /liveness/upload/init               email, size            -> {'upload_id', 'offset'}
+    PATCH /liveness/upload/<id>               Upload-Offset header, raw chunk body -> {'offset'}
+    GET   /liveness/upload/<id>                                      -> {'offset', 'size', ...}
+    POST  /liveness/upload/<id>/finalize                             -> same response as /liveness
+
+A client that loses its connection asks for the current offset and resends from
+there; bytes it sends again are skipped. While chunks arrive, the frames that can
+already be decoded are analysed in the background, so finalize usually only has the
+last few frames left. That needs the container index at the front of the file
+(MP4 "faststart", fragmented MP4 or WebM); otherwise nothing can be decoded before
+the upload completes and finalize analyses the whole clip, as /liveness does.
+Background analysis only starts once the first second of the clip has passed the
+replay pre-screen.
+
+The partial upload is kept in plaintext only in DECRYPTED_VIDEO_DIR (tmpfs where
+available), like decrypted videos are; the stored copy is encrypted at finalize.
+Each session reserves its declared size (MAX_UPLOAD_BYTES if it gave none) there
+when it starts. Sessions that would take more than MAX_SESSIONS or
+MAX_PLAINTEXT_BYTES in this process are refused with 429.
+"""
+from flask import Blueprint, request, jsonify
+import os
+import tempfile
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as VisionTimeoutError
+from models import User
+from routes import liveness, metrics, vision_workers
+from routes.face import DECRYPTED_VIDEO_DIR, record_liveness_result, store_liveness_video
+
+liveness_upload_bp = Blueprint('liveness_upload', __name__)
+
+MAX_UPLOAD_BYTES = int(os.environ.get('LIVENESS_UPLOAD_MAX_BYTES', str(100 * 2**20)))
+MAX_CHUNK_BYTES = int(os.environ.get('LIVENESS_UPLOAD_MAX_CHUNK_BYTES', str(8 * 2**20)))
+SESSION_TTL = float(os.environ.get('LIVENESS_UPLOAD_TTL', '3600'))
+# Open sessions per web worker process, and the plaintext bytes they may reserve in DECRYPTED_VIDEO_DIR
+MAX_SESSIONS = int(os.environ.get('LIVENESS_UPLOAD_MAX_SESSIONS', '16'))
+MAX_PLAINTEXT_BYTES = int(os.environ.get('LIVENESS_UPLOAD_MAX_PLAINTEXT_BYTES', str(512 * 2**20)))
+# Background analysis runs again once this many new bytes have arrived
+ANALYSE_EVERY_BYTES = int(os.environ.get('LIVENESS_UPLOAD_ANALYSE_EVERY_BYTES', str(512 * 2**10)))
+# Frames just before the end of a partial file may be decoded from incomplete data
+HOLDBACK_FRAMES = 8
+
+VERDICT_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+verdict_ms = metrics.histogram('liveness_upload_last_byte_to_verdict_ms', VERDICT_BUCKETS_MS)
+received_bytes = metrics.counter('liveness_upload_bytes')
+retransmitted_bytes = metrics.counter('liveness_upload_retransmitted_bytes')
+open_sessions = metrics.gauge('liveness_upload_sessions')
+reserved_bytes = metrics.gauge('liveness_upload_reserved_bytes')
+rejected_sessions = metrics.counter('liveness_upload_rejected')
+
+analysis_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='liveness-upload')
+
+class UploadSession:
+    def __init__(self, user_id, size):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.size = size
+        self.reserved = size or MAX_UPLOAD_BYTES
+        fd, self.path = tempfile.mkstemp(dir=DECRYPTED_VIDEO_DIR, prefix=f'liveness_upload_{self.id}_', suffix='.part')
+        os.close(fd)
+        self.lock = threading.Lock()
+        self.touched_at = time.time()
+        self.last_byte_at = None
+        # extract_ear_series() results for source frames [0, analysed_upto), in order
+        self.parts = []
+        self.analysed_upto = 0
+        self.analysed_bytes = 0
+        # liveness.prescreen() of the first second, once enough of it has arrived
+        self.screen = None
+        self.pending = None
+        self.finalizing = False
+
+    @property
+    def rejected(self):
+        return self.screen is not None and not self.screen['passed']
+
+    @property
+    def offset(self):
+        return os.path.getsize(self.path)
+
+    def blinks_so_far(self):
+        return liveness.merge_ear_results(self.parts)['blinks'] if self.parts else 0
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_reserved = 0
+
+def _drop(session):
+    global _reserved
+    with _sessions_lock:
+        if _sessions.pop(session.id, None) is not None:
+            _reserved -= session.reserved
+            open_sessions.set(len(_sessions))
+            reserved_bytes.set(_reserved)
+
+def _discard(session):
+    """Drop a session along with its partial upload"""
+    _drop(session)
+    if os.path.exists(session.path):
+        os.remove(session.path)
+
+def _open_session(user_id, size):
+    """A new UploadSession, or None if this process is at MAX_SESSIONS or MAX_PLAINTEXT_BYTES"""
+    global _reserved
+    with _sessions_lock:
+        if len(_sessions) >= MAX_SESSIONS or _reserved + (size or MAX_UPLOAD_BYTES) > MAX_PLAINTEXT_BYTES:
+            rejected_sessions.inc()
+            return None
+        session = UploadSession(user_id, size)
+        _sessions[session.id] = session
+        _reserved += session.reserved
+        open_sessions.set(len(_sessions))
+        reserved_bytes.set(_reserved)
+    return session
+
+@liveness_upload_bp.before_request
+def _expire_sessions():
+    now = time.time()
+    with _sessions_lock:
+        expired = [s for s in _sessions.values() if now - s.touched_at > SESSION_TTL]
+    for session in expired:
+        _discard(session)
+
+def _get_session(upload_id):
+    with _sessions_lock:
+        session = _sessions.get(upload_id)
+    if session is not None:
+        session.touched_at = time.time()
+    return session
+
+def _analyse_available(session):
+    """Analyse the frames that have become decodable since the last run"""
+    try:
+        if liveness.PRESCREEN and session.screen is None:
+            session.screen = vision_workers.prescreen(session.path, holdback=HOLDBACK_FRAMES)
+            if session.screen is None or session.rejected:
+                # Not enough of the clip yet, or a replay that finalize will reject
+                return
+        result = vision_workers.run(vision_workers.liveness_ear_range, session.path, session.analysed_upto, None)
+    except Exception as e:
+        # Picked up again on the next chunk or at finalize
+        print(f"Error analysing partial liveness upload: {str(e)}")
+        return
+    stable = result['end'] - HOLDBACK_FRAMES
+    if stable > session.analysed_upto:
+        session.parts.append(liveness.truncate_ear_result(result, stable))
+        session.analysed_upto = stable
+
+def _schedule_analysis(session):
+    with session.lock:
+        if session.finalizing or (session.pending is not None and not session.pending.done()):
+            return
+        if session.offset - session.analysed_bytes < ANALYSE_EVERY_BYTES:
+            return
+        if session.rejected or session.blinks_so_far() >= liveness.REQUIRED_BLINKS:
+            return
+        session.analysed_bytes = session.offset
+        session.pending = analysis_executor.submit(_analyse_available, session)
+
+def _store_video(session, user):
+    with open(session.path, 'rb') as f:
+        store_liveness_video(f, user.id)
+    os.remove(session.path)
+    _drop(session)
+
+@liveness_upload_bp.route('/liveness/upload/init', methods=['POST'])
+def init_upload():
+    email = request.form.get('email')
+    if not email:
+        return jsonify({'error': 'Email is required'}), 400
+    user = User.query.filter_by(email=email).first()
+    if not user or not user.reference_image:
+        return jsonify({'error': 'Reference image not found for user'}), 404
+    size = request.form.get('size', type=int)
+    if size is not None and (size <= 0 or size > MAX_UPLOAD_BYTES):
+        return jsonify({'error': f'size must be between 1 and {MAX_UPLOAD_BYTES} bytes'}), 413
+    session = _open_session(user.id, size)
+    if session is None:
+        return jsonify({'error': 'Too many liveness uploads in progress, please retry'}), 429
+    return jsonify({'upload_id': session.id, 'offset': 0, 'max_chunk_bytes': MAX_CHUNK_BYTES}), 201
+
+@liveness_upload_bp.route('/liveness/upload/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    session = _get_session(upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify({
+        'upload_id': session.id,
+        'offset': session.offset,
+        'size': session.size,
+        'frames_analysed': session.analysed_upto
+    }), 200
+
+@liveness_upload_bp.route('/liveness/upload/<upload_id>', methods=['PATCH'])
+def append_chunk(upload_id):
+    session = _get_session(upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None or offset < 0:
+        return jsonify({'error': 'Upload-Offset header is required'}), 400
+    if request.content_length is not None and request.content_length > MAX_CHUNK_BYTES:
+        return jsonify({'error': f'Chunks are limited to {MAX_CHUNK_BYTES} bytes'}), 413
+    data = request.get_data()
+    with session.lock:
+        if session.finalizing:
+            return jsonify({'error': 'Upload is being finalized'}), 409
+        current = session.offset
+        if offset > current:
+            # A chunk went missing; the client resends from `offset`
+            return jsonify({'error': 'Offset is ahead of the upload', 'offset': current}), 409
+        overlap = min(current - offset, len(data))
+        if overlap:
+            retransmitted_bytes.inc(overlap)
+        new_data = data[overlap:]
+        limit = session.size or MAX_UPLOAD_BYTES
+        if current + len(new_data) > limit:
+            return jsonify({'error': 'Upload exceeds its size', 'offset': current}), 413
+        if new_data:
+            with open(session.path, 'ab') as f:
+                f.write(new_data)
+            received_bytes.inc(len(new_data))
+            session.last_byte_at = time.perf_counter()
+        current += len(new_data)
+    _schedule_analysis(session)
+    return jsonify({'offset': current}), 200
+
+@liveness_upload_bp.route('/liveness/upload/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    session = _get_session(upload_id)
+    if session is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    with session.lock:
+        if session.finalizing:
+            return jsonify({'error': 'Upload is already being finalized'}), 409
+        if session.size is not None and session.offset < session.size:
+            return jsonify({'error': 'Upload is incomplete', 'offset': session.offset}), 409
+        if session.offset == 0:
+            return jsonify({'error': 'No video uploaded'}), 400
+        session.finalizing = True
+        pending = session.pending
+    user = User.query.get(session.user_id)
+    if user is None:
+        _discard(session)
+        return jsonify({'error': 'User not found'}), 404
+
+    # The .part file stays in plaintext (in DECRYPTED_VIDEO_DIR) while it is analysed;
+    # after that only the encrypted copy is kept
+    try:
+        if pending is not None:
+            pending.result(timeout=vision_workers.VISION_TASK_TIMEOUT)
+        if session.screen is None:
+            session.screen = vision_workers.prescreen(session.path)
+        if session.rejected:
+            _store_video(session, user)
+            return record_liveness_result(user, liveness.prescreen_rejection(session.screen))
+        if session.blinks_so_far() < liveness.REQUIRED_BLINKS:
+            session.parts.append(vision_workers.run(vision_workers.liveness_ear_range,
+                                                    session.path, session.analysed_upto, None))
+    except VisionTimeoutError:
+        print("Error: Timed out waiting for a vision worker")
+        # The client may finalize again
+        with session.lock:
+            session.finalizing = False
+        return jsonify({'error': 'Liveness service is busy, please retry'}), 503
+    result = liveness.merge_ear_results(session.parts)
+    if session.last_byte_at is not None:
+        verdict_ms.observe((time.perf_counter() - session.last_byte_at) * 1000.0)
+    _store_video(session, user)
+    return record_liveness_result(user, result)
@@ -0,0 +1,169 @@
+from flask import Blueprint, jsonify
+from collections import deque
+import bisect
+import threading
+
+metrics_bp = Blueprint('metrics', __name__)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self):
+        self._value = 0
+        self._reported = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def snapshot(self):
+        return self._value
+
+    def take_delta(self):
+        """Change since the last take_delta(), or None if there is none"""
+        with self._lock:
+            delta = self._value - self._reported
+            self._reported = self._value
+        return delta or None
+
+    def merge(self, delta):
+        self.inc(delta)
+
+class Gauge(Counter):
+    """
+    A value that goes up and down. Merged as a change in value, so a gauge set by
+    each worker process adds up to the total across them in the web process
+    """
+    kind = 'gauge'
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+class Histogram:
+    """Cumulative bucket counts plus percentiles over the most recent samples"""
+
+    kind = 'histogram'
+
+    def __init__(self, buckets, window=2048):
+        self.buckets = sorted(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._reported = ([0] * len(self._counts), 0, 0.0)
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._count += 1
+            self._sum += value
+            self._recent.append(value)
+
+    def take_delta(self):
+        """Observations since the last take_delta() (the recent ones only up to the window), or None"""
+        with self._lock:
+            counts, count, total = self._reported
+            new = self._count - count
+            if new == 0:
+                return None
+            delta = {
+                'buckets': self.buckets,
+                'counts': [n - reported for n, reported in zip(self._counts, counts)],
+                'count': new,
+                'sum': self._sum - total,
+                'recent': list(self._recent)[-new:]
+            }
+            self._reported = (list(self._counts), self._count, self._sum)
+        return delta
+
+    def merge(self, delta):
+        with self._lock:
+            for i, n in enumerate(delta['counts']):
+                self._counts[i] += n
+            self._count += delta['count']
+            self._sum += delta['sum']
+            self._recent.extend(delta['recent'])
+
+    def snapshot(self):
+        with self._lock:
+            recent = sorted(self._recent)
+            counts = list(self._counts)
+            count, total = self._count, self._sum
+
+        def percentile(p):
+            if not recent:
+                return None
+            return recent[min(len(recent) - 1, int(p * len(recent)))]
+
+        buckets = {}
+        running = 0
+        for bound, n in zip(self.buckets + ['+Inf'], counts):
+            running += n
+            buckets[str(bound)] = running
+        return {
+            'count': count,
+            'sum': total,
+            'buckets': buckets,
+            'p50': percentile(0.50),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99)
+        }
+
+def _get_or_create(name, factory):
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = factory()
+        return _registry[name]
+
+def counter(name):
+    return _get_or_create(name, Counter)
+
+def gauge(name):
+    return _get_or_create(name, Gauge)
+
+def histogram(name, buckets):
+    return _get_or_create(name, lambda: Histogram(buckets))
+
+def collect():
+    """
+    Changes to this process's metrics since the last collect(), as a picklable dict
+    for merge() in another process. Vision worker processes send theirs back with
+    each task result (routes/vision_workers.py)
+    """
+    with _registry_lock:
+        items = list(_registry.items())
+    changes = {}
+    for name, metric in items:
+        delta = metric.take_delta()
+        if delta is not None:
+            changes[name] = (metric.kind, delta)
+    return changes
+
+def merge(changes):
+    """Add the result of collect() in another process to this process's metrics"""
+    for name, (kind, delta) in changes.items():
+        if kind == 'histogram':
+            metric = histogram(name, delta['buckets'])
+        elif kind == 'gauge':
+            metric = gauge(name)
+        else:
+            metric = counter(name)
+        metric.merge(delta)
+
+def snapshot():
+    with _registry_lock:
+        items = list(_registry.items())
+    return {name: metric.snapshot() for name, metric in sorted(items)}
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    return jsonify(snapshot()), 200
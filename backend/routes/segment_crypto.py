@@ -0,0 +1,174 @@
+"""
+Segmented authenticated encryption for stored images and videos.
+
+    header    magic 'SPGC' | version u8 | segment size u32 | nonce prefix (8 random bytes)
+    segments  AES-256-GCM of each segment_size block of plaintext, with its 16-byte tag
+
+Segment i uses the nonce prefix || u32(i) and authenticates the header plus a
+last-segment flag, so segments can't be reordered, swapped between files, dropped or
+truncated away unnoticed. Unlike Fernet there is no base64 (ciphertext is the
+plaintext size plus 16 bytes per 64 KiB), and files are encrypted and decrypted a
+segment at a time instead of whole in memory.
+"""
+import os
+import struct
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+MAGIC = b'SPGC'
+VERSION = 1
+SEGMENT_SIZE = 64 * 1024
+TAG_SIZE = 16
+HEADER = struct.Struct('>4sBI8s')
+
+class DecryptionError(Exception):
+    pass
+
+def is_encrypted(head):
+    """Whether data (or its first bytes) is in this format rather than e.g. Fernet"""
+    return bytes(head[:len(MAGIC)]) == MAGIC
+
+def _nonce(prefix, index):
+    return prefix + struct.pack('>I', index)
+
+def _aad(header, last):
+    return header + (b'\x01' if last else b'\x00')
+
+def _new_header(segment_size):
+    return HEADER.pack(MAGIC, VERSION, segment_size, os.urandom(8))
+
+def _parse_header(header):
+    if len(header) < HEADER.size:
+        raise DecryptionError('Truncated header')
+    magic, version, segment_size, prefix = HEADER.unpack(bytes(header[:HEADER.size]))
+    if magic != MAGIC or version != VERSION or segment_size <= 0:
+        raise DecryptionError('Not a segment-encrypted file')
+    return segment_size, prefix
+
+class EncryptingWriter:
+    """File-like object that encrypts what is written to it into `fileobj`, a segment at a time"""
+
+    def __init__(self, fileobj, key, segment_size=SEGMENT_SIZE):
+        self.fileobj = fileobj
+        self.aead = AESGCM(key)
+        self.segment_size = segment_size
+        self.header = _new_header(segment_size)
+        self.prefix = self.header[-8:]
+        self.buffer = bytearray()
+        self.index = 0
+        self.closed = False
+        fileobj.write(self.header)
+
+    def write(self, data):
+        self.buffer += data
+        # Hold back the tail: only close() knows which segment is the last
+        while len(self.buffer) > self.segment_size:
+            self._emit(bytes(self.buffer[:self.segment_size]), last=False)
+            del self.buffer[:self.segment_size]
+        return len(data)
+
+    def _emit(self, plaintext, last):
+        self.fileobj.write(self.aead.encrypt(_nonce(self.prefix, self.index), plaintext, _aad(self.header, last)))
+        self.index += 1
+
+    def close(self):
+        if not self.closed:
+            self._emit(bytes(self.buffer), last=True)
+            self.buffer = bytearray()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # An interrupted write leaves no final segment, so the file won't decrypt
+        if exc_type is None:
+            self.close()
+
+def encrypt(data, key, segment_size=SEGMENT_SIZE):
+    """Encrypt a whole buffer"""
+    aead = AESGCM(key)
+    header = _new_header(segment_size)
+    prefix = header[-8:]
+    view = memoryview(data)
+    count = max(1, -(-len(view) // segment_size))
+    parts = [header]
+    for index in range(count):
+        segment = view[index * segment_size:(index + 1) * segment_size]
+        parts.append(aead.encrypt(_nonce(prefix, index), segment, _aad(header, index == count - 1)))
+    return b''.join(parts)
+
+def decrypt(data, key):
+    """Decrypt a whole buffer into a single preallocated bytearray"""
+    view = memoryview(data)
+    segment_size, prefix = _parse_header(view)
+    header = bytes(view[:HEADER.size])
+    body = view[HEADER.size:]
+    stride = segment_size + TAG_SIZE
+    count = max(1, -(-len(body) // stride))
+    out = bytearray(max(0, len(body) - count * TAG_SIZE))
+    aead = AESGCM(key)
+    position = 0
+    for index in range(count):
+        try:
+            plaintext = aead.decrypt(_nonce(prefix, index), body[index * stride:(index + 1) * stride],
+                                     _aad(header, index == count - 1))
+        except InvalidTag:
+            raise DecryptionError(f'Segment {index} failed authentication')
+        out[position:position + len(plaintext)] = plaintext
+        position += len(plaintext)
+    return out
+
+def iter_decrypt(fileobj, key):
+    """Plaintext segments of an encrypted file object, holding two segments in memory at most"""
+    header = fileobj.read(HEADER.size)
+    segment_size, prefix = _parse_header(header)
+    aead = AESGCM(key)
+    stride = segment_size + TAG_SIZE
+    index = 0
+    segment = fileobj.read(stride)
+    while True:
+        # Read ahead to know whether this is the last segment
+        following = fileobj.read(stride)
+        try:
+            yield aead.decrypt(_nonce(prefix, index), segment, _aad(header, not following))
+        except InvalidTag:
+            raise DecryptionError(f'Segment {index} failed authentication')
+        if not following:
+            return
+        segment = following
+        index += 1
+
+def decrypt_file(path, key):
+    """Decrypt a file into a single preallocated bytearray without reading the ciphertext whole"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        segment_size, _ = _parse_header(f.read(HEADER.size))
+        body = size - HEADER.size
+        out = bytearray(max(0, body - max(1, -(-body // (segment_size + TAG_SIZE))) * TAG_SIZE))
+        f.seek(0)
+        position = 0
+        for plaintext in iter_decrypt(f, key):
+            out[position:position + len(plaintext)] = plaintext
+            position += len(plaintext)
+    return out
+
+def encrypt_stream(src, dst, key, segment_size=SEGMENT_SIZE):
+    """Encrypt everything readable from file object src into file object dst"""
+    with EncryptingWriter(dst, key, segment_size) as writer:
+        while True:
+            chunk = src.read(segment_size)
+            if not chunk:
+                break
+            writer.write(chunk)
+
+def decrypt_stream(src, dst, key):
+    """Decrypt file object src into file object dst"""
+    for plaintext in iter_decrypt(src, key):
+        dst.write(plaintext)
+
+def encrypted_size(plaintext_size, segment_size=SEGMENT_SIZE):
+    return HEADER.size + plaintext_size + max(1, -(-plaintext_size // segment_size)) * TAG_SIZE
+
+__all__ = ['DecryptionError', 'EncryptingWriter', 'encrypt', 'decrypt', 'iter_decrypt', 'decrypt_file',
+           'encrypt_stream', 'decrypt_stream', 'encrypted_size', 'is_encrypted', 'SEGMENT_SIZE']
@@ -0,0 +1,100 @@
+"""
+Short-lived memo of /verify responses, so a client retrying after a timeout gets the
+original result instead of another run of the pipeline and another set of
+ActivityLog / ManualReview rows.
+
+Responses are keyed by the user, the identities of the reference and current images
+(derived from their content, see routes/face.py image_identity()) and the model
+version, and kept for VERIFY_CACHE_TTL seconds. A request for a key that is still
+being computed waits for that result. Requests can also carry an Idempotency-Key
+header: the response is then kept under that key for IDEMPOTENCY_KEY_TTL, even
+across a model change, and reusing the key for a different request is an error.
+State is per web worker process.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import TimeoutError as VisionTimeoutError
+from routes import metrics
+
+class IdempotencyConflict(Exception):
+    pass
+
+class _ExpiringMap:
+    """Insertion-ordered map whose entries expire after a fixed TTL, oldest first"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= now:
+            return None
+        return entry[1]
+
+    def put(self, key, value, now):
+        self._entries.pop(key, None)
+        self._entries[key] = (now + self.ttl, value)
+        while self._entries and (len(self._entries) > self.max_entries or next(iter(self._entries.values()))[0] <= now):
+            self._entries.popitem(last=False)
+
+class VerificationCache:
+    def __init__(self, ttl, idempotency_ttl, max_entries=10000):
+        self._results = _ExpiringMap(ttl, max_entries)
+        # (user_id, Idempotency-Key) -> (images, response)
+        self._idempotent = _ExpiringMap(idempotency_ttl, max_entries)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = metrics.counter('verification_cache_hits')
+        self.misses = metrics.counter('verification_cache_misses')
+        self.waits = metrics.counter('verification_cache_inflight_waits')
+        self.replays = metrics.counter('verification_idempotent_replays')
+
+    def acquire(self, user_id, images, model_version, idempotency_key=None, timeout=None):
+        """
+        The stored response for a user's request comparing `images` (a tuple of image
+        identities) under a model version, or None, in which case the caller computes
+        it and must call release() whatever happens. Raises IdempotencyConflict if the
+        idempotency key was used for a different request, and VisionTimeoutError if an
+        identical request in progress doesn't finish within timeout.
+        """
+        key = (user_id, images, model_version)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if idempotency_key is not None:
+                    previous = self._idempotent.get((user_id, idempotency_key), now)
+                    if previous is not None:
+                        if previous[0] != images:
+                            raise IdempotencyConflict(idempotency_key)
+                        self.replays.inc()
+                        return previous[1]
+                response = self._results.get(key, now)
+                if response is not None:
+                    self.hits.inc()
+                    return response
+                event = self._inflight.get(key)
+                if event is None:
+                    self._inflight[key] = threading.Event()
+                    self.misses.inc()
+                    return None
+            self.waits.inc()
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if not event.wait(remaining):
+                raise VisionTimeoutError('Timed out waiting for an identical verification')
+
+    def release(self, user_id, images, model_version, response, idempotency_key=None):
+        """Store the response of an acquired request, or pass None if it should not be reused"""
+        key = (user_id, images, model_version)
+        with self._lock:
+            now = time.monotonic()
+            if response is not None:
+                self._results.put(key, response, now)
+                if idempotency_key is not None:
+                    self._idempotent.put((user_id, idempotency_key), (images, response), now)
+            event = self._inflight.pop(key, None)
+        if event is not None:
+            event.set()
@@ -0,0 +1,215 @@
+"""
+Runs the CPU-bound face work (decode, detection, landmarks, embeddings) either in
+the web process or in a pool of worker processes that each own a FaceEngine.
+
+With VISION_WORKERS=0 everything runs in-process as before. With VISION_WORKERS>0
+the web worker only decrypts bytes and waits for the result, so auth and admin
+requests are never stuck behind a long liveness video. Metrics recorded in a worker
+(interpreter pool, embedding batches) come back with each task result and are merged
+into the web process's /metrics; those of a task that timed out are lost.
+
+If a worker dies (a crash in dlib or TFLite, the OOM killer), the pool is replaced
+and the tasks that were running fail with VisionWorkerCrashed, which routes answer
+with 503 like a timeout.
+"""
+import os
+import time
+import threading
+import multiprocessing
+from contextlib import contextmanager
+import cv2
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from routes.face_engine import FaceEngine
+from routes import liveness, metrics
+
+def _worker_count(value):
+    return (os.cpu_count() or 1) if value == 'auto' else int(value)
+
+# 'auto' starts one worker per CPU core; long liveness clips are split across all of them
+VISION_WORKERS = _worker_count(os.environ.get('VISION_WORKERS', '0'))
+VISION_TASK_TIMEOUT = float(os.environ.get('VISION_TASK_TIMEOUT', '60'))
+# Clips with at least this many frames per worker are split across all workers
+LIVENESS_MIN_FRAMES_PER_CHUNK = int(os.environ.get('LIVENESS_MIN_FRAMES_PER_CHUNK', '90'))
+
+prescreen_rejections = metrics.counter('liveness_prescreen_rejected')
+
+_engine = None
+_engine_config = None
+_executor = None
+_executor_lock = threading.Lock()
+_workers = 0
+
+class VisionWorkerCrashed(TimeoutError):
+    """A worker process died while the task was queued or running; the pool has been restarted"""
+
+def _build_engine(config):
+    engine = FaceEngine(config['model_path'], config['predictor_path'],
+                        pool_size=config['pool_size'],
+                        num_threads=config['num_threads'],
+                        checkout_timeout=config['checkout_timeout'])
+    engine.warm_up()
+    if config['batch_window_ms'] > 0:
+        engine.start_batching(config['batch_window_ms'], config['max_batch'])
+    return engine
+
+def _init_worker(config):
+    global _engine
+    _engine = _build_engine(config)
+
+def configure(config):
+    """Set the engine configuration; nothing is loaded until start() or the first get_engine()"""
+    global _engine_config
+    _engine_config = config
+
+def start(workers=VISION_WORKERS):
+    """
+    Load the models in-process, or start `workers` processes that each load them.
+    Called once by the server process at startup, never at import time: spawned
+    workers re-import the entry point and would start pools of their own
+    """
+    global _engine, _executor, _workers
+    _workers = workers
+    if workers > 0:
+        _executor = _new_pool()
+    else:
+        _engine = _build_engine(_engine_config)
+
+def _new_pool():
+    # A single-threaded worker never has concurrent faces to batch, and the cores
+    # are shared between the workers rather than between interpreters in one process
+    worker_config = dict(_engine_config, pool_size=1, batch_window_ms=0,
+                         num_threads=max(1, (os.cpu_count() or 1) // _workers))
+    return ProcessPoolExecutor(max_workers=_workers,
+                               mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker,
+                               initargs=(worker_config,))
+
+@contextmanager
+def _pool():
+    """
+    The current worker pool. If it breaks because a worker died, it is replaced
+    (once, however many threads were using it) and VisionWorkerCrashed is raised
+    """
+    global _executor
+    executor = _executor
+    try:
+        yield executor
+    except BrokenProcessPool as e:
+        with _executor_lock:
+            if _executor is executor:
+                print(f"Error: A vision worker died ({str(e)}), restarting the pool")
+                executor.shutdown(wait=False, cancel_futures=True)
+                _executor = _new_pool()
+        raise VisionWorkerCrashed('A vision worker died, please retry') from e
+
+def get_engine():
+    """The in-process engine, loaded on first use when vision work normally runs in workers"""
+    global _engine
+    if _engine is None:
+        _engine = _build_engine(_engine_config)
+    return _engine
+
+def _call(task, args):
+    """Run a task in a worker process, returning its result with the metrics it changed"""
+    return task(*args), metrics.collect()
+
+def _result(future, timeout):
+    result, changes = future.result(timeout=timeout)
+    metrics.merge(changes)
+    return result
+
+def run(task, *args, timeout=VISION_TASK_TIMEOUT):
+    """
+    Run a task from this module and return its result, raising TimeoutError if it
+    takes too long (or VisionWorkerCrashed, a TimeoutError, if its worker died)
+    """
+    if _executor is None:
+        return task(*args)
+    with _pool() as executor:
+        return _result(executor.submit(_call, task, args), timeout)
+
+def analyse_liveness(filepath, timeout=VISION_TASK_TIMEOUT):
+    """
+    Blink analysis of a liveness video. Clips that fail the replay pre-screen are
+    rejected before any landmark work. Long clips are split into frame ranges that
+    the worker processes analyse in parallel; short ones (or in-process mode) are
+    streamed through a single worker with early exit.
+    """
+    screen = prescreen(filepath, timeout)
+    if screen is not None and not screen['passed']:
+        return liveness.prescreen_rejection(screen)
+    if _executor is None or _workers < 2:
+        return run(analyse_liveness_video, filepath, timeout=timeout)
+    total, limit = liveness.video_frame_count(filepath)
+    chunks = min(_workers, total // LIVENESS_MIN_FRAMES_PER_CHUNK)
+    if chunks < 2:
+        return run(analyse_liveness_video, filepath, timeout=timeout)
+    deadline = time.monotonic() + timeout
+    with _pool() as executor:
+        futures = [executor.submit(_call, liveness_ear_range, (filepath, start, end))
+                   for start, end in liveness.split_ranges(total, chunks, last_end=limit)]
+        results = [_result(future, max(0.0, deadline - time.monotonic())) for future in futures]
+    return liveness.merge_ear_results(results)
+
+def prescreen(filepath, timeout=VISION_TASK_TIMEOUT, holdback=0):
+    """
+    liveness.prescreen() of a video in a worker, or None when the pre-screen is
+    disabled (or, with holdback, can't be judged yet)
+    """
+    if not liveness.PRESCREEN:
+        return None
+    screen = run(prescreen_liveness_video, filepath, holdback, timeout=timeout)
+    if screen is not None and not screen['passed']:
+        prescreen_rejections.inc()
+    return screen
+
+# --- Tasks (executed in whichever process owns the engine) ---
+
+def face_artifact_from_bytes(image_bytes):
+    """FaceEngine.face_artifact_from_bytes() with the crop as PNG bytes"""
+    artifact = get_engine().face_artifact_from_bytes(image_bytes)
+    if artifact['crop'] is not None:
+        artifact['crop'] = cv2.imencode('.png', artifact['crop'])[1].tobytes()
+    return artifact
+
+def face_artifacts_from_bytes(images):
+    """face_artifact_from_bytes() of several images, with one embedding invoke for all of them"""
+    artifacts = get_engine().face_artifacts_from_bytes(images)
+    for artifact in artifacts:
+        if artifact['crop'] is not None:
+            artifact['crop'] = cv2.imencode('.png', artifact['crop'])[1].tobytes()
+    return artifacts
+
+def embed_face_crop(crop_png):
+    """Embedding of a stored face crop, skipping decode and detection of the original image"""
+    crop = cv2.imdecode(np.frombuffer(crop_png, np.uint8), cv2.IMREAD_COLOR)
+    return get_engine().embed(crop)
+
+def embed_face_crops(crops_png):
+    """embed_face_crop() of several crops in one invoke"""
+    return get_engine().embed_batch([cv2.imdecode(np.frombuffer(crop_png, np.uint8), cv2.IMREAD_COLOR)
+                                     for crop_png in crops_png])
+
+def prescreen_liveness_video(filepath, holdback=0):
+    return liveness.prescreen(filepath, holdback=holdback)
+
+def analyse_liveness_video(filepath):
+    return liveness.analyse_video(get_engine(), filepath)
+
+def liveness_ear_range(filepath, start, end):
+    return liveness.extract_ear_series(get_engine(), filepath, start, end)
+
+def liveness_frame_ears(image_bytes, tracker_state, thumbnail=False, identity_cutoff=np.inf):
+    return liveness.frame_ears(get_engine(), image_bytes, tracker_state, thumbnail, identity_cutoff)
+
+def liveness_identity_embedding(items):
+    """
+    identity_embedding() of (score, position, crop PNG) items kept by a stream's
+    FrameSelector. Returns (embedding or None, number of frames used)
+    """
+    crops = [(score, position, cv2.imdecode(np.frombuffer(crop_png, np.uint8), cv2.IMREAD_COLOR))
+             for score, position, crop_png in items]
+    candidates = liveness.embed_candidates(get_engine(), crops)
+    return liveness.identity_embedding(candidates), min(len(candidates), liveness.IDENTITY_FRAMES)
@@ -0,0 +1,54 @@
+"""
+Blob store backends. The S3 tests run against a local MinIO server when
+BLOB_S3_TEST_ENDPOINT is set, e.g.
+
+    docker run -p 9000:9000 minio/minio server /data
+    BLOB_S3_TEST_ENDPOINT=http://localhost:9000 AWS_ACCESS_KEY_ID=minioadmin \
+        AWS_SECRET_ACCESS_KEY=minioadmin python -m pytest -q test_blob_store.py
+"""
+import hashlib
+import os
+import uuid
+import pytest
+from routes import blob_store
+
+def key_of(data):
+    return hashlib.sha256(data).hexdigest()
+
+@pytest.fixture(params=['local', 's3'])
+def store(request, tmp_path):
+    if request.param == 'local':
+        return blob_store.LocalBlobStore(str(tmp_path / 'blobs'))
+    endpoint = os.environ.get('BLOB_S3_TEST_ENDPOINT')
+    if not endpoint:
+        pytest.skip('BLOB_S3_TEST_ENDPOINT not set')
+    boto3 = pytest.importorskip('boto3')
+    client = boto3.client('s3', endpoint_url=endpoint, region_name='us-east-1')
+    bucket = f'blob-store-test-{uuid.uuid4().hex[:8]}'
+    client.create_bucket(Bucket=bucket)
+    return blob_store.S3BlobStore(bucket, prefix='images', client=client)
+
+def test_put_get_and_dedupe(store):
+    data = b'encrypted image bytes'
+    key = key_of(data)
+    assert not store.exists(key)
+    assert store.put(key, data)
+    assert store.exists(key)
+    assert store.get(key) == data
+    assert not store.put(key, data)
+    with pytest.raises(KeyError):
+        store.get(key_of(b'missing'))
+
+def test_local_layout_is_sharded_and_leaves_no_temporary_files(tmp_path):
+    store = blob_store.LocalBlobStore(str(tmp_path))
+    key = key_of(b'x')
+    store.put(key, b'x')
+    assert store.path(key) == os.path.join(str(tmp_path), key[:2], key[2:4], key)
+    assert os.listdir(os.path.dirname(store.path(key))) == [key]
+
+def test_only_blob_keys_are_accepted():
+    assert blob_store.is_blob_key(key_of(b'x'))
+    assert not blob_store.is_blob_key('reference_3.jpg')
+    assert not blob_store.is_blob_key(None)
+    with pytest.raises(ValueError):
+        blob_store.shard_path('../../etc/passwd')
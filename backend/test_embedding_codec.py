@@ -0,0 +1,55 @@
+"""
+Compact float16/int8 embedding format and its similarity error against float32.
+"""
+import numpy as np
+import pytest
+from routes import embedding_codec
+from routes.embedding_codec import CompactMatrix, SIMILARITY_TOLERANCE
+
+DIM = 128
+
+def random_embeddings(count, seed=0):
+    vectors = np.random.default_rng(seed).standard_normal((count, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+@pytest.mark.parametrize('dtype, size', [('float32', 520), ('float16', 264), ('int8', 140)])
+def test_round_trip(dtype, size):
+    a, b = random_embeddings(2)
+    blob = embedding_codec.encode(a, dtype)
+    assert len(blob) == size and blob[:4] == embedding_codec.MAGIC
+    decoded = embedding_codec.decode(blob)
+    assert decoded.dtype == np.float32 and decoded.shape == (DIM,)
+    assert abs(float(decoded @ b) - float(a @ b)) <= SIMILARITY_TOLERANCE[dtype]
+    if dtype == 'float32':
+        assert np.array_equal(decoded, a)
+
+def test_legacy_raw_float32_blobs_decode_unchanged():
+    embedding = random_embeddings(1)[0] * 7.5
+    decoded = embedding_codec.decode(embedding.tobytes())
+    assert np.array_equal(decoded, embedding)
+    # Blobs read back from SQLite may be memoryviews or bytearrays
+    assert np.array_equal(embedding_codec.decode(bytearray(embedding.tobytes())), embedding)
+
+def test_unknown_format_version_is_rejected():
+    blob = bytearray(embedding_codec.encode(random_embeddings(1)[0], 'float16'))
+    blob[4] = 99
+    with pytest.raises(ValueError):
+        embedding_codec.decode(bytes(blob))
+
+def test_int8_handles_zero_vectors():
+    decoded = embedding_codec.decode(embedding_codec.encode(np.zeros(DIM), 'int8'))
+    assert not decoded.any()
+
+@pytest.mark.parametrize('dtype', ['float16', 'int8'])
+def test_compact_matrix_scores_within_tolerance(dtype):
+    vectors = random_embeddings(5000)
+    queries = random_embeddings(20, seed=1)
+    compact = CompactMatrix(vectors, dtype)
+    assert len(compact) == 5000
+    assert compact.nbytes <= vectors.nbytes // (2 if dtype == 'float16' else 3)
+    exact = vectors @ queries.T
+    # Chunked scoring must not depend on the chunk boundaries
+    scores = compact.dot(queries, chunk=1000)
+    assert scores.shape == (5000, 20)
+    assert np.abs(scores - exact).max() <= SIMILARITY_TOLERANCE[dtype]
+    assert np.allclose(compact.dot(queries[0], chunk=333), scores[:, 0], atol=1e-6)
@@ -0,0 +1,204 @@
+"""
+IVF/PQ embedding index: recall against exact search, incremental updates and
+memory-mapped persistence.
+"""
+import os
+import numpy as np
+import pytest
+from routes.embedding_index import IVFIndex, StaleIndexError
+from routes.embedding_codec import SIMILARITY_TOLERANCE
+
+DIM = 128
+
+def clustered_embeddings(count, clusters=40, seed=0):
+    """Unit vectors around a few centres, like faces of similar-looking people"""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, DIM)).astype(np.float32)
+    vectors = centres[rng.integers(0, clusters, count)] + 0.5 * rng.standard_normal((count, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def same_results(a, b):
+    return [i for i, _ in a] == [i for i, _ in b] and np.allclose([s for _, s in a], [s for _, s in b], atol=1e-5)
+
+def recall_at_10(index, vectors, queries, nprobe):
+    hits = 0
+    for query in queries:
+        exact = set(np.argsort(-(vectors @ query))[:10])
+        hits += len(exact & {vector_id for vector_id, _ in index.search(query, k=10, nprobe=nprobe)})
+    return hits / (10 * len(queries))
+
+@pytest.fixture(scope='module')
+def data():
+    vectors = clustered_embeddings(3000)
+    queries = clustered_embeddings(50, seed=1)
+    return vectors, queries
+
+@pytest.mark.parametrize('pq_m, nprobe, min_recall', [(0, 8, 0.9), (0, 32, 0.999), (16, 16, 0.4)])
+def test_recall_against_exact_search(data, pq_m, nprobe, min_recall):
+    vectors, queries = data
+    index = IVFIndex(DIM, nlist=32, pq_m=pq_m)
+    index.train(vectors)
+    index.add(np.arange(len(vectors)), vectors)
+    assert len(index) == len(vectors)
+    assert recall_at_10(index, vectors, queries, nprobe) >= min_recall
+
+def test_flat_scores_are_exact_inner_products(data):
+    vectors, queries = data
+    index = IVFIndex(DIM, nlist=8)
+    index.train(vectors)
+    index.add(np.arange(len(vectors)), vectors)
+    results = index.search(queries[0], k=5, nprobe=8)
+    exact = np.argsort(-(vectors @ queries[0]))[:5]
+    assert [vector_id for vector_id, _ in results] == list(exact)
+    assert np.allclose([score for _, score in results], (vectors @ queries[0])[exact], atol=1e-5)
+
+def test_add_replace_remove(data, tmp_path):
+    vectors, _ = data
+    index = IVFIndex(DIM, nlist=16)
+    with pytest.raises(RuntimeError):
+        index.add([1], vectors[:1])
+    index.train(vectors)
+    index.add(np.arange(100), vectors[:100])
+    index.save(str(tmp_path / 'index'))
+    # Replace an entry of the saved (base) segment and one of the delta
+    index.add([100], vectors[100:101])
+    index.add([5, 100], vectors[[200, 201]])
+    assert len(index) == 101
+    assert index.search(vectors[200], k=1, nprobe=16)[0][0] == 5
+    assert index.search(vectors[201], k=1, nprobe=16)[0][0] == 100
+    assert 5 not in [vector_id for vector_id, _ in index.search(vectors[5], k=3, nprobe=16)]
+    index.remove(7)
+    index.remove(100)
+    index.remove(12345)
+    assert len(index) == 99
+    found = {vector_id for vector_id, _ in index.search(vectors[7], k=100, nprobe=16)}
+    assert 7 not in found and 100 not in found
+
+def test_save_and_load_memory_mapped(data, tmp_path):
+    vectors, queries = data
+    path = str(tmp_path / 'index')
+    index = IVFIndex(DIM, nlist=16, pq_m=16)
+    index.train(vectors)
+    index.add(np.arange(2000), vectors[:2000])
+    index.save(path, model_version='v1', saved_at='2026-01-01T00:00:00')
+    index.add(np.arange(2000, 3000), vectors[2000:])
+    index.remove(3)
+    index.save(path, saved_at='2026-01-02T00:00:00')
+    expected = [index.search(query, k=10, nprobe=8) for query in queries[:10]]
+
+    loaded = IVFIndex.load(path)
+    assert isinstance(loaded.ids, np.memmap) and isinstance(loaded.data, np.memmap)
+    assert loaded.meta == {'model_version': 'v1', 'saved_at': '2026-01-02T00:00:00'}
+    assert (loaded.dim, loaded.nlist, loaded.pq_m, len(loaded)) == (DIM, 16, 16, 2999)
+    assert [loaded.search(query, k=10, nprobe=8) for query in queries[:10]] == expected
+    # The base segment is read-only; updates go to the delta
+    loaded.add([3], vectors[3:4])
+    loaded.remove(4)
+    assert len(loaded) == 2999 and loaded.delta_size == 1
+    assert 3 in [vector_id for vector_id, _ in loaded.search(vectors[3], k=10, nprobe=16)]
+
+    in_memory = IVFIndex.load(path, mmap=False)
+    assert not isinstance(in_memory.data, np.memmap)
+    assert len(in_memory) == 2999
+
+@pytest.mark.parametrize('dtype', ['float16', 'int8'])
+def test_compact_lists_score_within_tolerance(data, tmp_path, dtype):
+    vectors, queries = data
+    path = str(tmp_path / 'index')
+    index = IVFIndex(DIM, nlist=8, dtype=dtype)
+    index.train(vectors)
+    index.add(np.arange(2000), vectors[:2000])
+    index.save(path)
+    loaded = IVFIndex.load(path)
+    assert loaded.dtype == dtype and loaded.data.dtype == np.dtype(dtype)
+    assert loaded.has_scales == (dtype == 'int8')
+    # Scored from the memory-mapped base and the in-memory delta
+    loaded.add(np.arange(2000, 3000), vectors[2000:])
+    tolerance = SIMILARITY_TOLERANCE[dtype]
+    for query in queries[:10]:
+        results = loaded.search(query, k=50, nprobe=8)
+        ids = [vector_id for vector_id, _ in results]
+        exact = vectors[ids] @ query
+        assert np.abs(np.array([score for _, score in results]) - exact).max() <= tolerance
+        best = np.argsort(-(vectors @ query))[:5]
+        assert set(best) <= set(ids)
+
+@pytest.mark.parametrize('pq_m, dtype', [(0, 'float32'), (0, 'int8'), (16, 'float32')])
+def test_flush_appends_changes_that_load_replays(data, tmp_path, pq_m, dtype):
+    vectors, queries = data
+    path = str(tmp_path / 'index')
+    index = IVFIndex(DIM, nlist=16, pq_m=pq_m, dtype=dtype)
+    index.train(vectors)
+    index.add(np.arange(2000), vectors[:2000])
+    index.save(path, model_version='v1', saved_at='2026-01-01T00:00:00')
+    data_size = os.path.getsize(os.path.join(path, 'data.npy'))
+
+    index.add(np.arange(2000, 2100), vectors[2000:2100])
+    index.add([5], vectors[2500:2501])
+    index.remove(7)
+    assert index.unflushed == 102
+    index.flush(path, saved_at='2026-01-02T00:00:00')
+    log_size = os.path.getsize(os.path.join(path, 'delta.log'))
+    assert index.unflushed == 0 and log_size == 102 * index.log_dtype.itemsize
+    # A second flush appends only what changed since the first
+    index.add([2050], vectors[2600:2601])
+    index.remove(2001)
+    index.flush(path, saved_at='2026-01-03T00:00:00')
+    assert os.path.getsize(os.path.join(path, 'delta.log')) == log_size + 2 * index.log_dtype.itemsize
+    # The base segment was not rewritten
+    assert os.path.getsize(os.path.join(path, 'data.npy')) == data_size
+
+    loaded = IVFIndex.load(path)
+    assert loaded.meta == {'model_version': 'v1', 'saved_at': '2026-01-03T00:00:00'}
+    assert len(loaded) == len(index) == 2098
+    assert loaded.unflushed == 0
+    for query in list(queries[:10]) + [vectors[2500], vectors[2600]]:
+        assert same_results(loaded.search(query, k=10, nprobe=16), index.search(query, k=10, nprobe=16))
+
+    # A record cut short by a crash mid-append is ignored
+    with open(os.path.join(path, 'delta.log'), 'ab') as f:
+        f.write(b'\x01' * 10)
+    assert len(IVFIndex.load(path)) == 2098
+
+    # save() folds the log into a new base segment
+    loaded.save(path)
+    assert not os.path.exists(os.path.join(path, 'delta.log'))
+    compacted = IVFIndex.load(path)
+    assert len(compacted) == 2098 and compacted.delta_size == 0
+    assert same_results(compacted.search(vectors[2600], k=10, nprobe=16), index.search(vectors[2600], k=10, nprobe=16))
+
+def test_flush_never_writes_over_a_rebuilt_index(data, tmp_path):
+    vectors, _ = data
+    path = str(tmp_path / 'index')
+    index = IVFIndex(DIM, nlist=16)
+    index.train(vectors)
+    index.add(np.arange(1000), vectors[:1000])
+    index.save(path, model_version='v1', saved_at='2026-01-01T00:00:00')
+    stale = IVFIndex.load(path)
+    # Another process retrains with more lists
+    rebuilt = IVFIndex(DIM, nlist=32)
+    rebuilt.train(vectors)
+    rebuilt.add(np.arange(2000), vectors[:2000])
+    rebuilt.save(path, model_version='v1', saved_at='2026-01-02T00:00:00')
+
+    stale.add([5000], vectors[2500:2501])
+    stale.remove(3)
+    with pytest.raises(StaleIndexError):
+        stale.flush(path, saved_at='2026-01-03T00:00:00')
+    assert not os.path.exists(os.path.join(path, 'delta.log'))
+    assert stale.unflushed_removals() == [3]
+    loaded = IVFIndex.load(path)
+    assert loaded.nlist == 32 and len(loaded) == 2000
+    assert loaded.meta == {'model_version': 'v1', 'saved_at': '2026-01-02T00:00:00'}
+
+    # Copies of the same build flush one after the other and only touch the given meta fields
+    other = IVFIndex.load(path)
+    loaded.add([6000], vectors[2600:2601])
+    loaded.flush(path, saved_at='2026-01-04T00:00:00')
+    other.remove(4)
+    other.flush(path, saved_at='2026-01-05T00:00:00')
+    merged = IVFIndex.load(path)
+    assert merged.nlist == 32 and merged.build == rebuilt.build
+    assert merged.meta == {'model_version': 'v1', 'saved_at': '2026-01-05T00:00:00'}
+    assert len(merged) == 2000
+    assert same_results(merged.search(vectors[2600], k=5, nprobe=32)[:1], [(6000, 1.0)])
@@ -0,0 +1,85 @@
+"""
+SQLite-backed enrollment job queue: claiming, retries and stale-job recovery.
+"""
+import threading
+from datetime import datetime, timedelta
+import pytest
+from flask import Flask
+from models import db, User, EnrollmentJob
+from routes import enrollment_queue
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    # A file database, so worker threads share it like they do in the app
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'queue.db'}"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(id=1, email='a@example.com', name='A', role='user', public_key='-',
+                            private_key_encrypted='-', challenge_phrase_hash='-'))
+        db.session.commit()
+    return app
+
+def queue_jobs(count):
+    jobs = [enrollment_queue.enqueue(1, f'{i:064x}') for i in range(count)]
+    # Uploads arrive one after another
+    started = datetime.utcnow()
+    for i, job in enumerate(jobs):
+        job.created_at = started + timedelta(milliseconds=i)
+    db.session.commit()
+    return [job.id for job in jobs]
+
+def test_claims_oldest_jobs_in_batches(app):
+    with app.app_context():
+        ids = queue_jobs(5)
+        first = enrollment_queue.claim('worker-a', 3)
+        assert [job.id for job in first] == ids[:3]
+        assert all(job.status == 'running' and job.attempts == 1 for job in first)
+        assert [job.id for job in enrollment_queue.claim('worker-b', 3)] == ids[3:]
+        assert enrollment_queue.claim('worker-a', 3) == []
+
+def test_concurrent_workers_never_share_a_job(app):
+    with app.app_context():
+        ids = queue_jobs(40)
+    claimed = []
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        with app.app_context():
+            while True:
+                jobs = enrollment_queue.claim(worker_id, 4)
+                if not jobs:
+                    return
+                with lock:
+                    claimed.extend(job.id for job in jobs)
+
+    threads = [threading.Thread(target=worker, args=(f'worker-{n}',)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed) == sorted(ids)
+
+def test_failed_jobs_are_retried_then_given_up(app, monkeypatch):
+    monkeypatch.setattr(enrollment_queue, 'ENROLLMENT_MAX_ATTEMPTS', 2)
+    with app.app_context():
+        job_id, = queue_jobs(1)
+        for attempt in (1, 2):
+            job, = enrollment_queue.claim('worker-a', 1)
+            enrollment_queue.retry_or_fail(job, 'vision worker timed out')
+            db.session.commit()
+        job = db.session.get(EnrollmentJob, job_id)
+        assert job.status == 'failed' and job.attempts == 2 and job.finished_at is not None
+        assert enrollment_queue.claim('worker-a', 1) == []
+
+def test_stale_running_jobs_are_queued_again(app):
+    with app.app_context():
+        job_id, = queue_jobs(1)
+        job, = enrollment_queue.claim('crashed-worker', 1)
+        assert enrollment_queue.requeue_stale() == 0
+        job.started_at = datetime.utcnow() - timedelta(seconds=enrollment_queue.ENROLLMENT_JOB_TIMEOUT + 1)
+        db.session.commit()
+        assert enrollment_queue.requeue_stale() == 1
+        job, = enrollment_queue.claim('worker-b', 1)
+        assert job.id == job_id and job.attempts == 2
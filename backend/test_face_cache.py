@@ -0,0 +1,69 @@
+"""
+Byte-bounded LRU cache of face results.
+"""
+import threading
+import numpy as np
+from routes import face_cache as face_caches
+from routes.face_cache import FaceCache, entry_size
+
+def face(seed):
+    rng = np.random.default_rng(seed)
+    return {
+        'embedding': rng.normal(size=128).astype(np.float32),
+        'crop': rng.integers(0, 255, (112, 112, 3), dtype=np.uint8)
+    }
+
+def test_evicts_least_recently_used_within_byte_budget():
+    size = entry_size(face(0))
+    cache = FaceCache(3 * size, name='test_face_cache_lru')
+    for i in range(3):
+        cache.put('face', f'key{i}', face(i))
+    assert cache.get('face', 'key0') is not None
+    evictions = cache.evictions.snapshot()
+    cache.put('face', 'key3', face(3))
+    assert cache.evictions.snapshot() == evictions + 1
+    assert cache.get('face', 'key1') is None
+    assert all(cache.get('face', k) is not None for k in ('key0', 'key2', 'key3'))
+    assert cache.nbytes == 3 * size
+
+    # Replacing an entry doesn't count its old size twice
+    cache.put('face', 'key3', face(4))
+    assert cache.nbytes == 3 * size and len(cache) == 3
+    # Entries bigger than the whole budget are not cached
+    cache.put('face', 'huge', {'crop': np.zeros(4 * size, dtype=np.uint8)})
+    assert cache.get('face', 'huge') is None and len(cache) == 3
+
+def test_invalidate_drops_every_kind_of_an_image():
+    cache = FaceCache(2**20, name='test_face_cache_invalidate')
+    cache.put('face', ('reference_1.jpg', 1.0), face(0))
+    cache.put('reference', ('reference_1.jpg', 1.0), {'embedding': face(0)['embedding']})
+    cache.put('face', 'other', face(1))
+    cache.invalidate(('reference_1.jpg', 1.0))
+    assert cache.get('face', ('reference_1.jpg', 1.0)) is None
+    assert cache.get('reference', ('reference_1.jpg', 1.0)) is None
+    assert cache.get('face', 'other') is not None
+    assert cache.nbytes == entry_size(face(1))
+    # A missing image has no identity
+    cache.put('face', None, face(2))
+    assert cache.get('face', None) is None
+
+def test_concurrent_use_keeps_accounting_consistent():
+    size = entry_size(face(0))
+    cache = FaceCache(10 * size, name='test_face_cache_threads')
+    values = [face(i) for i in range(40)]
+
+    def worker(offset):
+        for i in range(400):
+            key = (i * 7 + offset) % len(values)
+            if cache.get('face', key) is None:
+                cache.put('face', key, values[key])
+            if i % 50 == 0:
+                cache.invalidate(key)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.nbytes == len(cache) * size <= 10 * size
+    assert face_caches.metrics.snapshot()['test_face_cache_threads_entries'] == len(cache)
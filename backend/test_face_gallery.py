@@ -0,0 +1,99 @@
+"""
+In-memory reference gallery: 1:N search and the all-pairs duplicate sweep.
+"""
+import numpy as np
+import pytest
+from routes.face_gallery import ReferenceGallery
+from routes.embedding_codec import SIMILARITY_TOLERANCE
+
+DIM = 128
+
+def random_embeddings(count, seed=0):
+    vectors = np.random.default_rng(seed).standard_normal((count, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def near_copy(vector, noise, seed=1):
+    vector = vector + noise * np.random.default_rng(seed).standard_normal(DIM).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+def brute_force_pairs(user_ids, vectors, threshold):
+    scores = vectors @ vectors.T
+    return sorted((min(user_ids[a], user_ids[b]), max(user_ids[a], user_ids[b]))
+                  for a in range(len(user_ids)) for b in range(a + 1, len(user_ids))
+                  if scores[a, b] >= threshold)
+
+def test_search_matches_exact_cosine():
+    vectors = random_embeddings(200)
+    gallery = ReferenceGallery()
+    gallery.load((user_id, vector * 3.0) for user_id, vector in enumerate(vectors, start=1))
+    query = near_copy(vectors[41], 0.05)
+    expected = np.argsort(-(vectors @ query))[:5] + 1
+    results = gallery.search(query, k=5)
+    assert [user_id for user_id, _ in results] == list(expected)
+    assert results[0][0] == 42 and abs(results[0][1] - float(vectors[41] @ query)) < 1e-5
+    assert 42 not in [user_id for user_id, _ in gallery.search(query, k=5, exclude_user_id=42)]
+
+def test_upsert_and_remove_keep_rows_consistent():
+    vectors = random_embeddings(10)
+    gallery = ReferenceGallery()
+    for user_id, vector in enumerate(vectors, start=1):
+        gallery.upsert(user_id, vector)
+    assert len(gallery) == 10
+    # Replacing keeps one row per user
+    gallery.upsert(3, vectors[7])
+    assert len(gallery) == 10
+    assert gallery.search(vectors[7], k=2)[0][1] > 0.999
+    assert {user_id for user_id, _ in gallery.search(vectors[7], k=2)} == {3, 8}
+    # Removing moves the last row into the hole
+    gallery.remove(2)
+    gallery.remove(2)
+    assert len(gallery) == 9
+    assert gallery.search(vectors[9], k=1)[0][0] == 10
+    assert 2 not in [user_id for user_id, _ in gallery.search(vectors[1], k=9)]
+
+def test_duplicate_sweep_finds_each_pair_once():
+    vectors = random_embeddings(50)
+    # Same face enrolled twice within one block and across blocks
+    vectors[10] = near_copy(vectors[3], 0.02, seed=2)
+    vectors[45] = near_copy(vectors[5], 0.02, seed=3)
+    vectors[46] = near_copy(vectors[5], 0.02, seed=4)
+    user_ids = list(range(100, 150))
+    gallery = ReferenceGallery()
+    gallery.load(zip(user_ids, vectors))
+    expected = brute_force_pairs(user_ids, vectors, 0.9)
+    assert expected == [(103, 110), (105, 145), (105, 146), (145, 146)]
+    for block_size in (7, 16, 50, 1024):
+        pairs = gallery.duplicate_pairs(0.9, block_size=block_size)
+        assert sorted((a, b) for a, b, _ in pairs) == expected
+        # Best matches first, never a self-match
+        assert [s for _, _, s in pairs] == sorted((s for _, _, s in pairs), reverse=True)
+
+def test_empty_gallery():
+    gallery = ReferenceGallery()
+    assert gallery.search(random_embeddings(1)[0]) == []
+    assert gallery.duplicate_pairs(0.5) == []
+    gallery.load([])
+    assert len(gallery) == 0
+
+@pytest.mark.parametrize('dtype', ['float16', 'int8'])
+def test_compact_gallery_scores_within_tolerance(dtype):
+    vectors = random_embeddings(300)
+    vectors[250] = near_copy(vectors[20], 0.02, seed=5)
+    exact, compact = ReferenceGallery(), ReferenceGallery(dtype=dtype)
+    exact.load(enumerate(vectors[:200], start=1))
+    compact.load(enumerate(vectors[:200], start=1))
+    # Rows added after the initial load go through the growable compact matrix too
+    for user_id, vector in enumerate(vectors[200:], start=201):
+        exact.upsert(user_id, vector)
+        compact.upsert(user_id, vector)
+    compact.remove(7)
+    exact.remove(7)
+    tolerance = SIMILARITY_TOLERANCE[dtype]
+    for query in random_embeddings(10, seed=6):
+        expected = dict(exact.search(query, k=300))
+        found = dict(compact.search(query, k=300))
+        assert found.keys() == expected.keys()
+        assert max(abs(found[user_id] - expected[user_id]) for user_id in found) <= tolerance
+    pairs = compact.duplicate_pairs(0.9, block_size=64)
+    assert [(a, b) for a, b, _ in pairs] == [(21, 251)]
+    assert abs(pairs[0][2] - exact.duplicate_pairs(0.9)[0][2]) <= tolerance
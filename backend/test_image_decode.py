@@ -0,0 +1,40 @@
+"""
+Reduced-scale decoding of large uploads, including EXIF-rotated phone photos.
+"""
+import io
+import numpy as np
+from PIL import Image
+from routes.image_decode import decode_reduced, image_size, EXIF_ORIENTATION
+
+def jpeg(width, height, orientation=None):
+    pixels = np.zeros((height, width, 3), np.uint8)
+    pixels[:, :width // 4] = 255  # mark the left edge of the stored image
+    image = Image.fromarray(pixels)
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[EXIF_ORIENTATION] = orientation
+    out = io.BytesIO()
+    image.save(out, format='JPEG', exif=exif.tobytes())
+    return out.getvalue()
+
+def test_upright_photo_scale():
+    img, scale = decode_reduced(jpeg(4000, 3000))
+    assert img.shape[:2] == (1500, 2000)
+    assert scale == 2.0
+
+def test_rotated_photo_scale_uses_the_oriented_size():
+    # Stored landscape, shown portrait: the decoder rotates it, so must the scale
+    image_bytes = jpeg(4000, 3000, orientation=6)
+    assert image_size(image_bytes) == (3000, 4000)
+    img, scale = decode_reduced(image_bytes)
+    assert img.shape[:2] == (2000, 1500)
+    assert scale == 2.0
+
+def test_small_photo_is_decoded_at_full_size():
+    img, scale = decode_reduced(jpeg(640, 480, orientation=6))
+    assert img.shape[:2] == (640, 480)
+    assert scale == 1.0
+
+def test_undecodable_bytes():
+    assert image_size(b'not an image') is None
+    assert decode_reduced(b'not an image') == (None, 1.0)
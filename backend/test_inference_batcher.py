@@ -0,0 +1,45 @@
+"""
+Micro-batching of embedding inference.
+"""
+import threading
+import time
+import numpy as np
+from routes.inference_batcher import EmbeddingBatcher, _PendingEmbedding
+
+def test_backlog_is_drained_in_full_batches():
+    sizes = []
+    release = threading.Event()
+
+    def run_batch(tensors):
+        release.wait()
+        sizes.append(len(tensors))
+        return [tensor.sum() for tensor in tensors]
+
+    batcher = EmbeddingBatcher(run_batch, window_ms=3.0, max_batch=8, num_workers=1)
+    # The collector is blocked in run_batch with the first face while a backlog builds up
+    first = threading.Thread(target=batcher.embed, args=(np.zeros((1, 2)),))
+    first.start()
+    time.sleep(0.05)
+    backlog = []
+    for i in range(24):
+        pending = _PendingEmbedding(np.full((1, 2), i, dtype=np.float32))
+        pending.enqueued_at -= 1.0  # waited far longer than the window
+        batcher._queue.put(pending)
+        backlog.append(pending)
+    release.set()
+    first.join()
+    for pending in backlog:
+        assert pending.done.wait(5)
+    assert sizes == [1, 8, 8, 8]
+    assert [float(p.result) for p in backlog] == [2.0 * i for i in range(24)]
+
+def test_window_collects_faces_arriving_together():
+    sizes = []
+    batcher = EmbeddingBatcher(lambda tensors: sizes.append(len(tensors)) or list(tensors),
+                               window_ms=50.0, max_batch=4, num_workers=1)
+    threads = [threading.Thread(target=batcher.embed, args=(np.zeros((1, 2)),)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sizes == [4]
@@ -0,0 +1,280 @@
+"""
+Chunked liveness analysis must count exactly the blinks the sequential one does.
+
+Uses a synthetic MJPG clip whose frame brightness encodes the EAR, and a stand-in
+engine that turns brightness into eye landmarks, so it runs without dlib/TFLite.
+
+    python -m pytest -q test_liveness.py
+"""
+import numpy as np
+import cv2
+import pytest
+from routes import liveness
+
+EAR_OPEN = 0.30
+EAR_CLOSED = 0.15
+
+def ears_with_blinks(frames, blink_starts, length=3):
+    ears = np.full(frames, EAR_OPEN)
+    for start in blink_starts:
+        ears[start:start + length] = EAR_CLOSED
+    return ears
+
+class BrightnessEngine:
+    """engine.landmarks() stand-in: one face whose EAR is the frame's mean brightness / 500"""
+
+    def landmarks(self, gray, rects=None):
+        ear = float(gray.mean()) / 500.0
+        shape = np.zeros((68, 2), dtype=np.int32)
+        # width 100 eye whose two vertical distances are both 100 * ear
+        eye = np.array([[0, 0], [30, -50 * ear], [70, -50 * ear], [100, 0], [70, 50 * ear], [30, 50 * ear]])
+        shape[liveness.LEFT_EYE] = np.round(eye + [200, 100])
+        shape[liveness.RIGHT_EYE] = np.round(eye + [50, 100])
+        return [shape]
+
+    def face_boxes(self, gray):
+        return [(0, 0, gray.shape[1] - 1, gray.shape[0] - 1)]
+
+    def rect(self, left, top, right, bottom):
+        return left, top, right, bottom
+
+@pytest.fixture
+def clip(tmp_path):
+    ears = ears_with_blinks(120, [10, 38, 59, 88, 112], length=4)
+    path = str(tmp_path / 'clip.avi')
+    # Large enough to hold BrightnessEngine's landmarks, so FaceTracker can track them
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, (320, 240))
+    for ear in ears:
+        writer.write(np.full((240, 320, 3), int(round(ear * 500)), dtype=np.uint8))
+    writer.release()
+    return path
+
+def sequential_blinks(ears):
+    return liveness.BlinkCounter().update(ears)
+
+def chunked_blinks(ears, cuts):
+    bounds = [0] + list(cuts) + [len(ears)]
+    results = [{'ears': ears[a:b], 'face_found': True, 'frames_analysed': b - a, 'detector_calls': 0,
+                'consec_frames': liveness.CONSEC_FRAMES, 'identity': []}
+               for a, b in zip(bounds, bounds[1:])]
+    return liveness.merge_ear_results(results, required_blinks=len(ears))['blinks']
+
+def test_blink_straddling_a_chunk_boundary_counts_once():
+    ears = ears_with_blinks(40, [18])
+    assert sequential_blinks(ears) == 1
+    for cut in range(15, 23):
+        assert chunked_blinks(ears, [cut]) == 1
+
+def test_chunked_matches_sequential_on_random_series():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        ears = np.where(rng.random(300) < 0.15, EAR_CLOSED, EAR_OPEN)
+        cuts = sorted(rng.choice(np.arange(1, 300), size=rng.integers(1, 8), replace=False))
+        assert chunked_blinks(ears, cuts) == sequential_blinks(ears)
+
+def test_split_ranges_cover_every_frame():
+    for total in (1, 7, 90, 901):
+        for chunks in (1, 2, 3, 8):
+            ranges = liveness.split_ranges(total, chunks)
+            assert ranges[0][0] == 0 and ranges[-1][1] == total
+            assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+    assert liveness.split_ranges(100, 4, last_end=900)[-1] == (75, 900)
+
+@pytest.mark.parametrize('track', [False, True])
+@pytest.mark.parametrize('sample_fps', [0, 15])
+@pytest.mark.parametrize('chunks', [2, 3, 4, 7])
+def test_video_chunks_match_sequential(clip, chunks, sample_fps, track):
+    engine = BrightnessEngine()
+    sequential = liveness.analyse_video(engine, clip, required_blinks=99, track=track, sample_fps=sample_fps)
+    total, limit = liveness.video_frame_count(clip)
+    assert total == 120
+    assert sequential['frames_analysed'] == total // sequential['stride']
+    if track:
+        assert sequential['detector_calls'] < sequential['frames_analysed']
+    # Each range starts its own FaceTracker, so re-detection falls on other frames
+    results = [liveness.extract_ear_series(engine, clip, start, end, track=track, sample_fps=sample_fps)
+               for start, end in liveness.split_ranges(total, chunks, last_end=limit)]
+    merged = liveness.merge_ear_results(results, required_blinks=99)
+    assert sequential['blinks'] == 5
+    assert merged['blinks'] == sequential['blinks']
+    assert merged['frames_analysed'] == sequential['frames_analysed']
+    # With the production target both report blinks up to REQUIRED_BLINKS
+    early_exit = liveness.analyse_video(engine, clip, track=track, sample_fps=sample_fps)
+    assert liveness.merge_ear_results(results)['blinks'] == early_exit['blinks'] == liveness.REQUIRED_BLINKS
+
+def test_sampling_keeps_blink_semantics():
+    assert liveness.sample_stride(30) == 2 and liveness.sample_stride(60) == 4
+    assert liveness.sample_stride(15) == liveness.sample_stride(30, 0) == liveness.sample_stride(0) == 1
+    assert liveness.sampled_consec_frames(1) == liveness.CONSEC_FRAMES
+    # A blink is still at least two closed samples, however coarse the sampling
+    for stride in (2, 3, 4):
+        assert liveness.sampled_consec_frames(stride) == 2
+        ears = ears_with_blinks(60, [21], length=1)
+        ears[::stride] = EAR_OPEN
+        ears[20] = EAR_CLOSED
+        assert liveness.BlinkCounter(consec_frames=liveness.sampled_consec_frames(stride)).update(ears[::stride]) == 0
+    assert liveness.sampled_consec_frames(4, consec_frames=1) == 1
+
+@pytest.mark.parametrize('length', range(4, 13))
+def test_sampled_verdicts_match_full_rate_for_real_blink_lengths(length):
+    # Eyes stay below EAR_THRESHOLD for 130-400 ms of a blink, 4-12 frames at 30 fps
+    stride = liveness.sample_stride(30)
+    for phase in range(stride):
+        ears = ears_with_blinks(150, [30 + phase, 90 + phase], length=length)
+        full_rate = liveness.BlinkCounter().update(ears)
+        sampled = liveness.BlinkCounter(consec_frames=liveness.sampled_consec_frames(stride)).update(ears[::stride])
+        assert full_rate == sampled == liveness.REQUIRED_BLINKS
+
+@pytest.mark.parametrize('track', [False, True])
+def test_incremental_analysis_of_a_growing_file_matches_sequential(clip, tmp_path, track):
+    engine = BrightnessEngine()
+    sequential = liveness.analyse_video(engine, clip, required_blinks=99, track=track)
+    data = open(clip, 'rb').read()
+    partial = str(tmp_path / 'partial.avi')
+    parts, analysed_upto = [], 0
+    chunk = len(data) // 7
+    for offset in range(0, len(data), chunk):
+        with open(partial, 'ab') as f:
+            f.write(data[offset:offset + chunk])
+        result = liveness.extract_ear_series(engine, partial, analysed_upto, None, track=track)
+        stable = result['end'] - 8
+        if stable > analysed_upto:
+            parts.append(liveness.truncate_ear_result(result, stable))
+            analysed_upto = stable
+    assert 0 < analysed_upto < 120
+    parts.append(liveness.extract_ear_series(engine, partial, analysed_upto, None, track=track))
+    assert sequential['blinks'] == 5
+    assert liveness.merge_ear_results(parts, required_blinks=99)['blinks'] == sequential['blinks']
+
+def write_clip(path, frames):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, (160, 120))
+    for frame in frames:
+        writer.write(frame)
+    writer.release()
+    return path
+
+def test_prescreen_rejects_static_and_flickering_clips(tmp_path):
+    rng = np.random.default_rng(0)
+    scene = cv2.GaussianBlur(rng.integers(0, 255, (120, 160, 3)).astype(np.uint8), (0, 0), 3).astype(np.float32)
+    noisy = lambda frame: np.clip(frame + rng.normal(0, 2, frame.shape), 0, 255).astype(np.uint8)
+    static = liveness.prescreen(write_clip(str(tmp_path / 'static.avi'), [noisy(scene) for _ in range(45)]))
+    assert static['reason'] == 'static'
+    flickering = [noisy(np.roll(scene, i, axis=1) * (1.0 + 0.1 * (-1) ** i)) for i in range(45)]
+    assert liveness.prescreen(write_clip(str(tmp_path / 'replay.avi'), flickering))['reason'] == 'flicker'
+    moving = [noisy(np.roll(scene, i, axis=1)) for i in range(45)]
+    assert liveness.prescreen(write_clip(str(tmp_path / 'live.avi'), moving))['passed']
+
+def test_prescreen_of_streamed_thumbnails_matches_the_clip(tmp_path):
+    rng = np.random.default_rng(1)
+    scene = cv2.GaussianBlur(rng.integers(0, 255, (120, 160, 3)).astype(np.uint8), (0, 0), 3).astype(np.float32)
+    flickering = [np.clip(np.roll(scene, i, axis=1) * (1.0 + 0.1 * (-1) ** i), 0, 255).astype(np.uint8)
+                  for i in range(45)]
+    path = write_clip(str(tmp_path / 'replay.avi'), flickering)
+    expected = liveness.prescreen(path)
+    # What a stream session collects: one thumbnail per frame while it screens
+    cap = cv2.VideoCapture(path)
+    thumbnails = []
+    for _ in range(liveness.prescreen_frame_count(30)):
+        ok, frame = cap.read()
+        encoded = cv2.imencode('.png', frame)[1].tobytes()
+        thumbnails.append(liveness.frame_ears(BrightnessEngine(), encoded, thumbnail=True)['thumbnail'])
+    cap.release()
+    screen = liveness.prescreen_frames(thumbnails)
+    assert screen['reason'] == expected['reason'] == 'flicker'
+    assert screen['frames'] == expected['frames'] == 30
+    assert abs(screen['flicker'] - expected['flicker']) < 0.2 * expected['flicker']
+
+class FrontalEngine(BrightnessEngine):
+    """One open-eyed, frontal face in the middle of a 160x120 frame"""
+
+    def landmarks(self, gray, rects=None):
+        shape = np.full((68, 2), [80, 60], dtype=np.int32)
+        eye = np.array([[0, 0], [6, -3], [14, -3], [20, 0], [14, 3], [6, 3]])
+        shape[liveness.LEFT_EYE] = eye + [90, 50]
+        shape[liveness.RIGHT_EYE] = eye + [50, 50]
+        shape[liveness.JAW_LEFT] = [40, 60]
+        shape[liveness.JAW_RIGHT] = [120, 60]
+        shape[liveness.NOSE_TIP] = [80, 70]
+        shape[48:] = [80, 85]
+        return [shape]
+
+def test_stream_frames_yield_identity_crops_above_the_cutoff():
+    rng = np.random.default_rng(2)
+    frame = rng.integers(0, 255, (120, 160, 3)).astype(np.uint8)
+    encoded = cv2.imencode('.png', frame)[1].tobytes()
+    analysed = liveness.frame_ears(FrontalEngine(), encoded)
+    assert analysed['identity'] is None and analysed['thumbnail'] is None
+    assert len(analysed['ears']) == 1
+
+    selector = liveness.FrameSelector(k=2)
+    for position in range(3):
+        analysed = liveness.frame_ears(FrontalEngine(), encoded, identity_cutoff=selector.cutoff)
+        if analysed['identity'] is not None:
+            score, crop_png = analysed['identity']
+            selector.keep(score, position, crop_png)
+    # The third, identical frame doesn't beat the two kept ones, so its crop is never sent
+    assert analysed['identity'] is None
+    assert sorted(position for _, position, _ in selector.heap) == [0, 1]
+    crop = cv2.imdecode(np.frombuffer(selector.heap[0][2], np.uint8), cv2.IMREAD_COLOR)
+    assert 0 < crop.shape[0] < 120 and 0 < crop.shape[1] < 160
+    assert liveness.FrameSelector(k=0).cutoff == np.inf
+
+def test_prescreen_of_a_growing_file_waits_for_the_first_second(tmp_path):
+    rng = np.random.default_rng(3)
+    scene = cv2.GaussianBlur(rng.integers(0, 255, (120, 160, 3)).astype(np.uint8), (0, 0), 3).astype(np.float32)
+    frames = [np.clip(scene + rng.normal(0, 2, scene.shape), 0, 255).astype(np.uint8) for _ in range(45)]
+    data = open(write_clip(str(tmp_path / 'static.avi'), frames), 'rb').read()
+    partial = str(tmp_path / 'partial.avi')
+    with open(partial, 'wb') as f:
+        f.write(data[:len(data) // 3])
+    assert liveness.prescreen(partial, holdback=8) is None
+    with open(partial, 'wb') as f:
+        f.write(data[:len(data) * 9 // 10])
+    screen = liveness.prescreen(partial, holdback=8)
+    assert screen == liveness.prescreen(str(tmp_path / 'static.avi'))
+    assert screen['reason'] == 'static' and screen['frames'] == 30
+
+class BoxSensitiveEngine(BrightnessEngine):
+    """
+    dlib-like stand-in: the detector's box is the landmarks' bounds with a taller
+    margin above, and the predictor only recovers the true landmarks from a box
+    placed like that; from any other box it is pulled toward the mean face laid
+    out in that box
+    """
+    PAD = (-0.1, -0.35, 0.1, 0.05)
+
+    def __init__(self, mean_face):
+        self.mean_face = mean_face
+        self.truth = None
+
+    def face_boxes(self, gray):
+        left, top = self.truth.min(axis=0)
+        right, bottom = self.truth.max(axis=0)
+        width, height = right - left, bottom - top
+        return [(left + self.PAD[0] * width, top + self.PAD[1] * height,
+                 right + self.PAD[2] * width, bottom + self.PAD[3] * height)]
+
+    def landmarks(self, gray, rects=None):
+        shapes = []
+        for left, top, right, bottom in (rects or self.face_boxes(gray)):
+            width = (right - left) / (1 + self.PAD[2] - self.PAD[0])
+            height = (bottom - top) / (1 + self.PAD[3] - self.PAD[1])
+            guess = self.mean_face * [width, height] + [left - self.PAD[0] * width, top - self.PAD[1] * height]
+            shapes.append(np.round(0.5 * guess + 0.5 * self.truth).astype(np.int32))
+        return shapes
+
+def test_tracker_predicts_from_detector_like_boxes():
+    face = FrontalEngine().landmarks(None)[0].astype(np.float64)
+    mean_face = (face - face.min(axis=0)) / (face.max(axis=0) - face.min(axis=0))
+    engine = BoxSensitiveEngine(mean_face)
+    gray = np.zeros((240, 320), np.uint8)
+    tracker = liveness.FaceTracker(engine, redetect_every=15)
+    for frame in range(15):
+        # A face drifting right, 1 px per frame
+        engine.truth = np.round(mean_face * [100, 120] + [60 + frame, 60]).astype(np.int32)
+        shapes = tracker.landmarks(gray)
+        assert np.abs(shapes[0] - engine.truth).max() <= 1
+    assert tracker.detector_calls == 1
+    # Predicting inside the landmarks' own bounds lands well off the face
+    tight = engine.landmarks(gray, [liveness.FaceTracker._box(engine.truth)])[0]
+    assert np.abs(tight - engine.truth).max() > 10
@@ -0,0 +1,49 @@
+"""
+Merging metrics recorded in worker processes into the web process's registry.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from routes import metrics
+
+BUCKETS = (1, 10, 100)
+
+def worker_task(values):
+    """Records metrics the way a vision worker task does, then returns what changed"""
+    metrics.gauge('test_worker_pool_size').set(1)
+    histogram = metrics.histogram('test_worker_wait_ms', BUCKETS)
+    for value in values:
+        histogram.observe(value)
+        metrics.counter('test_worker_calls').inc()
+    return metrics.collect()
+
+def test_collect_returns_only_changes_since_last_call():
+    counter = metrics.counter('test_collect_counter')
+    histogram = metrics.histogram('test_collect_histogram', BUCKETS)
+    counter.inc(3)
+    histogram.observe(5)
+    changes = metrics.collect()
+    assert changes['test_collect_counter'] == ('counter', 3)
+    kind, delta = changes['test_collect_histogram']
+    assert kind == 'histogram' and delta['count'] == 1 and delta['recent'] == [5]
+
+    histogram.observe(50)
+    changes = metrics.collect()
+    assert 'test_collect_counter' not in changes
+    assert changes['test_collect_histogram'][1]['counts'] == [0, 0, 1, 0]
+    assert changes['test_collect_histogram'][1]['recent'] == [50]
+    # Nothing is reset locally
+    assert counter.snapshot() == 3 and histogram.snapshot()['count'] == 2
+
+def test_worker_metrics_are_merged():
+    for values in ([0.5, 20], [200]):
+        # A process each, like two vision workers
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            metrics.merge(executor.submit(worker_task, values).result())
+    snapshot = metrics.snapshot()
+    assert snapshot['test_worker_calls'] == 3
+    # Each worker's gauge adds to the total
+    assert snapshot['test_worker_pool_size'] == 2
+    wait = snapshot['test_worker_wait_ms']
+    assert wait['count'] == 3 and wait['sum'] == 220.5
+    assert wait['buckets'] == {'1': 1, '10': 1, '100': 2, '+Inf': 3}
+    assert wait['p99'] == 200
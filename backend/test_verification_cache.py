@@ -0,0 +1,59 @@
+"""
+Memo of /verify responses for retries and Idempotency-Key replays.
+"""
+import threading
+import time
+import pytest
+from concurrent.futures import TimeoutError as VisionTimeoutError
+from routes.verification_cache import VerificationCache, IdempotencyConflict
+
+IMAGES = ('reference-key', 'current-key')
+RESPONSE = {'verified': False, 'similarity': 0.42, 'admin_required': True}
+
+def test_identical_request_gets_the_stored_response():
+    cache = VerificationCache(ttl=60, idempotency_ttl=60)
+    assert cache.acquire(1, IMAGES, 'v1') is None
+    cache.release(1, IMAGES, 'v1', RESPONSE)
+    assert cache.acquire(1, IMAGES, 'v1') == RESPONSE
+    # Another user, other images or another model version is a different verification
+    assert cache.acquire(2, IMAGES, 'v1') is None
+    cache.release(2, IMAGES, 'v1', None)
+    assert cache.acquire(1, IMAGES, 'v2') is None
+    cache.release(1, IMAGES, 'v2', None)
+    # Failed computations are not stored
+    assert cache.acquire(2, IMAGES, 'v1') is None
+
+def test_responses_expire():
+    cache = VerificationCache(ttl=0.05, idempotency_ttl=0.05)
+    assert cache.acquire(1, IMAGES, 'v1') is None
+    cache.release(1, IMAGES, 'v1', RESPONSE)
+    time.sleep(0.1)
+    assert cache.acquire(1, IMAGES, 'v1') is None
+
+def test_idempotency_key():
+    cache = VerificationCache(ttl=0.05, idempotency_ttl=60)
+    assert cache.acquire(1, IMAGES, 'v1', 'attempt-1') is None
+    cache.release(1, IMAGES, 'v1', RESPONSE, 'attempt-1')
+    time.sleep(0.1)
+    # Replayed after the result TTL and across a model change
+    assert cache.acquire(1, IMAGES, 'v2', 'attempt-1') == RESPONSE
+    with pytest.raises(IdempotencyConflict):
+        cache.acquire(1, ('reference-key', 'other-current-key'), 'v1', 'attempt-1')
+    # Keys are per user
+    assert cache.acquire(2, ('a', 'b'), 'v1', 'attempt-1') is None
+
+def test_retry_waits_for_the_request_in_progress():
+    cache = VerificationCache(ttl=60, idempotency_ttl=60)
+    assert cache.acquire(1, IMAGES, 'v1') is None
+    results = []
+    retry = threading.Thread(target=lambda: results.append(cache.acquire(1, IMAGES, 'v1', timeout=5)))
+    retry.start()
+    time.sleep(0.05)
+    assert not results
+    cache.release(1, IMAGES, 'v1', RESPONSE)
+    retry.join()
+    assert results == [RESPONSE]
+
+    assert cache.acquire(2, IMAGES, 'v1') is None
+    with pytest.raises(VisionTimeoutError):
+        cache.acquire(2, IMAGES, 'v1', timeout=0.05)
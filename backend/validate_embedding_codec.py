@@ -0,0 +1,68 @@
+"""
+Checks that compact embedding storage doesn't change verification outcomes.
+
+Embeds every face in BlinkDetection/test_images, then compares all pairwise cosine
+similarities computed from float32 embeddings with those from float16 / int8
+encoded ones. Exits non-zero if any error exceeds embedding_codec.SIMILARITY_TOLERANCE.
+
+    python validate_embedding_codec.py [--images DIR] [--threshold 0.8]
+"""
+import argparse
+import itertools
+import os
+import sys
+import cv2
+import numpy as np
+from routes.face_engine import FaceEngine
+from routes import embedding_codec
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BACKEND_DIR)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', default=os.path.join(PROJECT_ROOT, 'BlinkDetection', 'test_images'))
+    parser.add_argument('--model', default=os.path.join(BACKEND_DIR, 'routes', 'output_model.tflite'))
+    parser.add_argument('--predictor', default=os.path.join(PROJECT_ROOT, 'BlinkDetection', 'shape_predictor_68_face_landmarks.dat'))
+    parser.add_argument('--threshold', type=float, default=0.8, help='SIMILARITY_THRESHOLD used by /verify')
+    args = parser.parse_args()
+
+    engine = FaceEngine(args.model, args.predictor)
+    names, embeddings = [], []
+    for filename in sorted(os.listdir(args.images)):
+        img = cv2.imread(os.path.join(args.images, filename))
+        if img is None:
+            continue
+        embedding, _ = engine.face_embedding(img)
+        if embedding is None:
+            print(f"skipping {filename}: no face detected")
+            continue
+        names.append(filename)
+        embeddings.append(embedding.astype(np.float32))
+    if len(embeddings) < 2:
+        print("Need at least two faces to compare")
+        return 1
+
+    pairs = list(itertools.combinations(range(len(embeddings)), 2))
+    reference = np.array([float(np.dot(embeddings[i], embeddings[j])) for i, j in pairs])
+    print(f"{len(names)} faces, {len(pairs)} pairs, threshold {args.threshold}\n")
+    print(f"{'dtype':<9}{'bytes':>7}{'max err':>11}{'mean err':>11}{'tolerance':>11}{'flipped':>9}")
+
+    failed = False
+    for dtype in ('float32', 'float16', 'int8'):
+        decoded = [embedding_codec.decode(embedding_codec.encode(e, dtype)) for e in embeddings]
+        scores = np.array([float(np.dot(decoded[i], decoded[j])) for i, j in pairs])
+        errors = np.abs(scores - reference)
+        flipped = int(((scores > args.threshold) != (reference > args.threshold)).sum())
+        tolerance = embedding_codec.SIMILARITY_TOLERANCE[dtype]
+        size = len(embedding_codec.encode(embeddings[0], dtype))
+        print(f"{dtype:<9}{size:>7}{errors.max():>11.2e}{errors.mean():>11.2e}{tolerance:>11.0e}{flipped:>9}")
+        if errors.max() > tolerance:
+            failed = True
+            worst = int(errors.argmax())
+            i, j = pairs[worst]
+            print(f"  exceeds tolerance on {names[i]} vs {names[j]}")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())